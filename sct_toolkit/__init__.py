@@ -1,5 +1,5 @@
-
 import sys
+import importlib
 
 try:
     __SCT_TOOLKIT_SETUP__
@@ -9,11 +9,38 @@ except NameError:
 if __SCT_TOOLKIT_SETUP__:
     sys.stderr.write('\n***Partial import of sct_toolkit during the build process***\n')
 else:
+    #classes sharing their submodule's name are bound eagerly, they only need numpy/h5py
     from .pedestal import pedestal
     from .waveform import waveform
-    from .interactive import interactive_heatmap
-    from .analysis import charge_spectrum
-    from .quick_plots import plot_charge, plot_amplitude, plot_position
-    from .utils import docs
+    from .event_builder import event_builder
+
+    #plotting/interactive tools pull in matplotlib and bokeh, load on first access
+    _lazy_attributes = {'interactive_heatmap': ('.interactive', 'interactive_heatmap'),
+                        'charge_spectrum': ('.analysis', 'charge_spectrum'),
+                        'pixel_covariance': ('.analysis', 'pixel_covariance'),
+                        'compare_pedestals': ('.analysis', 'compare_pedestals'),
+                        'make_multirun_database': ('.multirun', 'make_multirun_database'),
+                        'plot_charge': ('.quick_plots', 'plot_charge'),
+                        'plot_amplitude': ('.quick_plots', 'plot_amplitude'),
+                        'plot_position': ('.quick_plots', 'plot_position'),
+                        'make_report': ('.report', 'make_report'),
+                        'docs': ('.utils', 'docs')}
+
+    def __getattr__(name):
+        """ import lazily loaded attributes on first access """
+        if name in _lazy_attributes:
+            module_name, attribute = _lazy_attributes[name]
+            value = getattr(importlib.import_module(module_name, __name__), attribute)
+            globals()[name] = value
+            return value
+        raise AttributeError("module '{}' has no attribute '{}'".format(__name__, name))
+
+    def __dir__():
+        return sorted(set(globals()) | set(_lazy_attributes))
+
+    if sys.version_info < (3, 7):
+        #module level __getattr__ is not supported, fall back to eager imports
+        for _name in _lazy_attributes:
+            __getattr__(_name)
 
 __version__ = '0.0.1'
@@ -1,8 +1,14 @@
 from __future__ import division, print_function, absolute_import
 import sys, os
+import warnings
 import numpy as np
-from .pedestal import pedestal
+import h5py
+from .pedestal import pedestal, channel_flags
 from .waveform import waveform
+from .stats import covariance_stats
+from .handle_pool import handles
+from .catalog import update_catalog
+from .branch_index import write_branch_index
 
 def charge_spectrum(filename, module, asic, channel, block=None, phase=None):
     """
@@ -14,3 +20,312 @@ def charge_spectrum(filename, module, asic, channel, block=None, phase=None):
         If specified, loads an existing database (default: None)
 
     """
+
+def _read_bad_events(wf, pixels, start, stop):
+    """ flag per pixel the events [start, stop) that read samples from masked cells """
+    bad = np.zeros((stop-start, len(pixels)), dtype=bool)
+    for index, (module, asic, channel) in enumerate(pixels):
+        branch = wf.get_branch('Module{}/Asic{}/Channel{}/bad_samples'.format(
+                               module, asic, channel))
+        if branch is not None:
+            bad[:, index] = branch[start:stop] > 0
+    return bad
+
+def _read_observations(wf, pixels, quantity, start, stop, n_baseline):
+    """ read events [start, stop) of every pixel into an (n_observations, n_pixels) array """
+    columns = []
+    for module, asic, channel in pixels:
+        if quantity in ('baseline', 'cal_waveform'):
+            values = wf.get_cal_waveform(module, asic, channel, slice(start, stop))
+            if quantity == 'baseline':
+                values = values[:, :n_baseline].mean(axis=1)
+            else:
+                values = values.ravel()
+        else:
+            branch = wf.get_branch('Module{}/Asic{}/Channel{}/{}'.format(
+                                   module, asic, channel, quantity))
+            if branch is None:
+                raise KeyError("quantity '{}' not found in database".format(quantity))
+            values = branch[start:stop]
+        columns.append(np.asarray(values, dtype=float))
+    return np.stack(columns, axis=1)
+
+def _subtract_common_mode(observations, asic_index, valid=None):
+    """ subtract the per observation median of the (valid) pixels of each asic """
+    for index in np.unique(asic_index):
+        group = asic_index == index
+        if valid is None:
+            median = np.median(observations[:, group], axis=1)
+        else:
+            values = np.where(valid[:, group], observations[:, group], np.nan)
+            with warnings.catch_warnings():
+                #observations without any valid pixel of the asic are not used
+                warnings.simplefilter('ignore', RuntimeWarning)
+                median = np.nanmedian(values, axis=1)
+        observations[:, group] -= median[:,None]
+    return observations
+
+def pixel_covariance(filename, quantity='charge', common_mode=False, n_baseline=8,
+                     chunk_size=10000, save=False, use_masks=True, min_observations=10,
+                     verbose=True, catalog=None):
+    """
+    Calculate the pixel by pixel covariance and correlation matrices of a waveform
+    database in a single streaming pass over all modules, asics, and channels
+
+    Parameters
+    ----------
+    filename : str
+        name and path of waveform database
+    quantity : str (optional)
+        'charge', 'amplitude' or any other per event quantity, 'baseline' for the mean of
+        the first n_baseline calibrated samples of each event, or 'cal_waveform' to
+        treat every calibrated sample as an observation (default: 'charge')
+    common_mode : bool (optional)
+        if True, the median of all pixels of an asic is subtracted from each of its
+        pixels, per event (and sample) before accumulating (default: False)
+    n_baseline : int (optional)
+        number of leading samples averaged for quantity='baseline' (default: 8)
+    chunk_size : int (optional)
+        number of events read at once (default: 10000)
+    save : bool (optional)
+        if True, results are stored in the database under
+        'analysis/covariance_<quantity>' (with '_cm' appended if common_mode) (default: False)
+    use_masks : bool (optional)
+        if True, the values of a pixel from events in which it read samples from cells
+        masked in the pedestal database are skipped, and the covariance of each pair of
+        pixels uses the events in which both are usable. Dead channels, which are not
+        stored, are always skipped (default: True)
+    min_observations : int (optional)
+        warns if any pair of pixels has fewer common observations (default: 10)
+    verbose : bool (optional)
+        if True, prints where the results were saved (default: True)
+    catalog : run_catalog, str or False (optional)
+        run catalog refreshed after saving, False to disable. If None, the
+        SCT_TOOLKIT_CATALOG environment variable or ~/.sct_toolkit/catalog.db is used
+        (default: None)
+
+    Returns
+    ----------
+    dict with keys 'pixels' (n_pixels, 3) array of module, asic, channel, 'mean',
+    'covariance', 'correlation', 'counts' (n_pixels, n_pixels) number of observations
+    of each pair of pixels and 'n_observations'
+
+    """
+    with waveform(filename) as wf:
+        dead = set(wf.get_dead_channels())
+        pixels = [(module, asic, channel) for module in wf.get_module_list()
+                  for asic in wf.get_asic_list() for channel in wf.get_channel_list()
+                  if (int(module), int(asic), int(channel)) not in dead]
+        asics = sorted(set((module, asic) for module, asic, channel in pixels))
+        asic_index = np.array([asics.index((module, asic)) for module, asic, channel in pixels])
+        n_events = int(wf.get_n_events())
+        accumulator = covariance_stats(len(pixels))
+        for start in range(0, n_events, int(chunk_size)):
+            stop = min(start+int(chunk_size), n_events)
+            observations = _read_observations(wf, pixels, quantity, start, stop, n_baseline)
+            valid = None
+            if use_masks:
+                valid = ~_read_bad_events(wf, pixels, start, stop)
+                if quantity == 'cal_waveform':
+                    valid = np.repeat(valid, wf.get_n_samples(), axis=0)
+            if common_mode:
+                observations = _subtract_common_mode(observations, asic_index, valid)
+            accumulator.add(observations, valid)
+
+    counts = accumulator.get_counts()
+    if not np.any(np.diag(counts) > 1):
+        raise ValueError("no usable observations in {}, {} events read{}".format(
+                         filename, n_events, ", all masked (see use_masks)" if
+                         use_masks and accumulator.n else ""))
+    if np.any(counts < min_observations):
+        warnings.warn("{} of {} pixel pairs have fewer than {} common observations, their "
+                      "covariance is unreliable or nan".format(
+                      np.count_nonzero(np.triu(counts < min_observations)),
+                      len(pixels)*(len(pixels)+1)//2, min_observations), stacklevel=2)
+    result = {'pixels': np.array(pixels, dtype=int), 'mean': accumulator.get_mean(),
+              'covariance': accumulator.get_covariance(),
+              'correlation': accumulator.get_correlation(), 'counts': counts,
+              'n_observations': accumulator.n}
+    if save:
+        group_name = 'analysis/covariance_{}{}'.format(quantity, '_cm' if common_mode else '')
+        handles.discard(filename)
+        with h5py.File(filename, "r+", libver='latest') as database:
+            if group_name in database:
+                del database[group_name]
+            group = database.create_group(group_name)
+            for key in ('pixels', 'mean', 'covariance', 'correlation', 'counts'):
+                group.create_dataset(key, data=result[key])
+            group.attrs['quantity'] = quantity
+            group.attrs['common_mode'] = bool(common_mode)
+            group.attrs['n_observations'] = accumulator.n
+            write_branch_index(database)
+        update_catalog(filename, catalog)
+        if verbose:
+            print("Covariance saved to {}:{}".format(filename, group_name))
+    return result
+
+def _list_pedestal_channels(database):
+    """ (module, asic, channel) of every channel group in a pedestal database """
+    pixels = []
+    for module_name in database:
+        if not module_name.startswith('Module'):
+            continue
+        for asic_name in database[module_name]:
+            if not asic_name.startswith('Asic'):
+                continue
+            for channel_name in database[module_name][asic_name]:
+                if channel_name.startswith('Channel'):
+                    pixels.append((int(module_name[6:]), int(asic_name[4:]),
+                                   int(channel_name[7:])))
+    return pixels
+
+def _read_pedestal_block(databases, pixels, n_cells, use_masks):
+    """ read pedestals and usable cell masks of pixels from all databases into contiguous arrays """
+    values = np.zeros((len(databases), len(pixels), n_cells), dtype=np.float32)
+    sampled = np.zeros((len(databases), len(pixels), n_cells), dtype=bool)
+    counts = np.zeros(n_cells, dtype=np.int64)
+    for i, database in enumerate(databases):
+        for j, (module, asic, channel) in enumerate(pixels):
+            group = database['Module{}/Asic{}/Channel{}'.format(module, asic, channel)]
+            group['pedestal'].read_direct(values[i, j])
+            if 'count' in group:
+                group['count'].read_direct(counts)
+                sampled[i, j] = counts > 0
+            else:
+                #databases without cell counts store 0 for cells never sampled
+                sampled[i, j] = values[i, j] != 0
+            if use_masks:
+                if group.attrs.get('channel_mask', 0) & channel_flags['dead']:
+                    sampled[i, j] = False
+                elif 'cell_mask' in group:
+                    sampled[i, j] &= group['cell_mask'][()] == 0
+    return values, sampled
+
+def compare_pedestals(filenames, reference=0, n_sigma=5., min_deviation=1., block_size=64,
+                      verbose=True, report=None, use_masks=True):
+    """
+    Compare pedestal databases with a reference database to track pedestal drift
+
+    Pedestals are read in blocks of block_size channels from all databases at once,
+    so memory use does not grow with the number of channels. Cells not sampled in
+    either database are ignored, as are masked cells and dead channels if use_masks.
+
+    Parameters
+    ----------
+    filenames : list of str
+        names and paths of pedestal databases, ex. ordered in time
+    reference : int (optional)
+        index of the reference database in filenames (default: 0)
+    n_sigma : float (optional)
+        cells deviating from their channel's mean shift by more than n_sigma times
+        the channel's RMS of the difference are outliers (default: 5)
+    min_deviation : float (optional)
+        minimum deviation in ADC counts for a cell to be an outlier (default: 1)
+    block_size : int (optional)
+        number of channels read at once (default: 64)
+    verbose : bool (optional)
+        if True, prints a one line summary per database (default: True)
+    report : str (optional)
+        if specified, the per channel statistics are saved as csv (default: None)
+    use_masks : bool (optional)
+        if True, cells or channels masked in either database are ignored (default: True)
+
+    Returns
+    ----------
+    dict with keys 'filenames', 'pixels' (n_pixels, 3) array of module, asic, channel,
+    'modules', per database and channel 'channel_shift', 'channel_rms' and
+    'channel_outliers' of shape (n_databases, n_pixels), per database and module
+    'module_shift' and 'module_rms' of shape (n_databases, n_modules), per database and
+    cell 'cell_shift' and 'cell_outliers' of shape (n_databases, n_cells), and per
+    database 'shift' and 'rms'
+
+    """
+    filenames = list(filenames)
+    databases = [handles.acquire(name) for name in filenames]
+    try:
+        channel_sets = [set(_list_pedestal_channels(database)) for database in databases]
+        pixels = sorted(set.intersection(*channel_sets))
+        if not pixels:
+            raise KeyError("pedestal databases have no channels in common")
+        if any(len(channels) != len(pixels) for channels in channel_sets):
+            warnings.warn("only the {} channels present in all databases are "
+                          "compared".format(len(pixels)), stacklevel=2)
+        module, asic, channel = pixels[0]
+        n_cells = databases[0]['Module{}/Asic{}/Channel{}/pedestal'.format(
+                                module, asic, channel)].shape[0]
+        n_db, n_pix = len(databases), len(pixels)
+        #per channel sums of the valid differences and their squares
+        n_valid = np.zeros((n_db, n_pix))
+        diff_sum = np.zeros((n_db, n_pix))
+        diff_sq = np.zeros((n_db, n_pix))
+        channel_outliers = np.zeros((n_db, n_pix), dtype=np.int64)
+        cell_sum = np.zeros((n_db, n_cells))
+        cell_valid = np.zeros((n_db, n_cells))
+        cell_outliers = np.zeros((n_db, n_cells), dtype=np.int64)
+        for start in range(0, n_pix, int(block_size)):
+            stop = min(start+int(block_size), n_pix)
+            values, sampled = _read_pedestal_block(databases, pixels[start:stop], n_cells,
+                                                   use_masks)
+            valid = sampled & sampled[reference]
+            diff = np.where(valid, values-values[reference], 0.).astype(float)
+            count = valid.sum(axis=-1)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                mean = diff.sum(axis=-1)/count
+                rms = np.sqrt(np.maximum((diff**2).sum(axis=-1)/count-mean**2, 0.))
+            deviation = np.abs(diff-np.nan_to_num(mean)[...,None])
+            threshold = np.maximum(n_sigma*np.nan_to_num(rms), min_deviation)
+            outliers = valid & (deviation > threshold[...,None])
+            n_valid[:, start:stop] = count
+            diff_sum[:, start:stop] = diff.sum(axis=-1)
+            diff_sq[:, start:stop] = (diff**2).sum(axis=-1)
+            channel_outliers[:, start:stop] = outliers.sum(axis=-1)
+            cell_sum += diff.sum(axis=1)
+            cell_valid += valid.sum(axis=1)
+            cell_outliers += outliers.sum(axis=1)
+    finally:
+        for database in databases:
+            handles.release(database)
+
+    pixel_array = np.array(pixels, dtype=int)
+    modules = np.unique(pixel_array[:, 0])
+    module_index = np.searchsorted(modules, pixel_array[:, 0])
+    def moments(valid, total, total_sq):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = total/valid
+            return mean, np.sqrt(np.maximum(total_sq/valid-mean**2, 0.))
+    channel_shift, channel_rms = moments(n_valid, diff_sum, diff_sq)
+    module_valid, module_sum, module_sq = [
+        np.array([np.bincount(module_index, weights=row, minlength=len(modules)) for row in array])
+        for array in (n_valid, diff_sum, diff_sq)]
+    module_shift, module_rms = moments(module_valid, module_sum, module_sq)
+    shift, rms = moments(n_valid.sum(axis=1), diff_sum.sum(axis=1), diff_sq.sum(axis=1))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cell_shift = cell_sum/cell_valid
+    result = {'filenames': filenames, 'pixels': pixel_array, 'modules': modules,
+              'channel_shift': channel_shift, 'channel_rms': channel_rms,
+              'channel_outliers': channel_outliers, 'module_shift': module_shift,
+              'module_rms': module_rms, 'cell_shift': cell_shift,
+              'cell_outliers': cell_outliers, 'shift': shift, 'rms': rms}
+
+    if verbose:
+        print("Reference: {}".format(filenames[reference]))
+        print("{:>40} {:>9} {:>9} {:>12} {:>10} {:>20}".format(
+              'database', 'shift', 'rms', 'max |module|', 'outliers', 'worst channel'))
+        for i, name in enumerate(filenames):
+            if i == reference:
+                continue
+            worst = np.nanargmax(np.abs(channel_shift[i])) if np.isfinite(channel_shift[i]).any() else 0
+            print("{:>40} {:>9.3f} {:>9.3f} {:>12.3f} {:>10} {:>20}".format(
+                  os.path.basename(name)[-40:], shift[i], rms[i],
+                  np.nanmax(np.abs(module_shift[i])), int(channel_outliers[i].sum()),
+                  "{}/{}/{} ({:+.2f})".format(*(tuple(pixel_array[worst])+
+                                                 (channel_shift[i, worst],)))))
+    if report:
+        with open(report, 'w') as outfile:
+            outfile.write('database,module,asic,channel,shift,rms,outliers\n')
+            for i, name in enumerate(filenames):
+                for j, (module, asic, channel) in enumerate(pixel_array):
+                    outfile.write('{},{},{},{},{:.4f},{:.4f},{}\n'.format(
+                                  name, module, asic, channel, channel_shift[i, j],
+                                  channel_rms[i, j], channel_outliers[i, j]))
+    return result
@@ -0,0 +1,150 @@
+from __future__ import division, print_function, absolute_import
+import h5py
+import numpy as np
+
+#one row per dataset below the Module#/Asic#[/Channel#] groups, channel -1 for asic level
+index_dtype = np.dtype([('module', np.int32), ('asic', np.int32), ('channel', np.int32),
+                        ('key', 'S64')])
+
+def build_branch_index(database):
+    """
+    Build the structural index of the Module#/Asic#/Channel# datasets of a database
+
+    Parameters
+    ----------
+    database : h5py.File
+        pedestal, waveform or multi-run database
+
+    Returns
+    ----------
+    numpy structured array with fields module, asic, channel and key
+
+    """
+    rows = []
+    for module_name, module_group in database.items():
+        if not module_name.startswith('Module') or not isinstance(module_group, h5py.Group):
+            continue
+        module = int(module_name[6:])
+        for asic_name, asic_group in module_group.items():
+            if not asic_name.startswith('Asic'):
+                continue
+            asic = int(asic_name[4:])
+            for name, item in asic_group.items():
+                if isinstance(item, h5py.Group) and name.startswith('Channel'):
+                    channel = int(name[7:])
+                    rows.extend((module, asic, channel, key) for key in item)
+                else:
+                    rows.append((module, asic, -1, name))
+    return np.array(rows, dtype=index_dtype)
+
+def write_branch_index(database):
+    """
+    Store the structural index of a writable database as its 'branch_index' dataset
+
+    Parameters
+    ----------
+    database : h5py.File
+        pedestal, waveform or multi-run database opened for writing
+
+    """
+    index = build_branch_index(database)
+    if 'branch_index' in database:
+        del database['branch_index']
+    database.create_dataset('branch_index', data=index)
+
+def _parse_branch(name):
+    """ (module, asic, channel, key) of a branch name, -1 or '' for missing levels """
+    parts = name.split('/')
+    values = [-1, -1, -1]
+    for level, prefix in enumerate(('Module', 'Asic', 'Channel')):
+        if len(parts) > level and parts[level].startswith(prefix) and parts[level][len(prefix):].isdigit():
+            values[level] = int(parts[level][len(prefix):])
+        else:
+            break
+    depth = sum(value >= 0 for value in values)
+    key = '/'.join(parts[depth:])
+    return values[0], values[1], values[2], key
+
+def list_branches(database, filter_by=None, modules=None, asics=None, channels=None,
+                  keys=None, index=None):
+    """
+    List group and dataset names of a database, answered from its structural index
+    when available
+
+    Parameters
+    ----------
+    database : h5py.File
+        pedestal, waveform or multi-run database
+    filter_by : list of str (optional)
+        keep names containing all of these patterns (default: None)
+    modules, asics, channels : list of ints (optional)
+        keep branches of these modules, asics or channels (default: None)
+    keys : list of str (optional)
+        keep datasets with these names, ex. ['charge', 'amplitude'] (default: None)
+    index : numpy structured array (optional)
+        previously read branch_index, if None it is read from the database (default: None)
+
+    Returns
+    ----------
+    list of str
+
+    """
+    if index is None and 'branch_index' in database:
+        index = database['branch_index'][()]
+    if index is None:
+        #databases without index, enumerate every object once
+        names = []
+        database.visit(names.append)
+        parsed = [_parse_branch(name) for name in names]
+    else:
+        #structured filters select index rows without building their names
+        for field, values in (('module', modules), ('asic', asics), ('channel', channels)):
+            if values is not None:
+                index = index[np.isin(index[field], np.asarray(values, dtype=int))]
+        if keys is not None:
+            index = index[np.isin(index['key'], np.array([str(key).encode() for key in keys]))]
+        names, parsed = [], []
+        for module, asic, channel, key in index.tolist():
+            key = key.decode()
+            if channel < 0:
+                name = 'Module{}/Asic{}/{}'.format(module, asic, key)
+            else:
+                name = 'Module{}/Asic{}/Channel{}/{}'.format(module, asic, channel, key)
+            names.append(name)
+            parsed.append((module, asic, channel, key))
+        #parent groups are implied by the datasets below them
+        groups = set()
+        for module, asic, channel, key in set(parsed):
+            groups.update([(module, -1, -1, ''), (module, asic, -1, '')])
+            if channel >= 0:
+                groups.add((module, asic, channel, ''))
+        for module, asic, channel, key in sorted(groups):
+            name = '/'.join(level for level in ('Module{}'.format(module),
+                            'Asic{}'.format(asic) if asic >= 0 else '',
+                            'Channel{}'.format(channel) if channel >= 0 else '') if level)
+            names.append(name)
+            parsed.append((module, asic, channel, key))
+        #objects outside the Module# tree, ex. ped_slice_index or analysis results
+        for name, item in database.items():
+            if name.startswith('Module') or name == 'branch_index':
+                continue
+            children = [name]
+            if isinstance(item, h5py.Group):
+                #visit stops at the first callback returning a value, append returns None
+                item.visit(lambda child: children.append(name+'/'+child))
+            names.extend(children)
+            parsed.extend(_parse_branch(child) for child in children)
+    selection = []
+    for name, (module, asic, channel, key) in zip(names, parsed):
+        if modules is not None and module not in modules:
+            continue
+        if asics is not None and asic not in asics:
+            continue
+        if channels is not None and channel not in channels:
+            continue
+        if keys is not None and key not in keys:
+            continue
+        if filter_by and not all(pattern in name for pattern in set(filter_by)):
+            continue
+        selection.append(name)
+    return selection
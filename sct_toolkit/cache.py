@@ -0,0 +1,279 @@
+from __future__ import division, print_function, absolute_import
+import sys, os
+import errno
+import fcntl
+import glob
+import shutil
+import threading
+import warnings
+
+def find_run_file(run_number):
+    """
+    Locate run file in target5and7data
+
+    Parameters
+    ----------
+    run_number : int
+        run number
+
+    Returns
+    ----------
+    str
+
+    """
+    filename = "{}/target5and7data/run{}.fits".format(os.environ['HOME'], run_number)
+    if not os.path.isfile(filename):
+        new_path = "{0}/target5and7data/runs_{1}0000_"\
+                   "through_{1}9999/".format(os.environ['HOME'], str(run_number)[:-4])
+        filename = new_path+"run{}.fits".format(run_number)
+        if not os.path.isfile(filename):
+            raise IOError("File run{}.fits cannot be located".format(run_number))
+    return filename
+
+def get_cache(cache):
+    """
+    Resolve cache argument to a run_cache instance
+
+    Parameters
+    ----------
+    cache : run_cache, str or None
+        run_cache instance, cache directory, or None to use the directory in the
+        SCT_TOOLKIT_CACHE_DIR environment variable if set
+
+    Returns
+    ----------
+    run_cache or None
+
+    """
+    if isinstance(cache, run_cache):
+        return cache
+    if cache:
+        return run_cache(cache)
+    if os.environ.get('SCT_TOOLKIT_CACHE_DIR'):
+        return run_cache(os.environ['SCT_TOOLKIT_CACHE_DIR'])
+    return None
+
+class run_cache(object):
+    """ Local staging cache for run files with a size limit and LRU eviction """
+    def __init__(self, cache_dir, max_size=None):
+        """
+        Initialize run cache
+
+        Parameters
+        ----------
+        cache_dir : str
+            Local directory holding staged run files, created if needed
+        max_size : float (optional)
+            Maximum total size of staged files in GB. If None, uses the
+            SCT_TOOLKIT_CACHE_SIZE environment variable or 100 GB (default: None)
+
+        """
+        self.cache_dir = os.path.abspath(os.path.expanduser(str(cache_dir)))
+        if max_size is None:
+            max_size = float(os.environ.get('SCT_TOOLKIT_CACHE_SIZE', 100))
+        self.max_size = int(float(max_size)*1e9)
+        self._prefetching = {}
+        self._lock = threading.Lock()
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def _acquire_run(self, run_number, n_bytes):
+        """ take the staging lock file of a run, False if another process is staging it """
+        lock_name = self._cached_name(run_number)+'.lock'
+        for attempt in range(2):
+            try:
+                fd = os.open(lock_name, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except OSError as err:
+                if err.errno != errno.EEXIST:
+                    raise
+                if self._read_lock(lock_name) is not None:
+                    return False
+                #left behind by a process that died while staging
+                self._remove(lock_name)
+                continue
+            with os.fdopen(fd, 'w') as lock_file:
+                lock_file.write("{} {}".format(os.getpid(), int(n_bytes)))
+            return True
+        return False
+
+    def _cached_name(self, run_number):
+        """ return path of staged run file """
+        return os.path.join(self.cache_dir, "run{}.fits".format(int(run_number)))
+
+    def _evict(self, n_bytes, run_number):
+        """ remove least recently used run files until n_bytes fit in the cache """
+        #bytes reserved by copies in progress in other processes
+        reserved, staging = 0, set()
+        for lock_name in glob.glob(os.path.join(self.cache_dir, 'run*.fits.lock')):
+            lock = self._read_lock(lock_name)
+            if lock is not None and lock_name != self._cached_name(run_number)+'.lock':
+                reserved += lock[1]
+                staging.add(lock_name[:-len('.lock')])
+        #partial copies of processes that died while staging
+        for tmp_file in glob.glob(os.path.join(self.cache_dir, '*.fits.tmp*')):
+            if tmp_file.rsplit('.tmp', 1)[0] not in staging:
+                self._remove(tmp_file)
+        staged = sorted(self.get_files(), key=os.path.getmtime)
+        total = sum(os.path.getsize(name) for name in staged)
+        while staged and total+reserved+n_bytes > self.max_size:
+            oldest = staged.pop(0)
+            total -= os.path.getsize(oldest)
+            self._remove(oldest)
+
+    def _prefetch(self, run_number):
+        """ background staging of a run file """
+        try:
+            if not os.path.isfile(self._cached_name(run_number)):
+                self.stage(run_number, find_run_file(run_number))
+        except (IOError, OSError) as err:
+            warnings.warn("prefetch of run {} failed: {}".format(run_number, err))
+        finally:
+            with self._lock:
+                self._prefetching.pop(run_number, None)
+
+    def _read_lock(self, lock_name):
+        """ (pid, reserved bytes) of a staging lock held by a running process, else None """
+        try:
+            with open(lock_name) as lock_file:
+                pid, n_bytes = [int(value) for value in lock_file.read().split()]
+        except (IOError, OSError, ValueError):
+            return None
+        try:
+            os.kill(pid, 0)
+        except OSError as err:
+            if err.errno != errno.EPERM:
+                return None
+        return pid, n_bytes
+
+    def _remove(self, name):
+        """ remove a file that another process may have removed already """
+        try:
+            os.remove(name)
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise
+
+    def _wait_for_prefetch(self, run_number):
+        """ block until a running prefetch of run_number has finished """
+        with self._lock:
+            thread = self._prefetching.get(int(run_number))
+        if thread is not None:
+            thread.join()
+
+    def clear(self):
+        """ Remove all staged run files """
+        for name in self.get_files():
+            os.remove(name)
+
+    def get_files(self):
+        """
+        Get list of staged run files
+
+        Returns
+        ----------
+        list of str
+
+        """
+        return glob.glob(os.path.join(self.cache_dir, 'run*.fits'))
+
+    def get_size(self):
+        """
+        Get total size of staged run files in bytes
+
+        Returns
+        ----------
+        int
+
+        """
+        return sum(os.path.getsize(name) for name in self.get_files())
+
+    def lookup(self, run_number):
+        """
+        Get path of a staged run file, marking it as recently used
+
+        Parameters
+        ----------
+        run_number : int
+            run number
+
+        Returns
+        ----------
+        str, or None if the run is not staged
+
+        """
+        self._wait_for_prefetch(run_number)
+        name = self._cached_name(run_number)
+        if not os.path.isfile(name):
+            return None
+        os.utime(name, None)
+        return name
+
+    def prefetch(self, run_number):
+        """
+        Stage a run file in a background thread
+
+        Parameters
+        ----------
+        run_number : int
+            run number
+
+        Returns
+        ----------
+        threading.Thread
+
+        """
+        run_number = int(run_number)
+        with self._lock:
+            if run_number in self._prefetching:
+                return self._prefetching[run_number]
+            thread = threading.Thread(target=self._prefetch, args=(run_number,))
+            self._prefetching[run_number] = thread
+        thread.start()
+        return thread
+
+    def stage(self, run_number, filename):
+        """
+        Copy a run file into the cache
+
+        Processes sharing the cache directory coordinate through a lock file per run
+        and a lock of the whole cache during eviction. If another process is staging
+        the run, the copy is skipped and the remote file is used.
+
+        Parameters
+        ----------
+        run_number : int
+            run number
+        filename : str
+            path of the remote run file
+
+        Returns
+        ----------
+        str, path of the staged file, or filename if it exceeds the cache size or
+        another process is staging it
+
+        """
+        size = os.path.getsize(filename)
+        if size > self.max_size:
+            warnings.warn("run{}.fits is larger than the cache, reading remote file".format(
+                          run_number), stacklevel=2)
+            return filename
+        name = self._cached_name(run_number)
+        with open(os.path.join(self.cache_dir, '.cache.lock'), 'a') as cache_lock:
+            #reservations and eviction are serialized between processes
+            fcntl.flock(cache_lock, fcntl.LOCK_EX)
+            try:
+                if os.path.isfile(name):
+                    os.utime(name, None)
+                    return name
+                if not self._acquire_run(run_number, size):
+                    return filename
+                self._evict(size, run_number)
+            finally:
+                fcntl.flock(cache_lock, fcntl.LOCK_UN)
+        try:
+            tmp_name = "{}.tmp{}".format(name, os.getpid())
+            shutil.copyfile(filename, tmp_name)
+            os.rename(tmp_name, name)
+        finally:
+            self._remove(name+'.lock')
+        return name
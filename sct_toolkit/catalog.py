@@ -0,0 +1,278 @@
+from __future__ import division, print_function, absolute_import
+import os
+import sqlite3
+import warnings
+import h5py
+import numpy as np
+
+default_catalog = os.path.join('~', '.sct_toolkit', 'catalog.db')
+
+_schema = """
+CREATE TABLE IF NOT EXISTS databases (
+    path TEXT PRIMARY KEY, kind TEXT, run INTEGER, ped_name TEXT, num_events INTEGER,
+    waveform_length INTEGER, date TEXT, created_by TEXT, comments TEXT, keys TEXT,
+    size INTEGER, mtime REAL);
+CREATE TABLE IF NOT EXISTS runs (path TEXT, run INTEGER);
+CREATE TABLE IF NOT EXISTS modules (path TEXT, module INTEGER);
+CREATE INDEX IF NOT EXISTS databases_run ON databases (run);
+CREATE INDEX IF NOT EXISTS runs_run ON runs (run);
+CREATE INDEX IF NOT EXISTS runs_path ON runs (path);
+CREATE INDEX IF NOT EXISTS modules_module ON modules (module);
+CREATE INDEX IF NOT EXISTS modules_path ON modules (path);
+"""
+
+def get_catalog(catalog):
+    """
+    Resolve catalog argument to a run_catalog instance
+
+    Parameters
+    ----------
+    catalog : run_catalog, str, False or None
+        run_catalog instance, catalog file, False to disable the catalog, or None to
+        use the file in the SCT_TOOLKIT_CATALOG environment variable if set, else
+        ~/.sct_toolkit/catalog.db
+
+    Returns
+    ----------
+    run_catalog or None
+
+    """
+    if isinstance(catalog, run_catalog):
+        return catalog
+    if catalog is False:
+        return None
+    if catalog:
+        return run_catalog(catalog)
+    return run_catalog(os.environ.get('SCT_TOOLKIT_CATALOG') or default_catalog)
+
+def update_catalog(filename, catalog=None):
+    """
+    Add or refresh a database in the run catalog, warning instead of failing
+
+    Parameters
+    ----------
+    filename : str
+        name and path of a pedestal, waveform or multi-run database
+    catalog : run_catalog, str, False or None (optional)
+        see get_catalog (default: None)
+
+    """
+    try:
+        catalog = get_catalog(catalog)
+        if catalog is not None:
+            catalog.add(filename)
+    except (IOError, OSError, sqlite3.Error) as err:
+        warnings.warn("run catalog not updated for {}: {}".format(filename, err), stacklevel=2)
+
+class run_catalog(object):
+    """ SQLite index of the metadata of pedestal and waveform databases """
+    def __init__(self, filename=default_catalog):
+        """
+        Initialize run catalog
+
+        Only the metadata attributes of the databases are indexed, so queries do
+        not open any hdf5 file. Keep the catalog on a local disk, SQLite locking is
+        unreliable on network file systems.
+
+        Parameters
+        ----------
+        filename : str (optional)
+            catalog file, created if needed (default: ~/.sct_toolkit/catalog.db)
+
+        """
+        self.filename = os.path.abspath(os.path.expanduser(str(filename)))
+        directory = os.path.dirname(self.filename)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with self._connect() as connection:
+            connection.executescript(_schema)
+
+    def _connect(self):
+        """ open a connection, waiting for concurrent writers (ex. batch workers) """
+        return _connection(sqlite3.connect(self.filename, timeout=60))
+
+    def _read_attributes(self, filename):
+        """ return the catalog row, runs and modules of a database """
+        stat = os.stat(filename)
+        with h5py.File(filename, "r") as database:
+            attrs = database.attrs
+            if 'sources' in attrs:
+                kind = 'multirun'
+            elif 'estimator' in attrs or str(attrs.get('keys', '')).startswith('pedestal'):
+                kind = 'pedestal'
+            else:
+                kind = 'waveform'
+            runs = [int(run) for run in np.atleast_1d(attrs['run'])]
+            modules = [int(module) for module in np.atleast_1d(attrs['modules'])]
+            row = (filename, kind, runs[0], str(attrs['ped_name']) if 'ped_name' in attrs else None,
+                   int(attrs['num_events']), int(attrs['waveform_length']),
+                   str(attrs.get('date', '')), str(attrs.get('created_by', '')),
+                   str(attrs.get('comments', '')), str(attrs.get('keys', '')),
+                   int(stat.st_size), float(stat.st_mtime))
+        return row, runs, modules
+
+    def _remove(self, connection, paths):
+        """ delete catalog entries of paths """
+        for table in ('databases', 'runs', 'modules'):
+            connection.executemany("DELETE FROM {} WHERE path = ?".format(table),
+                                   [(path,) for path in paths])
+
+    def add(self, filename):
+        """
+        Add a database to the catalog, replacing an existing entry of the same file
+
+        Parameters
+        ----------
+        filename : str
+            name and path of a pedestal, waveform or multi-run database
+
+        """
+        filename = os.path.abspath(str(filename))
+        row, runs, modules = self._read_attributes(filename)
+        with self._connect() as connection:
+            self._remove(connection, [filename])
+            connection.execute("INSERT INTO databases VALUES (?,?,?,?,?,?,?,?,?,?,?,?)", row)
+            connection.executemany("INSERT INTO runs VALUES (?,?)",
+                                   [(filename, run) for run in runs])
+            connection.executemany("INSERT INTO modules VALUES (?,?)",
+                                   [(filename, module) for module in modules])
+
+    def query(self, runs=None, kind=None, modules=None, ped_name=None, comments=None,
+              path=None):
+        """
+        Find databases matching all given criteria
+
+        Parameters
+        ----------
+        runs : int or list of ints (optional)
+            databases containing any of these runs (default: None)
+        kind : str (optional)
+            'pedestal', 'waveform' or 'multirun' (default: None)
+        modules : int or list of ints (optional)
+            databases containing all of these modules (default: None)
+        ped_name : str (optional)
+            waveform databases calibrated with a pedestal database whose path contains
+            this text (default: None)
+        comments : str (optional)
+            databases whose comments contain this text (default: None)
+        path : str (optional)
+            databases whose path contains this text (default: None)
+
+        Returns
+        ----------
+        list of dicts, ordered by run and path
+
+        """
+        conditions, values = [], []
+        if runs is not None:
+            runs = [int(run) for run in np.atleast_1d(runs)]
+            conditions.append("path IN (SELECT path FROM runs WHERE run IN ({}))".format(
+                              ",".join("?"*len(runs))))
+            values += runs
+        if modules is not None:
+            for module in np.atleast_1d(modules):
+                conditions.append("path IN (SELECT path FROM modules WHERE module = ?)")
+                values.append(int(module))
+        if kind is not None:
+            conditions.append("kind = ?")
+            values.append(str(kind))
+        for column, text in (('ped_name', ped_name), ('comments', comments), ('path', path)):
+            if text is not None:
+                conditions.append("{} LIKE ?".format(column))
+                values.append('%{}%'.format(text))
+        statement = "SELECT * FROM databases"
+        if conditions:
+            statement += " WHERE "+" AND ".join(conditions)
+        with self._connect() as connection:
+            connection.row_factory = sqlite3.Row
+            rows = [dict(row) for row in connection.execute(statement+" ORDER BY run, path",
+                                                            values)]
+            for row in rows:
+                row['runs'] = [run for (run,) in connection.execute(
+                               "SELECT run FROM runs WHERE path = ? ORDER BY run", (row['path'],))]
+                row['modules'] = [module for (module,) in connection.execute(
+                                  "SELECT module FROM modules WHERE path = ?", (row['path'],))]
+        return rows
+
+    def remove_missing(self):
+        """
+        Remove entries of databases that no longer exist
+
+        Returns
+        ----------
+        int, number of removed entries
+
+        """
+        with self._connect() as connection:
+            missing = [path for (path,) in connection.execute("SELECT path FROM databases")
+                       if not os.path.isfile(path)]
+            self._remove(connection, missing)
+        return len(missing)
+
+    def scan(self, directories, pattern='.h5', verbose=True):
+        """
+        Incrementally index the databases below one or more directories. Files
+        whose size and modification time match their catalog entry are not opened,
+        entries of deleted files are removed.
+
+        Parameters
+        ----------
+        directories : str or list of str
+            directories searched recursively
+        pattern : str (optional)
+            file name suffix of databases (default: '.h5')
+        verbose : bool (optional)
+            if True, prints the number of added, unchanged and skipped files (default: True)
+
+        Returns
+        ----------
+        dict with the numbers of 'added', 'unchanged', 'skipped' and 'removed' files
+
+        """
+        if isinstance(directories, str):
+            directories = [directories]
+        with self._connect() as connection:
+            known = dict((path, (size, mtime)) for path, size, mtime in
+                         connection.execute("SELECT path, size, mtime FROM databases"))
+        summary = {'added': 0, 'unchanged': 0, 'skipped': 0, 'removed': 0}
+        for directory in directories:
+            directory = os.path.abspath(os.path.expanduser(directory))
+            for root, dirs, files in os.walk(directory):
+                for name in sorted(files):
+                    if not name.endswith(pattern):
+                        continue
+                    filename = os.path.join(root, name)
+                    stat = os.stat(filename)
+                    if known.get(filename) == (stat.st_size, stat.st_mtime):
+                        summary['unchanged'] += 1
+                        continue
+                    try:
+                        self.add(filename)
+                        summary['added'] += 1
+                    except (IOError, OSError, KeyError):
+                        #not a toolkit database, or still being written
+                        summary['skipped'] += 1
+            #drop entries of files deleted below the scanned directory
+            gone = [path for path in known if path.startswith(directory+os.sep)
+                    and not os.path.isfile(path)]
+            with self._connect() as connection:
+                self._remove(connection, gone)
+            summary['removed'] += len(gone)
+        if verbose:
+            print("Catalog {}: {added} added/updated, {unchanged} unchanged, {skipped} "
+                  "skipped, {removed} removed".format(self.filename, **summary))
+        return summary
+
+class _connection(object):
+    """ sqlite3 connection committing on success and always closing """
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        return self.connection
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.connection.commit()
+        self.connection.close()
+        return False
@@ -0,0 +1,348 @@
+from __future__ import division, print_function, absolute_import
+import sys, os
+import argparse
+import time
+import traceback
+import multiprocessing
+from .pedestal import pedestal
+from .waveform import waveform
+from .cache import run_cache
+from .extractors import extractors
+from .timing import estimators
+from .common_mode import methods
+from .analysis import compare_pedestals
+from .catalog import get_catalog
+from .report import make_report, formats, quantities
+
+overwrite_policies = ['skip', 'overwrite', 'fail']
+
+def _parse_runs(specs):
+    """ convert run specifiers, ex. ['322342-322345', '322350,322352'], to sorted run list """
+    runs = set()
+    for spec in specs:
+        for item in str(spec).split(','):
+            item = item.strip()
+            if not item:
+                continue
+            if '-' in item:
+                first, last = item.split('-', 1)
+                runs.update(range(int(first), int(last)+1))
+            else:
+                runs.add(int(item))
+    return sorted(runs)
+
+def _pair_runs(runs, ped_runs):
+    """ pair each data run with the closest pedestal run taken before it """
+    pairs = []
+    for run in runs:
+        earlier = [ped for ped in ped_runs if ped <= run]
+        pairs.append((run, max(earlier) if earlier else None))
+    return pairs
+
+def _check_output(outfile, overwrite):
+    """ apply non-interactive overwrite policy, return True if the job should run """
+    if not os.path.isfile(outfile):
+        return True
+    if overwrite == 'overwrite':
+        return True
+    if overwrite == 'fail':
+        raise IOError("output file '{}' already exists".format(outfile))
+    return False
+
+def _run_job(job):
+    """ process a single run in a worker process, return summary dict """
+    result = {'run': job['run'], 'ped_run': job.get('ped_run'), 'output': job['outfile'],
+              'status': 'done', 'n_events': 0, 'elapsed': 0., 'message': ''}
+    stdout = sys.stdout
+    start = time.time()
+    try:
+        if not _check_output(job['outfile'], job['overwrite']):
+            result['status'] = 'skipped'
+            result['message'] = 'output exists'
+            return result
+        if job['log_dir']:
+            sys.stdout = open(os.path.join(job['log_dir'], 'run{}.log'.format(job['run'])), 'w')
+        cache = None
+        if job['cache_dir']:
+            cache = run_cache(job['cache_dir'], max_size=job['cache_size'])
+        if job['command'] == 'build-peds':
+            ped = pedestal()
+            ped.make_pedestal_database(job['outfile'], job['run'], job['modules'],
+                                       asics=job['asics'], channels=job['channels'],
+                                       check_overwrite=False, comments=job['comments'],
+                                       pipelined=job['pipelined'], chunk_size=job['chunk_size'],
+                                       cache=cache, prefetch_run=job['prefetch_run'],
+                                       estimator=job['estimator'], time_slices=job['time_slices'],
+                                       slice_by=job['slice_by'], catalog=job['catalog'])
+            result['n_events'] = int(ped.n_events)
+        else:
+            if job['ped_required'] and job['ped_name'] is None:
+                raise IOError("no pedestal run precedes run {}".format(job['run']))
+            if job['ped_name'] and not os.path.isfile(job['ped_name']):
+                raise IOError("pedestal database '{}' not found".format(job['ped_name']))
+            wf = waveform()
+            wf.write_events(job['run'], job['modules'], outname=os.path.basename(job['outfile']),
+                            outdir=os.path.dirname(job['outfile']) or '.',
+                            ped_name=job['ped_name'], asics=job['asics'],
+                            channels=job['channels'], check_overwrite=False,
+                            comments=job['comments'], charge_interval=job['charge_interval'],
+                            pipelined=job['pipelined'], chunk_size=job['chunk_size'],
+                            cache=cache, prefetch_run=job['prefetch_run'],
+                            store_calibrated=not job['calibrate_on_read'],
+                            extractor=job['extractor'], timing=job['timing'],
+                            store_stats=job['stats'], common_mode=job['common_mode'],
+                            ped_slices=job['ped_slices'], use_masks=not job['no_masks'],
+                            zero_suppress=job['zero_suppress'], previews=job['previews'],
+                            catalog=job['catalog'])
+            result['n_events'] = int(wf.n_events)
+    except (Exception, SystemExit) as err:
+        result['status'] = 'failed'
+        result['message'] = str(err) or type(err).__name__
+        if job['log_dir']:
+            traceback.print_exc(file=sys.stdout)
+    finally:
+        if sys.stdout is not stdout:
+            sys.stdout.close()
+            sys.stdout = stdout
+        result['elapsed'] = time.time()-start
+    return result
+
+def _make_jobs(args):
+    """ build list of job dicts from parsed arguments """
+    runs = _parse_runs(args.runs)
+    common = {'command': args.command, 'modules': args.modules, 'asics': args.asics,
+              'channels': args.channels, 'comments': args.comments,
+              'overwrite': args.overwrite, 'log_dir': args.log_dir,
+              'pipelined': args.pipelined, 'chunk_size': args.chunk_size,
+              'cache_dir': args.cache_dir, 'cache_size': args.cache_size,
+              'catalog': args.catalog}
+    jobs = []
+    if args.command == 'build-peds':
+        for run in runs:
+            job = dict(common, run=run, estimator=args.estimator, time_slices=args.time_slices,
+                       slice_by=args.slice_by)
+            job['outfile'] = os.path.join(args.outdir, 'pedestal_database_{}.h5'.format(run))
+            jobs.append(job)
+    else:
+        ped_runs = _parse_runs(args.ped_runs) if args.ped_runs else []
+        for run, ped_run in _pair_runs(runs, ped_runs):
+            job = dict(common, run=run, ped_run=ped_run, charge_interval=args.charge_interval,
+                       calibrate_on_read=args.calibrate_on_read, extractor=args.extractor,
+                       timing=args.timing, stats=args.stats,
+                       common_mode=args.common_mode, ped_slices=args.ped_slices,
+                       no_masks=args.no_masks, zero_suppress=args.zero_suppress,
+                       previews=None if args.previews is None else (args.previews or True))
+            job['outfile'] = os.path.join(args.outdir, 'run{}.h5'.format(run))
+            job['ped_name'] = None
+            job['ped_required'] = bool(ped_runs)
+            if ped_run is not None:
+                job['ped_name'] = os.path.join(args.ped_dir,
+                                               'pedestal_database_{}.h5'.format(ped_run))
+            jobs.append(job)
+    #each worker prefetches the run its next job will most likely process
+    for i, job in enumerate(jobs):
+        next_job = i+max(args.jobs, 1)
+        job['prefetch_run'] = jobs[next_job]['run'] if next_job < len(jobs) else None
+    return jobs
+
+def _print_report(results, wall_time, report=None):
+    """ print per run throughput summary, optionally save it as csv """
+    header = ('run', 'ped_run', 'status', 'events', 'seconds', 'events/s', 'message')
+    rows = []
+    for res in sorted(results, key=lambda r: r['run']):
+        rate = res['n_events']/res['elapsed'] if res['elapsed'] > 0 else 0.
+        rows.append((res['run'], res['ped_run'] if res['ped_run'] is not None else '-',
+                     res['status'], res['n_events'], '{:.1f}'.format(res['elapsed']),
+                     '{:.1f}'.format(rate), res['message']))
+    print('\n'+'{:>8} {:>8} {:>8} {:>9} {:>9} {:>10}  {}'.format(*header))
+    for row in rows:
+        print('{:>8} {:>8} {:>8} {:>9} {:>9} {:>10}  {}'.format(*row))
+    n_events = sum(res['n_events'] for res in results)
+    print('Processed {} runs ({} events) in {:.1f} s, {:.1f} events/s overall'.format(
+          len(results), n_events, wall_time, n_events/wall_time if wall_time > 0 else 0.))
+    if report:
+        with open(report, 'w') as outfile:
+            outfile.write(','.join(header)+'\n')
+            for row in rows:
+                outfile.write(','.join(str(val) for val in row)+'\n')
+
+def _query_catalog(args):
+    """ rescan directories and/or print matching catalog entries """
+    catalog = get_catalog(args.catalog)
+    if args.remove_missing:
+        print("Removed {} missing databases".format(catalog.remove_missing()))
+    if args.scan:
+        catalog.scan(args.scan)
+    rows = catalog.query(runs=_parse_runs(args.runs) if args.runs else None, kind=args.kind,
+                         modules=args.modules, ped_name=args.ped_name,
+                         comments=args.comments, path=args.path)
+    print('{:>8} {:>9} {:>8} {:>7} {:<20}  {}'.format('run', 'kind', 'events', 'samples',
+                                                       'modules', 'path'))
+    for row in rows:
+        print('{:>8} {:>9} {:>8} {:>7} {:<20}  {}'.format(
+              row['run'], row['kind'], row['num_events'], row['waveform_length'],
+              ','.join(str(module) for module in row['modules']), row['path']))
+    print('{} databases'.format(len(rows)))
+    return 0
+
+def _build_parser():
+    """ construct command line argument parser """
+    parser = argparse.ArgumentParser(prog='sct-toolkit',
+                                     description='Batch processing of pSCT runs')
+    subparsers = parser.add_subparsers(dest='command')
+
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('runs', nargs='+',
+                        help="run numbers, lists or ranges, ex. 322342-322350 322360,322362")
+    common.add_argument('-m', '--modules', nargs='+', type=int, required=True,
+                        help="ordered list of module numbers used during data taking")
+    common.add_argument('--asics', nargs='+', type=int, default=list(range(4)))
+    common.add_argument('--channels', nargs='+', type=int, default=list(range(16)))
+    common.add_argument('-o', '--outdir', default='.', help="output directory (default: .)")
+    common.add_argument('-j', '--jobs', type=int, default=1,
+                        help="number of runs processed concurrently (default: 1)")
+    common.add_argument('--overwrite', choices=overwrite_policies, default='skip',
+                        help="policy for existing output files (default: skip)")
+    common.add_argument('--comments', default=None, help="comments added as metadata")
+    common.add_argument('--log-dir', default=None,
+                        help="write per run output to log files in this directory")
+    common.add_argument('--report', default=None, help="save summary report as csv")
+    common.add_argument('--pipelined', action='store_true',
+                        help="overlap packet reading, processing and writing within each run")
+    common.add_argument('--cache-dir', default=None,
+                        help="local directory used to stage run files (default: no cache)")
+    common.add_argument('--cache-size', type=float, default=None,
+                        help="maximum size of the staging cache in GB (default: 100)")
+    common.add_argument('--chunk-size', type=int, default=1000,
+                        help="number of events processed at once (default: 1000)")
+    common.add_argument('--catalog', default=None,
+                        help="run catalog updated with new databases (default: "
+                             "$SCT_TOOLKIT_CATALOG or ~/.sct_toolkit/catalog.db)")
+
+    peds = subparsers.add_parser('build-peds', parents=[common],
+                                 help="create pedestal databases")
+    peds.add_argument('--estimator', choices=['mean', 'median'], default='mean',
+                      help="per cell pedestal estimator (default: mean)")
+    peds.add_argument('--time-slices', type=int, default=1,
+                      help="also store pedestals of this many time slices (default: 1)")
+    peds.add_argument('--slice-by', choices=['event', 'tack'], default='event',
+                      help="split runs into equal event ranges or TACK windows (default: event)")
+    events = subparsers.add_parser('write-events', parents=[common],
+                                   help="create waveform databases")
+    events.add_argument('-p', '--ped-runs', nargs='+', default=None,
+                        help="pedestal runs, each data run uses the closest preceding one")
+    events.add_argument('--ped-dir', default='.',
+                        help="directory containing pedestal_database_<run>.h5 files (default: .)")
+    events.add_argument('--charge-interval', nargs=2, type=int, default=[8, 8],
+                        metavar=('LOWER', 'UPPER'))
+    events.add_argument('--calibrate-on-read', action='store_true',
+                        help="do not store cal_waveform, subtract pedestals when reading")
+    events.add_argument('--extractor', choices=sorted(extractors), default='global_peak',
+                        help="charge extraction algorithm (default: global_peak)")
+    events.add_argument('--timing', choices=sorted(estimators), default='parabolic',
+                        help="sub-sample peak_time estimator (default: parabolic)")
+    events.add_argument('--stats', action='store_true',
+                        help="store mean, RMS and percentile waveforms, needs ~150 MB of "
+                             "memory per asic of 256 samples")
+    events.add_argument('--common-mode', choices=methods, default=None,
+                        help="subtract the asic common mode estimated from quiet channels")
+    events.add_argument('--ped-slices', choices=['nearest', 'interpolate'], default=None,
+                        help="use the time slices of the pedestal databases")
+    events.add_argument('--no-masks', action='store_true',
+                        help="ignore dead channel and bad cell masks of the pedestal databases")
+    events.add_argument('--zero-suppress', type=float, default=None, metavar='THRESHOLD',
+                        help="only store waveforms with a calibrated amplitude above THRESHOLD")
+    events.add_argument('--previews', nargs='*', type=int, default=None, metavar='BLOCK_SIZE',
+                        help="store min/max/mean preview envelopes over blocks of events "
+                             "(default block sizes: 100 1000 10000)")
+    compare = subparsers.add_parser('compare-peds',
+                                    help="report pedestal drift between pedestal databases")
+    compare.add_argument('databases', nargs='+', help="pedestal databases, ex. ordered in time")
+    compare.add_argument('-r', '--reference', type=int, default=0,
+                         help="index of the reference database (default: 0)")
+    compare.add_argument('--n-sigma', type=float, default=5.,
+                         help="outlier cell threshold in units of the channel RMS (default: 5)")
+    compare.add_argument('--report', default=None, help="save per channel statistics as csv")
+    report = subparsers.add_parser('report', help="render charge, amplitude and position "
+                                                  "histograms of waveform databases")
+    report.add_argument('databases', nargs='+', help="waveform databases")
+    report.add_argument('-o', '--outdir', default=None,
+                        help="write each report to a subdirectory named after its database "
+                             "(default: <database>_report next to each database)")
+    report.add_argument('-m', '--modules', nargs='+', type=int, default=None,
+                        help="only render these modules (default: all)")
+    report.add_argument('--asics', nargs='+', type=int, default=None)
+    report.add_argument('--quantities', nargs='+', choices=quantities, default=quantities)
+    report.add_argument('--format', choices=formats, default='png',
+                        help="file format of the figures (default: png)")
+    report.add_argument('-j', '--jobs', type=int, default=None,
+                        help="number of worker processes (default: number of cpus)")
+    catalog = subparsers.add_parser('catalog', help="index and search produced databases")
+    catalog.add_argument('--scan', nargs='+', default=None, metavar='DIR',
+                         help="incrementally add the databases below these directories")
+    catalog.add_argument('--remove-missing', action='store_true',
+                         help="drop entries of databases that no longer exist")
+    catalog.add_argument('--runs', nargs='+', default=None,
+                         help="only databases containing these runs, ex. 322342-322350")
+    catalog.add_argument('-m', '--modules', nargs='+', type=int, default=None,
+                         help="only databases containing all of these modules")
+    catalog.add_argument('--kind', choices=['pedestal', 'waveform', 'multirun'], default=None)
+    catalog.add_argument('--ped-name', default=None,
+                         help="only databases calibrated with a matching pedestal database")
+    catalog.add_argument('--comments', default=None, help="only databases with matching comments")
+    catalog.add_argument('--path', default=None, help="only databases with a matching path")
+    catalog.add_argument('--catalog', default=None,
+                         help="catalog file (default: $SCT_TOOLKIT_CATALOG or "
+                              "~/.sct_toolkit/catalog.db)")
+    return parser
+
+def main(argv=None):
+    """ command line entry point """
+    parser = _build_parser()
+    args = parser.parse_args(argv)
+    if not args.command:
+        parser.print_help()
+        return 2
+    if args.command == 'compare-peds':
+        compare_pedestals(args.databases, reference=args.reference, n_sigma=args.n_sigma,
+                          report=args.report)
+        return 0
+    if args.command == 'catalog':
+        return _query_catalog(args)
+    if args.command == 'report':
+        for database in args.databases:
+            outdir = None
+            if args.outdir:
+                outdir = os.path.join(args.outdir,
+                                      os.path.splitext(os.path.basename(database))[0])
+            make_report(database, outdir=outdir, modules=args.modules, asics=args.asics,
+                        quantities=args.quantities, fmt=args.format, jobs=args.jobs)
+        return 0
+    if not os.path.isdir(args.outdir):
+        os.makedirs(args.outdir)
+    if args.log_dir and not os.path.isdir(args.log_dir):
+        os.makedirs(args.log_dir)
+
+    jobs = _make_jobs(args)
+    print('Processing {} runs with {} worker(s)'.format(len(jobs), args.jobs))
+    start = time.time()
+    results = []
+    if args.jobs > 1:
+        pool = multiprocessing.Pool(processes=args.jobs, maxtasksperchild=1)
+        try:
+            for res in pool.imap_unordered(_run_job, jobs):
+                print('run {}: {}'.format(res['run'], res['status']))
+                results.append(res)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for job in jobs:
+            res = _run_job(job)
+            print('run {}: {}'.format(res['run'], res['status']))
+            results.append(res)
+    _print_report(results, time.time()-start, report=args.report)
+    return 1 if any(res['status']=='failed' for res in results) else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,72 @@
+from __future__ import division, print_function, absolute_import
+import warnings
+import numpy as np
+
+methods = ['median', 'mean']
+
+def get_quiet_channels(cal_waveform, threshold=None, n_sigma=5.):
+    """
+    Flag channels without a pulse in each event of an asic
+
+    Parameters
+    ----------
+    cal_waveform : numpy.ndarray
+        pedestal subtracted waveforms of one asic, shape (n_events, n_channels, n_samples)
+    threshold : float (optional)
+        channels with a maximum sample above threshold (ADC counts) are not quiet. If
+        None, a channel is not quiet when its maximum exceeds the median maximum of the
+        asic's channels by more than n_sigma robust (MAD) standard deviations, at least
+        1 ADC count, of the channel maxima in that event (default: None)
+    n_sigma : float (optional)
+        see threshold (default: 5)
+
+    Returns
+    ----------
+    numpy.ndarray of bool, shape (n_events, n_channels)
+
+    """
+    peak = cal_waveform.max(axis=-1)
+    if threshold is not None:
+        return peak <= threshold
+    centre = np.median(peak, axis=1)[:,None]
+    spread = 1.4826*np.median(np.abs(peak-centre), axis=1)[:,None]
+    return peak <= centre+n_sigma*np.maximum(spread, 1.)
+
+def estimate_common_mode(cal_waveform, method='median', per_sample=False, threshold=None,
+                         n_sigma=5.):
+    """
+    Estimate the baseline shift shared by all channels of an asic in each event from
+    its quiet channels
+
+    Parameters
+    ----------
+    cal_waveform : numpy.ndarray
+        pedestal subtracted waveforms of one asic, shape (n_events, n_channels, n_samples)
+    method : str (optional)
+        'median' or 'mean' of the quiet channels (default: 'median')
+    per_sample : bool (optional)
+        if True, the common mode is estimated separately for every sample, otherwise
+        once per event from all samples of the quiet channels (default: False)
+    threshold : float (optional)
+        pulse threshold, see get_quiet_channels (default: None)
+    n_sigma : float (optional)
+        adaptive pulse threshold, see get_quiet_channels (default: 5)
+
+    Returns
+    ----------
+    numpy.ndarray of shape (n_events, n_samples) if per_sample, else (n_events,)
+
+    """
+    if method not in methods:
+        raise KeyError("unknown common mode method '{}', available: {}".format(
+                       method, ", ".join(methods)))
+    quiet = get_quiet_channels(cal_waveform, threshold=threshold, n_sigma=n_sigma)
+    masked = np.where(quiet[:,:,None], cal_waveform, np.nan)
+    if not per_sample:
+        masked = masked.reshape(len(masked), -1)
+    estimator = np.nanmedian if method == 'median' else np.nanmean
+    with warnings.catch_warnings():
+        #events without quiet channels give nan and are left uncorrected
+        warnings.simplefilter('ignore', RuntimeWarning)
+        common_mode = estimator(masked, axis=1)
+    return np.nan_to_num(common_mode)
@@ -0,0 +1,262 @@
+from __future__ import division, print_function, absolute_import
+import sys, os
+import datetime
+import warnings
+import h5py
+import numpy as np
+from .waveform import waveform
+from .handle_pool import handles
+
+class event_builder(object):
+    """ Class for building camera events from module TACK timestamps """
+    def __init__(self, database=None, tolerance=0, chunk_size=100000):
+        """
+        Initialize event builder class
+
+        Parameters
+        ----------
+        database : str, (optional)
+            If specified, loads an existing waveform database (default: None)
+        tolerance : int
+            Maximum TACK time difference between consecutive packets belonging
+            to the same camera event (default: 0)
+        chunk_size : int
+            Number of timestamps read per stream and merge step (default: 100000)
+
+        """
+        self.wf = None
+        self.events = None
+        self.tolerance = int(tolerance)
+        self.chunk_size = int(chunk_size)
+        if database:
+            self._load_database(database)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """ close the database when leaving a with block """
+        if self.wf is not None and isinstance(self.wf.database, h5py.File):
+            self.close_database()
+        return False
+
+    def _assign_groups(self, timestamps, streams, events):
+        """
+        group merged packets into camera events, return per event arrays
+        """
+        n_streams = len(self.streams)
+        new_event = np.ones(len(timestamps), dtype=bool)
+        new_event[1:] = np.diff(timestamps) > self.tolerance
+        group = np.cumsum(new_event)-1
+        n_groups = int(group[-1])+1
+        first = np.flatnonzero(new_event)
+
+        flat_index = group*n_streams+streams
+        n_packets = np.bincount(flat_index, minlength=n_groups*n_streams)
+        n_packets = n_packets.reshape(n_groups, n_streams)
+        event_index = np.full(n_groups*n_streams, -1, dtype=np.int64)
+        #assign in reverse so the first packet of a duplicate wins
+        event_index[flat_index[::-1]] = events[::-1]
+        event_index = event_index.reshape(n_groups, n_streams)
+
+        return {'timestamp': timestamps[first],
+                'event_index': event_index,
+                'n_packets': n_packets}
+
+    def _load_database(self, name):
+        """ load an existing waveform database """
+        self.wf = waveform(name)
+        self.run_number = self.wf.run_number
+        self.modules = list(self.wf.get_module_list())
+
+    def _merge_streams(self):
+        """
+        k-way merge of sorted timestamp streams, yields merged blocks of
+        (timestamp, stream, event) that are final with respect to all streams
+        """
+        n_streams = len(self.streams)
+        sizes = [len(ds) for ds in self.streams]
+        offsets = np.zeros(n_streams, dtype=np.int64)
+        last = np.full(n_streams, np.iinfo(np.int64).min, dtype=np.int64)
+        buffers = [np.zeros(0, dtype=np.int64) for i in range(n_streams)]
+        buffer_events = [np.zeros(0, dtype=np.int64) for i in range(n_streams)]
+        self.out_of_order = np.zeros(n_streams, dtype=np.int64)
+
+        while True:
+            #refill empty buffers with the next chunk of each stream
+            for i in range(n_streams):
+                if len(buffers[i])==0 and offsets[i] < sizes[i]:
+                    stop = min(offsets[i]+self.chunk_size, sizes[i])
+                    ts = np.asarray(self.streams[i][offsets[i]:stop], dtype=np.int64)
+                    prev = np.concatenate(([last[i]], ts[:-1]))
+                    unsorted = ts < prev
+                    if np.any(unsorted):
+                        self.out_of_order[i] += np.count_nonzero(unsorted)
+                        ts = np.maximum.accumulate(np.maximum(ts, last[i]))
+                    buffers[i] = ts
+                    buffer_events[i] = np.arange(offsets[i], stop, dtype=np.int64)
+                    last[i] = ts[-1]
+                    offsets[i] = stop
+
+            active = [i for i in range(n_streams) if len(buffers[i])]
+            if not active:
+                break
+
+            #everything up to the smallest buffered maximum is safe to emit
+            exhausted = [i for i in active if offsets[i]==sizes[i]]
+            pending = [i for i in active if i not in exhausted]
+            if pending:
+                frontier = min(buffers[i][-1] for i in pending)
+            else:
+                frontier = max(buffers[i][-1] for i in active)
+
+            ts_block, stream_block, event_block = [], [], []
+            for i in active:
+                n_take = np.searchsorted(buffers[i], frontier, side='right')
+                ts_block.append(buffers[i][:n_take])
+                stream_block.append(np.full(n_take, i, dtype=np.int64))
+                event_block.append(buffer_events[i][:n_take])
+                buffers[i] = buffers[i][n_take:]
+                buffer_events[i] = buffer_events[i][n_take:]
+
+            timestamps = np.concatenate(ts_block)
+            order = np.argsort(timestamps, kind='mergesort')
+            yield (timestamps[order], np.concatenate(stream_block)[order],
+                   np.concatenate(event_block)[order])
+
+    def _set_streams(self, asic, channel):
+        """ assign one timestamp dataset per module """
+        if asic is None:
+            asic = self.wf.get_asic_list()[0]
+        if channel is None:
+            channel = self.wf.get_channel_list()[0]
+        self.streams = []
+        for module in self.modules:
+            branch_name = 'Module{}/Asic{}/Channel{}/timestamp'.format(module, asic, channel)
+            dataset = self.wf.get_branch(branch_name)
+            if dataset is None:
+                raise KeyError("branch '{}' not found in database".format(branch_name))
+            self.streams.append(dataset)
+
+    def build_events(self, tolerance=None, asic=None, channel=None, verbose=True):
+        """
+        Merge the timestamp streams of all modules into camera events
+
+        Parameters
+        ----------
+        tolerance : int (optional)
+            Overrides the TACK time tolerance given at initialization (default: None)
+        asic : int (optional)
+            asic used as the timestamp reference of each module (default: first asic)
+        channel : int (optional)
+            channel used as the timestamp reference of each module (default: first channel)
+        verbose : bool
+            If True, print a summary of missing and duplicated packets (default: True)
+
+        Returns
+        ----------
+        dict of numpy.ndarray
+
+        """
+        if tolerance is not None:
+            self.tolerance = int(tolerance)
+        self._set_streams(asic, channel)
+
+        results = {'timestamp': [], 'event_index': [], 'n_packets': []}
+        carry = None
+        for block in self._merge_streams():
+            if carry is not None:
+                block = tuple(np.concatenate((c, b)) for c, b in zip(carry, block))
+            timestamps, streams, events = block
+            #hold back the trailing group, it may continue in the next block
+            gaps = np.flatnonzero(np.diff(timestamps) > self.tolerance)
+            if len(gaps)==0:
+                carry = block
+                continue
+            split = gaps[-1]+1
+            carry = (timestamps[split:], streams[split:], events[split:])
+            groups = self._assign_groups(timestamps[:split], streams[:split], events[:split])
+            for key in results:
+                results[key].append(groups[key])
+        if carry is not None and len(carry[0]):
+            groups = self._assign_groups(*carry)
+            for key in results:
+                results[key].append(groups[key])
+
+        n_streams = len(self.streams)
+        results['timestamp'].append(np.zeros(0, dtype=np.int64))
+        results['event_index'].append(np.zeros((0, n_streams), dtype=np.int64))
+        results['n_packets'].append(np.zeros((0, n_streams), dtype=np.int64))
+        self.events = dict((key, np.concatenate(val)) for key, val in results.items())
+        self.events['missing'] = self.events['n_packets']==0
+        self.events['duplicate'] = self.events['n_packets']>1
+        if verbose:
+            self.summary()
+        return self.events
+
+    def close_database(self):
+        """ Close currently loaded waveform database """
+        if self.wf is not None:
+            self.wf.close_database()
+        else:
+            warnings.warn("No database currently open!",stacklevel=2)
+
+    def get_complete_events(self):
+        """
+        Get camera events with exactly one packet from every module
+
+        Returns
+        ----------
+        numpy.ndarray
+
+        """
+        if self.events is None:
+            raise RuntimeError("No events built yet, call build_events first")
+        complete = np.all(self.events['n_packets']==1, axis=1)
+        return self.events['event_index'][complete]
+
+    def save_events(self, outname):
+        """
+        Save built camera events to a new hdf5 file
+
+        Parameters
+        ----------
+        outname : str
+            Full name and path of output file
+
+        """
+        if self.events is None:
+            raise RuntimeError("No events built yet, call build_events first")
+        handles.discard(outname)
+        with h5py.File(outname, "w", libver='latest') as outfile:
+            for key, val in self.events.items():
+                outfile.create_dataset(key, data=val)
+            outfile.attrs['name'] = str(outname)
+            outfile.attrs['date'] = str(datetime.datetime.today())
+            outfile.attrs['database'] = str(self.wf.get_database_name())
+            outfile.attrs['run'] = self.run_number
+            outfile.attrs['modules'] = self.modules
+            outfile.attrs['tolerance'] = self.tolerance
+            outfile.attrs['out_of_order'] = self.out_of_order
+            outfile.attrs['keys'] = "timestamp, event_index, n_packets, missing, duplicate"
+
+    def summary(self):
+        """
+        Print number of built camera events and missing/duplicated packets per module
+
+        Returns
+        ----------
+        list of tuples
+
+        """
+        if self.events is None:
+            raise RuntimeError("No events built yet, call build_events first")
+        missing = np.sum(self.events['missing'], axis=0)
+        duplicate = np.sum(np.maximum(self.events['n_packets']-1, 0), axis=0)
+        rows = list(zip(self.modules, missing, duplicate, self.out_of_order))
+        print("Built {} camera events from {} modules (tolerance: {})".format(
+              len(self.events['timestamp']), len(self.modules), self.tolerance))
+        for module, n_missing, n_duplicate, n_unsorted in rows:
+            print("Module {}: {} missing, {} duplicated, {} out of order".format(
+                  module, n_missing, n_duplicate, n_unsorted))
+        return rows
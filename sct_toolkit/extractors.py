@@ -0,0 +1,217 @@
+from __future__ import division, print_function, absolute_import
+import numpy as np
+
+extractors = {}
+
+def register_extractor(name):
+    """
+    Decorator adding a charge extractor to the registry
+
+    Extractors are called as extractor(cal_waveform, lower, upper, channels=None, **options)
+    with cal_waveform of shape (..., n_samples), ex. (n_events, n_samples) or
+    (n_events, n_channels, n_samples), and return the charge and the integer sample
+    anchoring the integration window, both of shape cal_waveform.shape[:-1].
+
+    Parameters
+    ----------
+    name : str
+        name used to select the extractor
+
+    Returns
+    ----------
+    callable
+
+    """
+    def decorator(func):
+        extractors[str(name)] = func
+        return func
+    return decorator
+
+def get_extractor(name):
+    """
+    Get a registered charge extractor
+
+    Parameters
+    ----------
+    name : str or callable
+        name of a registered extractor, or an extractor function
+
+    Returns
+    ----------
+    callable
+
+    """
+    if callable(name):
+        return name
+    if name not in extractors:
+        raise KeyError("unknown charge extractor '{}', available: {}".format(
+                       name, ", ".join(sorted(extractors))))
+    return extractors[name]
+
+def _integrate(cal_waveform, anchor, lower, upper):
+    """ sum samples [anchor-lower, anchor+upper), clipped to the readout window """
+    n_samples = cal_waveform.shape[-1]
+    #integrate the charge window as a difference of the cumulative sum
+    cumulative = np.zeros(cal_waveform.shape[:-1]+(n_samples+1,))
+    np.cumsum(cal_waveform, axis=-1, out=cumulative[...,1:])
+    start = np.clip(anchor-lower, 0, n_samples)
+    stop = np.clip(anchor+upper, 0, n_samples)
+    return (np.take_along_axis(cumulative, stop[...,None], axis=-1)-
+            np.take_along_axis(cumulative, start[...,None], axis=-1))[...,0]
+
+@register_extractor('global_peak')
+def global_peak(cal_waveform, lower, upper, channels=None):
+    """
+    Integrate a window around the maximum sample of each waveform
+
+    Parameters
+    ----------
+    cal_waveform : numpy.ndarray
+        pedestal subtracted waveforms, shape (..., n_samples)
+    lower : int
+        number of samples integrated before the peak
+    upper : int
+        number of samples integrated from the peak onwards
+    channels : list of ints (optional)
+        unused
+
+    Returns
+    ----------
+    charge, position : numpy.ndarray
+
+    """
+    position = np.argmax(cal_waveform, axis=-1)
+    return _integrate(cal_waveform, position, lower, upper), position
+
+@register_extractor('fixed_window')
+def fixed_window(cal_waveform, lower, upper, channels=None, start=None):
+    """
+    Integrate the same window of lower+upper samples for every waveform
+
+    Parameters
+    ----------
+    cal_waveform : numpy.ndarray
+        pedestal subtracted waveforms, shape (..., n_samples)
+    lower : int
+        number of samples integrated before the window center
+    upper : int
+        number of samples integrated from the window center onwards
+    channels : list of ints (optional)
+        unused
+    start : int (optional)
+        first sample of the window. If None, the window is centered in the
+        readout window (default: None)
+
+    Returns
+    ----------
+    charge, position : numpy.ndarray
+
+    """
+    n_samples = cal_waveform.shape[-1]
+    if start is None:
+        start = n_samples//2-lower
+    position = np.full(cal_waveform.shape[:-1], int(start)+lower, dtype=int)
+    return _integrate(cal_waveform, position, lower, upper), position
+
+@register_extractor('sliding_window')
+def sliding_window(cal_waveform, lower, upper, channels=None):
+    """
+    Integrate the window of lower+upper samples with the largest sum
+
+    Parameters
+    ----------
+    cal_waveform : numpy.ndarray
+        pedestal subtracted waveforms, shape (..., n_samples)
+    lower : int
+        the returned position is the window start plus lower
+    upper : int
+        the window has lower+upper samples
+    channels : list of ints (optional)
+        unused
+
+    Returns
+    ----------
+    charge, position : numpy.ndarray
+
+    """
+    n_samples = cal_waveform.shape[-1]
+    width = min(max(lower+upper, 1), n_samples)
+    cumulative = np.zeros(cal_waveform.shape[:-1]+(n_samples+1,))
+    np.cumsum(cal_waveform, axis=-1, out=cumulative[...,1:])
+    sums = cumulative[...,width:]-cumulative[...,:-width]
+    start = np.argmax(sums, axis=-1)
+    charge = np.take_along_axis(sums, start[...,None], axis=-1)[...,0]
+    return charge, start+lower
+
+@register_extractor('neighbour_peak')
+def neighbour_peak(cal_waveform, lower, upper, channels=None, local_weight=0.):
+    """
+    Integrate a window around the peak of the summed waveforms of neighbouring pixels
+
+    Neighbours are the adjacent channels of the same asic on its 4x4 pixel grid
+    (channel%4, channel//4). Channels without a read out neighbour fall back to
+    their own waveform.
+
+    Parameters
+    ----------
+    cal_waveform : numpy.ndarray
+        pedestal subtracted waveforms of one asic, shape (n_events, n_channels, n_samples)
+    lower : int
+        number of samples integrated before the peak
+    upper : int
+        number of samples integrated from the peak onwards
+    channels : list of ints
+        channel numbers along axis 1 of cal_waveform
+    local_weight : float (optional)
+        weight of the pixel's own waveform in the peak search (default: 0)
+
+    Returns
+    ----------
+    charge, position : numpy.ndarray
+
+    """
+    if channels is None or cal_waveform.ndim != 3:
+        raise ValueError("neighbour_peak requires waveforms of shape "
+                         "(n_events, n_channels, n_samples) and their channel numbers")
+    channels = np.asarray(channels)
+    col, row = channels%4, channels//4
+    adjacent = (np.abs(col[:,None]-col[None,:])+np.abs(row[:,None]-row[None,:])) == 1
+    weights = adjacent.astype(float)
+    weights[np.diag_indices(len(channels))] = np.where(adjacent.any(axis=1), local_weight, 1.)
+    neighbour_sum = np.einsum('ij,ejs->eis', weights, cal_waveform)
+    position = np.argmax(neighbour_sum, axis=-1)
+    return _integrate(cal_waveform, position, lower, upper), position
+
+@register_extractor('cfd')
+def cfd(cal_waveform, lower, upper, channels=None, fraction=0.5):
+    """
+    Integrate a window around the leading edge crossing of a constant fraction
+    of the peak amplitude
+
+    Parameters
+    ----------
+    cal_waveform : numpy.ndarray
+        pedestal subtracted waveforms, shape (..., n_samples)
+    lower : int
+        number of samples integrated before the crossing
+    upper : int
+        number of samples integrated from the crossing onwards
+    channels : list of ints (optional)
+        unused
+    fraction : float (optional)
+        fraction of the peak amplitude defining the crossing (default: 0.5)
+
+    Returns
+    ----------
+    charge, position : numpy.ndarray
+
+    """
+    n_samples = cal_waveform.shape[-1]
+    peak = np.argmax(cal_waveform, axis=-1)
+    threshold = fraction*np.take_along_axis(cal_waveform, peak[...,None], axis=-1)
+    samples = np.arange(n_samples)
+    below = (cal_waveform < threshold) & (samples <= peak[...,None])
+    #first sample at or above threshold after the last one below it, before the peak
+    last_below = np.max(np.where(below, samples, -1), axis=-1)
+    position = np.minimum(last_below+1, peak)
+    return _integrate(cal_waveform, position, lower, upper), position
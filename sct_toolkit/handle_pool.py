@@ -0,0 +1,182 @@
+from __future__ import division, print_function, absolute_import
+import os
+import atexit
+import threading
+import time
+from collections import OrderedDict
+import h5py
+
+#chunk cache of pooled read handles. Per channel datasets are read front to back in
+#event chunks, so fully read chunks are evicted first (w0=1), and 4 MB hold the ~128
+#sparse waveform chunks (32 kB) spanning a typical read, hashed into a prime number
+#of slots well above the number of cached chunks
+rdcc_defaults = {'rdcc_nbytes': 4*1024**2, 'rdcc_nslots': 10007, 'rdcc_w0': 1.}
+
+class handle_pool(object):
+    """ Process-wide pool of shared read-only h5py file handles """
+    def __init__(self, max_idle=None, idle_timeout=None):
+        """
+        Initialize handle pool
+
+        Handles are shared by every reader of the same file and reference counted.
+        Released handles stay open (idle) for reuse until idle_timeout expires or more
+        than max_idle handles are idle, least recently used first. An idle handle keeps
+        its file locked against writers in other processes until it is evicted.
+
+        Parameters
+        ----------
+        max_idle : int (optional)
+            Maximum number of idle handles, 0 closes handles on their last release. If
+            None, uses the SCT_TOOLKIT_POOL_SIZE environment variable or 8 (default: None)
+        idle_timeout : float (optional)
+            Seconds an idle handle is kept open. If None, uses the
+            SCT_TOOLKIT_POOL_TIMEOUT environment variable or 30 (default: None)
+
+        """
+        if max_idle is None:
+            max_idle = os.environ.get('SCT_TOOLKIT_POOL_SIZE', 8)
+        if idle_timeout is None:
+            idle_timeout = os.environ.get('SCT_TOOLKIT_POOL_TIMEOUT', 30)
+        self.max_idle = int(max_idle)
+        self.idle_timeout = float(idle_timeout)
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+        self._timer = None
+        self._pid = os.getpid()
+
+    def _check_process(self):
+        """ forget handles and timer inherited from the parent of a forked worker process """
+        if self._pid != os.getpid():
+            self._entries = OrderedDict()
+            self._lock = threading.RLock()
+            self._timer = None
+            self._pid = os.getpid()
+
+    def _close(self, path):
+        """ close and forget the handle of path """
+        entry = self._entries.pop(path)
+        if entry['handle']:
+            entry['handle'].close()
+
+    def _evict(self):
+        """ close expired idle handles and the least recently used ones beyond max_idle """
+        with self._lock:
+            now = time.time()
+            idle = []
+            for path, entry in list(self._entries.items()):
+                if entry['users'] > 0:
+                    continue
+                if now-entry['released'] >= self.idle_timeout:
+                    self._close(path)
+                else:
+                    idle.append(path)
+            while len(idle) > max(self.max_idle, 0):
+                self._close(idle.pop(0))
+            if idle and self._timer is None:
+                self._timer = threading.Timer(self.idle_timeout, self._expire)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def _expire(self):
+        """ timer callback evicting idle handles """
+        with self._lock:
+            self._timer = None
+            self._evict()
+
+    def acquire(self, filename):
+        """
+        Get a shared read-only handle of a database, opening it if needed
+
+        Parameters
+        ----------
+        filename : str
+            name and path of the hdf5 database
+
+        Returns
+        ----------
+        h5py.File, to be given back with release
+
+        """
+        path = os.path.abspath(str(filename))
+        stat = os.stat(path)
+        stat = (stat.st_size, stat.st_mtime)
+        self._check_process()
+        with self._lock:
+            entry = self._entries.get(path)
+            #closed by its user, or an idle handle of a file that was rewritten
+            if entry is not None and (not entry['handle'] or
+                                      (entry['users'] == 0 and entry['stat'] != stat)):
+                self._close(path)
+                entry = None
+            if entry is None:
+                #opened by the given name, which is what handle.filename reports
+                handle = h5py.File(str(filename), "r", libver='latest', **rdcc_defaults)
+                entry = {'handle': handle, 'users': 0, 'released': 0., 'stat': stat}
+                self._entries[path] = entry
+            entry['users'] += 1
+            self._entries.move_to_end(path)
+            return entry['handle']
+
+    def clear(self):
+        """ Close all idle handles """
+        with self._lock:
+            for path in [path for path, entry in self._entries.items() if entry['users'] == 0]:
+                self._close(path)
+
+    def discard(self, filename):
+        """
+        Close the idle handle of a database before it is opened for writing
+
+        Parameters
+        ----------
+        filename : str
+            name and path of the hdf5 database
+
+        """
+        path = os.path.abspath(str(filename))
+        self._check_process()
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is None:
+                return
+            if entry['users'] > 0 and entry['handle']:
+                raise IOError("database '{}' is open for reading ({} user(s)), close it "
+                              "before writing".format(path, entry['users']))
+            self._close(path)
+
+    def get_open_files(self):
+        """
+        Get pooled databases and their number of users, 0 for idle handles
+
+        Returns
+        ----------
+        dict of str: int
+
+        """
+        with self._lock:
+            return dict((path, entry['users']) for path, entry in self._entries.items())
+
+    def release(self, handle):
+        """
+        Give back a handle obtained with acquire. Handles that are not pooled, ex.
+        writable ones, are closed.
+
+        Parameters
+        ----------
+        handle : h5py.File
+
+        """
+        self._check_process()
+        with self._lock:
+            for path, entry in self._entries.items():
+                if entry['handle'] is handle:
+                    entry['users'] = max(entry['users']-1, 0)
+                    if entry['users'] == 0:
+                        entry['released'] = time.time()
+                        self._evict()
+                    return
+        if handle:
+            handle.close()
+
+handles = handle_pool()
+atexit.register(handles.clear)
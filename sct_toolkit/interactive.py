@@ -1,30 +1,200 @@
 from __future__ import division, print_function, absolute_import
 import sys, os
-import StringIO
-import urllib, base64
+import h5py
 import numpy as np
-import matplotlib.pyplot as plt
-from .pedestal import pedestal
+from .pedestal import pedestal, channel_flags, is_pedestal_database
 from .waveform import waveform
-from bokeh.plotting import figure, output_file, show, ColumnDataSource
-from bokeh.models import HoverTool, BasicTicker, LinearColorMapper, ColorBar
+from bokeh.plotting import figure, output_file, save, ColumnDataSource
+from bokeh.models import HoverTool, BasicTicker, LinearColorMapper, ColorBar, Slider, CustomJS
+from bokeh.layouts import column
 
 class interactive_heatmap(object):
-    def __init__(self, filename=None):
+    def __init__(self, filename=None, database=None, quantity='charge', outname=None,
+                 max_frames=100, show=True):
         """
         Class for creating interactive heatmaps
 
         Parameters
         ----------
         filename : str, (optional)
-            If specified, launches interactive heatmap in browser (default: None)
+            If specified, launches an existing interactive heatmap in browser (default: None)
+        database : str, (optional)
+            If specified, builds a camera heatmap from a waveform or pedestal database
+            (default: None)
+        quantity : str
+            Per pixel quantity to display, ex. 'charge', 'amplitude' or 'position' for
+            waveform databases. Pedestal databases always display 'pedestal' (default: 'charge')
+        outname : str (optional)
+            Name of the html output. If None, the name is derived from the database
+            name and quantity (default: None)
+        max_frames : int
+            Maximum number of event frames selectable with the slider. Events are
+            averaged in equal sized blocks to fit this number (default: 100)
+        show : bool
+            If True, launch heatmap in browser (default: True)
+
+        """
+        self.filename = filename
+        if database:
+            self.filename = self.make_heatmap(database, quantity=quantity,
+                                              outname=outname, max_frames=max_frames)
+        if show and self.filename:
+            self._show_heatmap()
+
+    def _aggregate_pedestal(self, database):
+        """
+        return mean pedestal of each pixel over its sampled, unmasked cells, shape
+        (n_pixels,) and (1, n_pixels). Dead channels and channels without usable cells
+        are NaN
+        """
+        with pedestal(database) as ped:
+            self.modules = list(ped.modules)
+            self.asics = list(ped.asics)
+            self.channels = list(ped.channels)
+            self.n_events = 0
+            frames = np.full((1, self._n_pixels()), np.nan, dtype=np.float32)
+            for pixel, (module, asic, channel) in enumerate(self._iter_pixels()):
+                if ped.get_channel_mask(module, asic, channel) & channel_flags['dead']:
+                    continue
+                values = ped.get_pedestal_waveform(module, asic, channel)
+                try:
+                    sampled = ped.get_cell_counts(module, asic, channel) > 0
+                except KeyError:
+                    #databases without cell counts store 0 for cells never sampled
+                    sampled = values != 0
+                sampled &= ped.get_cell_mask(module, asic, channel) == 0
+                if np.any(sampled):
+                    frames[0, pixel] = np.mean(values[sampled])
+        return frames[0], frames
+
+    def _aggregate_waveform(self, database, quantity, max_frames):
+        """ return run average (n_pixels,) and event block averages (n_frames, n_pixels) """
+        with waveform(database) as wf:
+            self.modules = wf.get_module_list()
+            self.asics = wf.get_asic_list()
+            self.channels = wf.get_channel_list()
+            self.n_events = int(wf.get_n_events())
+            n_frames = max(1, min(int(max_frames), self.n_events))
+            edges = np.linspace(0, self.n_events, n_frames+1).astype(int)
+            frames = np.zeros((n_frames, self._n_pixels()), dtype=np.float32)
+            dead = set(wf.get_dead_channels())
+            for pixel, (module, asic, channel) in enumerate(self._iter_pixels()):
+                if (int(module), int(asic), int(channel)) in dead:
+                    #dead channels are not stored, leave them blank
+                    frames[:, pixel] = np.nan
+                    continue
+                branch = wf.get_branch('Module{}/Asic{}/Channel{}/{}'.format(
+                                       module, asic, channel, quantity))
+                if branch is None:
+                    raise KeyError("quantity '{}' not found in database".format(quantity))
+                values = np.asarray(branch, dtype=np.float64)
+                frames[:, pixel] = np.add.reduceat(values, edges[:-1])/np.diff(edges)
+        average = np.average(frames, axis=0, weights=np.diff(edges))
+        return average, frames
+
+    def _iter_pixels(self):
+        """ iterate over (module, asic, channel) in pixel order """
+        for module in self.modules:
+            for asic in self.asics:
+                for channel in self.channels:
+                    yield module, asic, channel
+
+    def _n_pixels(self):
+        """ return total number of pixels """
+        return len(self.modules)*len(self.asics)*len(self.channels)
+
+    def _pixel_coordinates(self):
+        """
+        schematic camera coordinates: modules on a square grid of 8x8 pixels,
+        asics in 4x4 quadrants, channels row by row within each asic
+        """
+        n_cols = int(np.ceil(np.sqrt(len(self.modules))))
+        x = np.zeros(self._n_pixels())
+        y = np.zeros(self._n_pixels())
+        for pixel, (module, asic, channel) in enumerate(self._iter_pixels()):
+            mod_i = self.modules.index(module)
+            x[pixel] = (mod_i%n_cols)*9+(asic%2)*4+channel%4
+            y[pixel] = (mod_i//n_cols)*9+(asic//2)*4+channel//4
+        return x, y
+
+    def _show_heatmap(self):
+        """ launch heatmap in web browser """
+        if not os.path.isfile(self.filename):
+            raise IOError("file '{}' not found. Check name and/or path ".format(self.filename))
+        if sys.platform == 'darwin':
+            os.system('open {}'.format(self.filename))
+        else:
+            os.system('xdg-open {}'.format(self.filename))
+
+    def make_heatmap(self, database, quantity='charge', outname=None, max_frames=100):
+        """
+        Build an interactive camera heatmap from a waveform or pedestal database
+
+        Per pixel values are pre-aggregated into a compact (n_frames, n_pixels) array
+        so the html output stays small regardless of the number of events.
+
+        Parameters
+        ----------
+        database : str
+            Name and path of h5py waveform or pedestal database
+        quantity : str
+            Per pixel quantity to display for waveform databases (default: 'charge')
+        outname : str (optional)
+            Name of the html output (default: None)
+        max_frames : int
+            Maximum number of event frames selectable with the slider (default: 100)
+
+        Returns
+        ----------
+        str
 
         """
         try:
-            if sys.platform == 'darwin':
-                os.system('open {}'.format(filename))
-            else:
-                os.system('open-xdg {}'.format(filename))
+            with h5py.File(database, "r") as db:
+                is_pedestal = is_pedestal_database(db)
         except IOError:
-            raise IOError("file '{}' not found. Check name and/or path ".format(filename))
-        
+            raise IOError("file '{}' not found. Check name and/or path ".format(database))
+        if is_pedestal:
+            quantity = 'pedestal'
+            average, frames = self._aggregate_pedestal(database)
+        else:
+            average, frames = self._aggregate_waveform(database, quantity, max_frames)
+        average = np.round(average, decimals=2)
+        frames = np.round(frames.astype(np.float64), decimals=2)
+
+        if not outname:
+            outname = '{}_{}_heatmap.html'.format(os.path.splitext(database)[0], quantity)
+        x, y = self._pixel_coordinates()
+        labels = ['Mod{} ASIC{} Ch{}'.format(m, a, c) for m, a, c in self._iter_pixels()]
+        source = ColumnDataSource(data=dict(x=x, y=y, value=average,
+                                            pixel=labels))
+        low, high = np.nanpercentile(frames, [1, 99])
+        mapper = LinearColorMapper(palette='Viridis256', low=low, high=high)
+        hover = HoverTool(tooltips=[('pixel', '@pixel'), (quantity, '@value')])
+
+        output_file(outname, title='{} heatmap'.format(quantity))
+        plot = figure(title='{}: {}'.format(quantity.capitalize(), os.path.basename(database)),
+                      width=700, height=700, tools=[hover, 'pan', 'wheel_zoom', 'reset', 'save'],
+                      match_aspect=True, x_axis_location=None, y_axis_location=None)
+        plot.grid.visible = False
+        plot.rect(x='x', y='y', width=1, height=1, source=source,
+                  fill_color={'field': 'value', 'transform': mapper}, line_color=None)
+        color_bar = ColorBar(color_mapper=mapper, ticker=BasicTicker(), location=(0, 0))
+        plot.add_layout(color_bar, 'right')
+
+        if len(frames) > 1:
+            #frame 0 holds the run average, frames 1..n the event block averages
+            frame_list = [average.tolist()]+frames.tolist()
+            slider = Slider(start=0, end=len(frames), value=0, step=1,
+                            title='Event block (0: all {} events)'.format(self.n_events))
+            callback = CustomJS(args=dict(source=source, frames=frame_list, slider=slider),
+                                code="""
+                source.data['value'] = frames[slider.value];
+                source.change.emit();
+            """)
+            slider.js_on_change('value', callback)
+            save(column(plot, slider))
+        else:
+            save(plot)
+        print("Heatmap saved to {}".format(outname))
+        return outname
@@ -0,0 +1,170 @@
+from __future__ import division, print_function, absolute_import
+import os
+import datetime
+import warnings
+import h5py
+import numpy as np
+from .catalog import update_catalog
+from .branch_index import write_branch_index
+from .handle_pool import handles
+
+#metadata that has to agree for runs to be combined
+consistent_attributes = ['modules', 'asics', 'channels', 'waveform_length']
+
+def _get_keys(database):
+    """ per channel keys listed in the metadata of a waveform database """
+    return [key.strip() for key in str(database.attrs['keys']).split(',') if key.strip()]
+
+def _check_runs(databases):
+    """ raise ValueError if the metadata of the run databases is inconsistent """
+    first = databases[0]
+    for database in databases[1:]:
+        for attribute in consistent_attributes:
+            if not np.array_equal(np.asarray(first.attrs[attribute]),
+                                  np.asarray(database.attrs[attribute])):
+                raise ValueError("'{}' of {} ({}) differs from {} ({})".format(
+                                 attribute, database.filename, database.attrs[attribute],
+                                 first.filename, first.attrs[attribute]))
+        if bool(database.attrs.get('calibrate_on_read', False)):
+            warnings.warn("{} was written in calibrate-on-read mode, its cal_waveform "
+                          "is not combined".format(database.filename), stacklevel=3)
+
+def _virtual_layout(sources, shape, dtype):
+    """ concatenate (file name, dataset name, shape) sources along the first axis """
+    layout = h5py.VirtualLayout(shape=shape, dtype=dtype)
+    offset = 0
+    for filename, name, source_shape in sources:
+        if source_shape[0]:
+            layout[offset:offset+source_shape[0]] = h5py.VirtualSource(filename, name,
+                                                                       shape=source_shape)
+        offset += source_shape[0]
+    return layout
+
+def make_multirun_database(outname, filenames, keys=None, overwrite=False, catalog=None):
+    """
+    Create a database exposing several run databases as one, without copying data
+
+    Every per channel dataset of the new database is an HDF5 virtual dataset
+    concatenating the events of all runs in the given order. The root datasets 'run'
+    and 'run_event' hold the run number and the event number within its run of every
+    event, 'run_offsets' the first event of each run. The result is opened with
+    waveform(outname) like any other database. Zero-suppressed waveforms are combined
+    as well, only their event numbers are copied. The run databases have to stay at
+    their (absolute) location.
+
+    Parameters
+    ----------
+    outname : str
+        name and path of the new database
+    filenames : list of str
+        names and paths of the run databases, all with the same modules, asics,
+        channels and waveform_length
+    keys : list of str (optional)
+        per channel datasets to combine, must be present in every run. If None, all
+        keys common to the runs are combined (default: None)
+    overwrite : bool (optional)
+        if True, an existing database named outname is replaced (default: False)
+    catalog : run_catalog, str or False (optional)
+        run catalog updated with the new database, False to disable. If None, the
+        SCT_TOOLKIT_CATALOG environment variable or ~/.sct_toolkit/catalog.db is used
+        (default: None)
+
+    Returns
+    ----------
+    str, name of the new database
+
+    """
+    if os.path.isfile(outname) and not overwrite:
+        raise IOError("file '{}' already exists, use overwrite=True".format(outname))
+    filenames = [os.path.abspath(name) for name in filenames]
+    if not filenames:
+        raise ValueError("no run databases given")
+    databases = [h5py.File(name, "r", libver='latest') for name in filenames]
+    try:
+        _check_runs(databases)
+        common = [key for key in _get_keys(databases[0])
+                  if all(key in _get_keys(database) for database in databases[1:])]
+        if any(bool(database.attrs.get('calibrate_on_read', False)) for database in databases):
+            common = [key for key in common if key != 'cal_waveform']
+        if keys is None:
+            keys = common
+        missing = [key for key in keys if key not in common]
+        if missing:
+            raise KeyError("keys {} are not available in every run, available: {}".format(
+                           ", ".join(missing), ", ".join(common)))
+        first = databases[0]
+        dead = set()
+        for database in databases:
+            dead.update(tuple(int(value) for value in row)
+                        for row in database.attrs.get('dead_channels', []))
+        if dead:
+            warnings.warn("{} channel(s) dead in at least one run are not combined".format(
+                          len(dead)), stacklevel=2)
+        n_events = np.array([int(database.attrs['num_events']) for database in databases])
+        offsets = np.concatenate(([0], np.cumsum(n_events)))
+        n_samples = int(first.attrs['waveform_length'])
+
+        handles.discard(outname)
+        with h5py.File(outname, "w", libver='latest') as output:
+            for module in first.attrs['modules']:
+                for asic in first.attrs['asics']:
+                    for channel in first.attrs['channels']:
+                        if (int(module), int(asic), int(channel)) in dead:
+                            continue
+                        name = 'Module{}/Asic{}/Channel{}'.format(module, asic, channel)
+                        branches = [database[name] for database in databases]
+                        group = output.create_group(name)
+                        #a channel is sparse if any of its runs is zero-suppressed
+                        sparse = any('zs_index' in branch for branch in branches)
+                        if sparse:
+                            group.create_dataset('zs_index', data=np.concatenate([
+                                (branch['zs_index'][()] if 'zs_index' in branch else
+                                 np.arange(n_events[i]))+offsets[i]
+                                for i, branch in enumerate(branches)]).astype(int))
+                            group.attrs['zs_threshold'] = max(
+                                float(branch.attrs.get('zs_threshold', -np.inf))
+                                for branch in branches)
+                        for key in keys:
+                            datasets = [branch[key] for branch in branches]
+                            sources = [(filename, dataset.name, dataset.shape)
+                                       for filename, dataset in zip(filenames, datasets)]
+                            is_waveform = len(datasets[0].shape) == 2
+                            if sparse and is_waveform and datasets[0].shape[1] == n_samples:
+                                shape = (len(group['zs_index']), n_samples)
+                            else:
+                                shape = (int(offsets[-1]),)+datasets[0].shape[1:]
+                            layout = _virtual_layout(sources, shape, datasets[0].dtype)
+                            dataset = group.create_virtual_dataset(key, layout)
+                            if sparse and is_waveform:
+                                dataset.attrs['sparse'] = True
+
+            output.create_dataset('run', data=np.repeat(
+                [int(database.attrs['run']) for database in databases], n_events))
+            output.create_dataset('run_event', data=np.concatenate(
+                [np.arange(n) for n in n_events]).astype(int))
+            output.create_dataset('run_offsets', data=offsets)
+            for key in ('channels_per_packet', 'packet_size', 'ped_name', 'charge_interval',
+                        'charge_extractor', 'timing_estimator', 'common_mode'):
+                if key in first.attrs:
+                    output.attrs[key] = first.attrs[key]
+            for attribute in consistent_attributes:
+                output.attrs[attribute] = first.attrs[attribute]
+            output.attrs['name'] = str(outname)
+            output.attrs['date'] = str(datetime.datetime.today())
+            output.attrs['comments'] = "combined runs {}".format(
+                ", ".join(str(database.attrs['run']) for database in databases))
+            output.attrs['run'] = np.array([int(database.attrs['run']) for database in databases])
+            output.attrs['sources'] = np.array(filenames, dtype=h5py.string_dtype())
+            output.attrs['num_events'] = int(offsets[-1])
+            output.attrs['calibrate_on_read'] = False
+            output.attrs['structure'] = "Module#/Asic#/Channel#/'keys'"
+            output.attrs['keys'] = ", ".join(keys)
+            if dead:
+                output.attrs['dead_channels'] = np.array(sorted(dead), dtype=int).reshape(-1, 3)
+            write_branch_index(output)
+    finally:
+        for database in databases:
+            database.close()
+    update_catalog(outname, catalog)
+    print("Combined {} runs ({} events) into {}".format(len(filenames), int(offsets[-1]), outname))
+    return outname
@@ -4,6 +4,11 @@ import datetime
 import warnings
 import h5py
 import numpy as np
+from .pipeline import pipeline
+from .cache import find_run_file, get_cache
+from .catalog import update_catalog
+from .branch_index import list_branches, write_branch_index
+from .handle_pool import handles
 
 try:
     import target_io
@@ -11,76 +16,195 @@ try:
 except ImportError:
     pass
 
+try:
+    input = raw_input
+except NameError:
+    pass
+
+#bit flags of the cell and channel masks stored in pedestal databases
+cell_flags = {'unsampled': 1, 'noisy': 2, 'outlier': 4}
+channel_flags = {'dead': 1, 'hot': 2}
+mask_defaults = {'n_sigma': 5., 'min_count': 1, 'dead_rms': 0.5, 'hot_factor': 3.,
+                 'dead_fraction': 0.5}
+
+def is_pedestal_database(database):
+    """
+    Check whether an open hdf5 database is a pedestal database
+
+    Parameters
+    ----------
+    database : h5py.File
+        pedestal, waveform or multi-run database
+
+    Returns
+    ----------
+    bool
+
+    """
+    keys = [key.strip() for key in str(database.attrs.get('keys', '')).split(',')]
+    return 'estimator' in database.attrs or keys[0] == 'pedestal'
+
 class pedestal(object):
     """ Class for handling pedestal databases """
     def __init__(self, ped_database=None):
-	"""
+        """
         Initialize pedestal class
 
-	Parameters
-	----------
-	ped_database : str, (optional)
-	    If not 'None', loads an existing pedestal database to be used for
-	    pedestal subtraction, etc. (default: None)
+        Parameters
+        ----------
+        ped_database : str, (optional)
+            If not 'None', loads an existing pedestal database to be used for
+            pedestal subtraction, etc. (default: None)
 
-	"""
+        """
         self._generate_maps()
+        self.branch_index = None
         self.ped_database = ped_database
         if ped_database:
             self._load_database(ped_database)
 
-    def _add_branch(self, ped_waveform, module, asic, channel):
-        """ create new branch to hold pedestal waveforms """
-	branch_name = "Module{}/Asic{}/Channel{}".format(module ,asic, channel)
-	branch = self.ped_database.create_group(branch_name)
-	branch.create_dataset("pedestal", data=ped_waveform)
-
-    def _average_events(self, mod_i, module, asic, channel):
-        """ calculate average over all events in a given module, asic, and channel """
-        ped_array = np.zeros(512*32)
-        count_array = np.zeros(512*32)
-	for ievt in xrange(self.n_events):
-            if(ievt%1000==0):
-                sys.stdout.write('\r')
-                sys.stdout.write("[%-100s] %d%%" % ('='*int((ievt)*100.0/(self.n_events)),
-                                (ievt)*100.0/(self.n_events)))
-                sys.stdout.flush() 
-
-	    rawdata = self.reader.GetEventPacket(ievt,(4*mod_i+asic)\
-                      *16//self.channels_per_packet+channel//self.channels_per_packet)
-	    self.packet.Assign(rawdata, self.reader.GetPacketSize())
-	    block = int(self.packet.GetColumn()*8+self.packet.GetRow())
-	    phase = int(self.packet.GetBlockPhase())
-            wf = self.packet.GetWaveform(channel%self.channels_per_packet)
-	    samples = map(wf.GetADC, self.waveform)
-            cells = self._get_cell_ids(block, phase)
-	    if np.amin(samples)>100:   #reject events with data spikes
-		ped_array[cells]+=samples
-		count_array[cells]+=1
-            else:  #check cell-by-cell to reject data spike
-                for index, cell in enumerate(cells):
-                    if samples[index] > 100:
-                        ped_array[cell]+=samples[index]
-                        count_array[cell]+=1
-
-        pedestal = np.nan_to_num(ped_array/count_array)
-        ped_waveform = np.round(pedestal,decimals=2)
-        self._add_branch(ped_waveform, module, asic, channel)
-        sys.stdout.write('\n')
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """ close the database when leaving a with block """
+        if isinstance(self.ped_database, h5py.File):
+            self.close_database()
+        return False
+
+    def _accumulate_chunk(self, chunk):
+        """ add a chunk of events to the pedestal sums of its asic """
+        if (chunk['module'], chunk['asic']) != self.ped_asic:
+            print("Processing {} Events from Module {}, Asic {}".format(
+                   self.n_events, chunk['module'], chunk['asic']))
+            self._reset_accumulators(chunk['module'], chunk['asic'])
+        #storage cell occupancy of the first sample, all channels of an asic share it
+        self.block_occupancy += np.bincount(chunk['block'][:,0], minlength=512)
+        self.phase_occupancy += np.bincount(chunk['phase'][:,0], minlength=32)
+        #accumulate in readout order, one row of positions per channel
+        n_positions = self.ped_sum.shape[1]
+        first_position = self.block_position[chunk['block']]*32+chunk['phase']
+        positions = (first_position[:,:,None]+np.arange(self.n_samples)+
+                     np.arange(len(self.channels))[:,None]*n_positions)
+        accepted = chunk['waveform'] > 100   #reject cells with data spikes
+        self.ped_sum += np.bincount(positions[accepted], weights=chunk['waveform'][accepted],
+                                    minlength=self.ped_sum.size).reshape(self.ped_sum.shape)
+        self.ped_count += np.bincount(positions[accepted],
+                                      minlength=self.ped_count.size).reshape(self.ped_count.shape)
+        self.ped_sq += np.bincount(positions[accepted],
+                                   weights=chunk['waveform'][accepted].astype(float)**2,
+                                   minlength=self.ped_sq.size).reshape(self.ped_sq.shape)
+        if self.n_slices > 1:
+            self.timestamps[chunk['start']:chunk['stop']] = chunk['timestamp']
+            #offset positions by the time slice of their event
+            event_slice = self.event_slice[chunk['start']:chunk['stop']]
+            slice_positions = (positions+event_slice[:,None,None]*self.ped_sum.size)[accepted]
+            self.slice_sum += np.bincount(slice_positions, weights=chunk['waveform'][accepted],
+                                          minlength=self.slice_sum.size).reshape(
+                                          self.slice_sum.shape)
+            self.slice_count += np.bincount(slice_positions, minlength=self.slice_count.size
+                                            ).reshape(self.slice_count.shape)
+        if self.estimator == 'median':
+            #histograms are kept per cell, fold wrapped readout positions back
+            cells = positions[accepted]%n_positions
+            channel_index = positions[accepted]//n_positions
+            self._accumulate_histograms(channel_index*512*32+cells%(512*32),
+                                        chunk['waveform'][accepted])
+        self._print_progress(chunk['stop'])
+        if chunk['stop'] == self.n_events:
+            self._add_branches()
+            sys.stdout.write('\n')
+
+    def _accumulate_histograms(self, index, values):
+        """ add samples to the local histograms of their (channel, cell) flat index """
+        n_seed = self.seed_values.shape[-1]
+        center = self.hist_center.ravel()
+        seeding = center[index] < 0
+        if seeding.any():
+            #the first samples of each cell are buffered to center its histogram on their median
+            seed_index, seed_values = index[seeding], values[seeding]
+            order = np.argsort(seed_index, kind='mergesort')
+            seed_index, seed_values = seed_index[order], seed_values[order]
+            first = np.searchsorted(seed_index, seed_index)
+            slot = self.seed_fill.ravel()[seed_index]+np.arange(len(seed_index))-first
+            stored = slot < n_seed
+            self.seed_values.reshape(-1, n_seed)[seed_index[stored], slot[stored]] = \
+                seed_values[stored]
+            self.seed_fill.ravel()[:] += np.bincount(seed_index[stored], minlength=center.size)
+            self._seed_histograms(np.unique(seed_index[self.seed_fill.ravel()[seed_index]
+                                                       == n_seed]))
+            #samples beyond the seed buffer belong to cells centered just above
+            index = np.concatenate([index[~seeding], seed_index[~stored]])
+            values = np.concatenate([values[~seeding], seed_values[~stored]])
+        self._fill_histograms(index, values)
+        self._recenter_histograms(np.unique(index))
+
+    def _add_branches(self):
+        """ create new branches holding the pedestal waveforms of the current asic """
+        module, asic = self.ped_asic
+        asic_group = self.ped_database.require_group("Module{}/Asic{}".format(module, asic))
+        asic_group.create_dataset("block_occupancy", data=self.block_occupancy)
+        asic_group.create_dataset("phase_occupancy", data=self.phase_occupancy)
+        if self.estimator == 'median':
+            #cells with fewer samples than the seed buffer are centered now
+            self._seed_histograms(np.nonzero((self.seed_fill.ravel() > 0) &
+                                             (self.hist_center.ravel() < 0))[0])
+        pedestals, noise, counts = [], [], []
+        for index, channel in enumerate(self.channels):
+            count = self._positions_to_cells(self.ped_count[index])
+            with np.errstate(divide='ignore', invalid='ignore'):
+                pedestal = np.nan_to_num(self._positions_to_cells(self.ped_sum[index])/count)
+                mean_sq = np.nan_to_num(self._positions_to_cells(self.ped_sq[index])/count)
+            rms = np.sqrt(np.maximum(mean_sq-pedestal**2, 0.))
+            if self.estimator == 'median':
+                median, outside = self._get_histogram_median(index)
+                median = self._positions_to_cells(median)
+                outside = self._positions_to_cells(outside).astype(bool)
+                pedestal = np.where(outside, pedestal, median)
+                if outside.any():
+                    warnings.warn("Module {}, Asic {}, Channel {}: median of {} cells outside "
+                                  "the histogram window, using their mean".format(
+                                  module, asic, channel, int(outside.sum())), stacklevel=2)
+            ped_waveform = np.round(pedestal,decimals=2)
+            branch_name = "Module{}/Asic{}/Channel{}".format(module ,asic, channel)
+            branch = self.ped_database.create_group(branch_name)
+            branch.create_dataset("pedestal", data=ped_waveform)
+            branch.create_dataset("count", data=count.astype(np.int64))
+            branch.create_dataset("rms", data=np.round(rms, decimals=2))
+            pedestals.append(ped_waveform)
+            noise.append(rms)
+            counts.append(count)
+            if self.n_slices > 1:
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    slices = np.array([np.nan_to_num(self._positions_to_cells(ped_sum)/
+                                                     self._positions_to_cells(ped_count))
+                                       for ped_sum, ped_count in zip(self.slice_sum[:,index],
+                                                                     self.slice_count[:,index])])
+                #cells not sampled within a slice use the run pedestal
+                slices = np.where(slices == 0, pedestal, slices)
+                branch.create_dataset("pedestal_slices", data=np.round(slices, decimals=2))
+        self._write_masks(module, asic, *self._make_masks(np.array(pedestals), np.array(noise),
+                                                          np.array(counts)))
 
     def _calculate_pedestals(self):
-        """ iterate through modules, asics, and channels to calculate all pedestals """
-	for mod_i, module in enumerate(self.modules):
-	    for asic in self.asics:
-		for channel in self.channels:
-                    print("Processing {} Events from Module {}, Asic {}, Channel {}".format(
-                           self.n_events, module, asic, channel))
-                    self._average_events(mod_i, module, asic, channel)
+        """ iterate through modules and asics to accumulate all pedestals in chunks """
+        tasks = [(mod_i, module, asic, start, min(start+self.chunk_size, self.n_events))
+                 for mod_i, module in enumerate(self.modules)
+                 for asic in self.asics
+                 for start in range(0, self.n_events, self.chunk_size)]
+        self.ped_asic = None
+        if self.pipelined:
+            stages = pipeline(self._read_chunk, self._accumulate_chunk, depth=self.queue_depth)
+            stages.run(tasks)
+            print('\n'.join(stages.get_stats()))
+        else:
+            for task in tasks:
+                self._accumulate_chunk(self._read_chunk(task))
 
     def _check_type(self,data):
         """ check input type and map to integer(s) list """
-        if isinstance(data,list):
-            return map(int,data)
+        if isinstance(data,(list,tuple,range,np.ndarray)):
+            return list(map(int,data))
         elif isinstance(data,int):
             return [int(data)]
         else:
@@ -89,7 +213,7 @@ class pedestal(object):
     def _generate_maps(self):
         """ generates block and cell id mappings """
         block_id_map = [0]
-        for i in xrange(511):
+        for i in range(511):
             if block_id_map[-1]%2==0:
                 next_block = (block_id_map[-1]+3)%512
                 block_id_map.append(next_block)
@@ -97,32 +221,100 @@ class pedestal(object):
                 next_block = (block_id_map[-1]-1)%512
                 block_id_map.append(next_block)
 
-        cell_id_map = np.array([])
-        block_cells = np.arange(32)
-        for i in xrange(512):
-            cell_id_map = np.append(cell_id_map,block_id_map[i]*32+block_cells)
-
         self.block_id_map = block_id_map
-        self.cell_id_map = cell_id_map.astype(int)
+        self.block_position = np.argsort(block_id_map)
+        self.cell_id_map = (np.array(block_id_map)[:,None]*32+np.arange(32)).ravel()
 
     def _get_cell_ids(self, block, phase):
         """ 
         convert block to cell id, shift to account for phase, return cell ids   
         """
-        first_cell = self.block_id_map.index(int(block))*32
-        cells = np.arange(first_cell,first_cell+self.n_samples,1)+phase
-        shifted_cells = np.mod(cells,512*32)
-        return self.cell_id_map[shifted_cells]
+        first_position = self._get_first_position(block, phase)
+        positions = np.arange(first_position,first_position+self.n_samples,1)
+        shifted_positions = np.mod(positions,512*32)
+        return self.cell_id_map[shifted_positions]
+
+    def _get_first_position(self, block, phase):
+        """ return readout order position of the first sample """
+        return int(self.block_position[int(block)])*32+int(phase)
+
+    def _estimate_events(self, counts, n_events, min_hits, target):
+        """
+        number of events for a fraction target of cells to reach min_hits, assuming
+        Poisson hits at the per cell rates observed in this run
+        """
+        #cells never hit get half a hit to avoid infinite requirements
+        rate = np.maximum(counts, 0.5).ravel()/float(n_events)
+        def coverage(n):
+            expected = rate*n
+            term = np.exp(-expected)
+            below = np.zeros_like(expected)
+            for k in range(int(min_hits)):
+                below += term
+                term = term*expected/(k+1)
+            return np.mean(1-below)
+        low, high = 0, max(n_events, 1)
+        while coverage(high) < target:
+            low, high = high, high*2
+        while high-low > max(1, high//1000):
+            middle = (low+high)//2
+            if coverage(middle) < target:
+                low = middle
+            else:
+                high = middle
+        return int(high)
+
+    def _fill_histograms(self, index, values):
+        """ count samples in the histograms of their (channel, cell) flat index """
+        n_bins = self.hist_bins
+        size = self.hist_center.size
+        bins = values-self.hist_center.ravel()[index]+n_bins//2
+        inside = (bins >= 0) & (bins < n_bins)
+        self.hist_counts.ravel()[:] += np.bincount(index[inside]*n_bins+bins[inside],
+                                                   minlength=self.hist_counts.size)
+        self.hist_below.ravel()[:] += np.bincount(index[bins < 0], minlength=size)
+        self.hist_above.ravel()[:] += np.bincount(index[bins >= n_bins], minlength=size)
+
+    def _get_histogram_median(self, index):
+        """ return grouped data median of every position of a channel, and a flag for
+        positions whose median is not within the histogram window """
+        counts = self.hist_counts[index]
+        below, above = self.hist_below[index], self.hist_above[index]
+        total = below+counts.sum(axis=1)+above
+        half = total/2.
+        cumulative = below[:,None]+np.cumsum(counts, axis=1)
+        bin_index = np.argmax(cumulative >= half[:,None], axis=1)
+        outside = (total == 0) | (half <= below) | (half > cumulative[:,-1])
+        in_bin = np.take_along_axis(counts, bin_index[:,None], axis=1)[:,0]
+        before = np.take_along_axis(cumulative, bin_index[:,None], axis=1)[:,0]-in_bin
+        with np.errstate(divide='ignore', invalid='ignore'):
+            median = (self.hist_center[index]+bin_index-self.hist_bins//2-0.5+
+                      np.where(in_bin > 0, (half-before)/in_bin, 0.5))
+        return np.where(outside, 0., median), outside
+
+    def _get_packet_channels(self, mod_i, asic):
+        """ group channels by data packet, return list of (packet id, [(index, packet channel)]) """
+        packets = {}
+        for index, channel in enumerate(self.channels):
+            packet_id = (4*mod_i+asic)*16//self.channels_per_packet+channel//self.channels_per_packet
+            packets.setdefault(packet_id, []).append((index, channel%self.channels_per_packet))
+        return sorted(packets.items())
 
     def _get_pedestal(self, module, asic, channel):
         """ return pedestal array """
         ped_group = self.ped_database['Module{}/Asic{}/Channel{}'.format(module,asic,channel)]
         return np.array(ped_group['pedestal'])
 
-    def _load_database(self,name):
+    def _load_database(self, name, mode="r"):
         """ load an existing hdf5 pedestal database """
+        if mode != "r":
+            handles.discard(name)
         try:
-            self.ped_database = h5py.File(name,"r",libver='latest')
+            if mode == "r":
+                self.ped_database = handles.acquire(name)
+            else:
+                self.ped_database = h5py.File(name,mode,libver='latest')
+            self.branch_index = None
             self.n_samples = self.ped_database.attrs['waveform_length']
             self.modules = self.ped_database.attrs['modules']
             self.asics = self.ped_database.attrs['asics']
@@ -130,24 +322,181 @@ class pedestal(object):
         except IOError:
             raise IOError("file '{}' not found. Check name and/or path ".format(name))
 
+    def _make_masks(self, pedestals, noise, counts):
+        """
+        flag bad cells and dead or hot channels of an asic from (n_channels, n_cells)
+        arrays of cell pedestals, RMS and counts, return uint8 cell and channel masks
+        """
+        options = dict(mask_defaults, **self.mask_options)
+        n_sigma = options['n_sigma']
+        cell_mask = np.zeros(pedestals.shape, dtype=np.uint8)
+        sampled = counts >= max(options['min_count'], 1)
+        cell_mask[~sampled] |= cell_flags['unsampled']
+        masked_noise = np.where(counts > 1, noise, np.nan)
+        masked_ped = np.where(sampled, pedestals, np.nan)
+        with warnings.catch_warnings():
+            #channels without sampled cells give nan and are flagged dead below
+            warnings.simplefilter('ignore', RuntimeWarning)
+            noise_centre = np.nanmedian(masked_noise, axis=1)[:,None]
+            noise_spread = 1.4826*np.nanmedian(np.abs(masked_noise-noise_centre), axis=1)[:,None]
+            ped_centre = np.nanmedian(masked_ped, axis=1)[:,None]
+            ped_spread = 1.4826*np.nanmedian(np.abs(masked_ped-ped_centre), axis=1)[:,None]
+        with np.errstate(invalid='ignore'):
+            noisy = masked_noise > noise_centre+n_sigma*np.maximum(noise_spread, 0.5)
+            outlier = np.abs(masked_ped-ped_centre) > n_sigma*np.maximum(ped_spread, 1.)
+        cell_mask[noisy] |= cell_flags['noisy']
+        cell_mask[outlier] |= cell_flags['outlier']
+
+        channel_noise = np.nan_to_num(noise_centre[:,0])
+        channel_mask = np.zeros(len(pedestals), dtype=np.uint8)
+        #unsampled cells reflect the run length, not the health of the channel
+        n_sampled = sampled.sum(axis=1)
+        bad_fraction = (noisy | outlier).sum(axis=1)/np.maximum(n_sampled, 1)
+        dead = ((n_sampled == 0) | (channel_noise < options['dead_rms']) |
+                (bad_fraction > options['dead_fraction']))
+        channel_mask[dead] |= channel_flags['dead']
+        live = channel_noise[~dead]
+        if len(live):
+            channel_mask[channel_noise > options['hot_factor']*np.median(live)] |= \
+                channel_flags['hot']
+        return cell_mask, channel_mask
+
     def _new_database(self, name, check_overwrite):
         """ generates a new hdf5 database """
         if check_overwrite:
-	    if os.path.isfile(name):
-		print("The file '{}' already exists.".format(name))
-		answers = {"yes","no"}
-		choice = None
-		while True:
-		    choice = raw_input("Would you like to overwrite it? (yes/no) ").lower()
-		    if choice in answers:
-			break
-		    else:
-			print("Not an acceptable input, try again!")
-		if choice == 'no':
-		    raise SystemExit('exiting...')
+            if os.path.isfile(name):
+                print("The file '{}' already exists.".format(name))
+                if not sys.stdin.isatty():
+                    raise IOError("file '{}' exists and overwrite cannot be confirmed "
+                                  "non-interactively, use check_overwrite=False".format(name))
+                answers = {"yes","no"}
+                choice = None
+                while True:
+                    choice = input("Would you like to overwrite it? (yes/no) ").lower()
+                    if choice in answers:
+                        break
+                    else:
+                        print("Not an acceptable input, try again!")
+                if choice == 'no':
+                    raise SystemExit('exiting...')
 
+        if isinstance(self.ped_database, h5py.File):
+            handles.release(self.ped_database)
+        handles.discard(name)
         self.ped_database = h5py.File(name,"w",libver='latest')
 
+    def _positions_to_cells(self, position_array):
+        """ fold wrapped readout positions back and reorder them by cell id """
+        n_cells = 512*32
+        folded = np.array(position_array[:n_cells])
+        folded[:len(position_array)-n_cells] += position_array[n_cells:]
+        cell_array = np.zeros(n_cells)
+        cell_array[self.cell_id_map] = folded
+        return cell_array
+
+    def _print_progress(self, ievt):
+        """ print progress bar """
+        sys.stdout.write('\r')
+        sys.stdout.write("[%-100s] %d%%" % ('='*int((ievt)*100.0/(self.n_events)),
+                        (ievt)*100.0/(self.n_events)))
+        sys.stdout.flush()
+
+    def _read_chunk(self, task):
+        """ read and decode packets of all channels in an asic for a range of events """
+        mod_i, module, asic, start, stop = task
+        n_chunk = stop-start
+        n_channels = len(self.channels)
+        chunk = {'module': module, 'asic': asic, 'start': start, 'stop': stop,
+                 'block': np.zeros((n_chunk, n_channels), dtype=int),
+                 'phase': np.zeros((n_chunk, n_channels), dtype=int),
+                 'timestamp': np.zeros(n_chunk, dtype=np.int64),
+                 'waveform': np.zeros((n_chunk, n_channels, self.n_samples), dtype=int)}
+        packets = self._get_packet_channels(mod_i, asic)
+        for i, ievt in enumerate(range(start, stop)):
+            for packet_index, (packet_id, packet_channels) in enumerate(packets):
+                rawdata = self.reader.GetEventPacket(ievt, packet_id)
+                self.packet.Assign(rawdata, self.packet_size)
+                if packet_index == 0:
+                    chunk['timestamp'][i] = self.packet.GetTACKTime()
+                block = int(self.packet.GetColumn()*8+self.packet.GetRow())
+                phase = int(self.packet.GetBlockPhase())
+                for index, packet_channel in packet_channels:
+                    chunk['block'][i, index] = block
+                    chunk['phase'][i, index] = phase
+                    wf = self.packet.GetWaveform(packet_channel)
+                    samples = chunk['waveform'][i, index]
+                    for j in range(self.n_samples):
+                        samples[j] = wf.GetADC(j)
+        return chunk
+
+    def _recenter_histograms(self, index):
+        """ move histogram windows whose median drifted into their outer quarters """
+        n_bins = self.hist_bins
+        center = self.hist_center.ravel()
+        counts = self.hist_counts.reshape(-1, n_bins)
+        old = counts[index]
+        below, above = self.hist_below.ravel()[index], self.hist_above.ravel()[index]
+        half = (below+old.sum(axis=1)+above)/2.
+        cumulative = below[:,None]+np.cumsum(old, axis=1)
+        inside = (half > below) & (half <= cumulative[:,-1])
+        shift = np.argmax(cumulative >= half[:,None], axis=1)-n_bins//2
+        moved = inside & (np.abs(shift) >= max(n_bins//4, 1))
+        if not moved.any():
+            return
+        index, shift, old = index[moved], shift[moved], old[moved]
+        bins = np.arange(n_bins)
+        source = bins[None,:]+shift[:,None]
+        valid = (source >= 0) & (source < n_bins)
+        #counts shifted out of the window are kept as under/overflow
+        self.hist_below.ravel()[index] += np.sum(old*(bins[None,:] < shift[:,None]), axis=1)
+        self.hist_above.ravel()[index] += np.sum(old*(bins[None,:] >= n_bins+shift[:,None]),
+                                                 axis=1)
+        counts[index] = np.where(valid, np.take_along_axis(old, np.clip(source, 0, n_bins-1),
+                                                           axis=1), 0)
+        center[index] += shift
+
+    def _read_timestamps(self):
+        """ return TACK timestamp of every event, read from the first packet """
+        timestamps = np.zeros(self.n_events, dtype=np.int64)
+        for ievt in range(self.n_events):
+            rawdata = self.reader.GetEventPacket(ievt, 0)
+            self.packet.Assign(rawdata, self.packet_size)
+            timestamps[ievt] = self.packet.GetTACKTime()
+        return timestamps
+
+    def _reset_accumulators(self, module, asic):
+        """ start new pedestal sums for all channels of an asic """
+        n_positions = 512*32+self.n_samples+32
+        self.ped_sum = np.zeros((len(self.channels), n_positions))
+        self.ped_count = np.zeros((len(self.channels), n_positions))
+        self.ped_sq = np.zeros((len(self.channels), n_positions))
+        self.block_occupancy = np.zeros(512, dtype=np.int64)
+        self.phase_occupancy = np.zeros(32, dtype=np.int64)
+        if self.n_slices > 1:
+            self.slice_sum = np.zeros((self.n_slices,)+self.ped_sum.shape)
+            self.slice_count = np.zeros((self.n_slices,)+self.ped_sum.shape)
+        if self.estimator == 'median':
+            #local histograms of hist_bins ADC counts around a running center per cell
+            shape = (len(self.channels), 512*32)
+            self.hist_counts = np.zeros(shape+(self.hist_bins,), dtype=np.int32)
+            self.hist_center = np.full(shape, -1, dtype=int)
+            self.hist_below = np.zeros(shape, dtype=np.int64)
+            self.hist_above = np.zeros(shape, dtype=np.int64)
+            self.seed_values = np.full(shape+(5,), np.nan)
+            self.seed_fill = np.zeros(shape, dtype=int)
+        self.ped_asic = (module, asic)
+
+    def _seed_histograms(self, index):
+        """ center histograms on the median of their buffered samples, then add them """
+        if not len(index):
+            return
+        n_seed = self.seed_values.shape[-1]
+        seeds = self.seed_values.reshape(-1, n_seed)[index]
+        self.hist_center.ravel()[index] = np.round(np.nanmedian(seeds, axis=1)).astype(int)
+        filled = ~np.isnan(seeds)
+        self._fill_histograms(np.repeat(index, filled.sum(axis=1)), seeds[filled].astype(int))
+        self.seed_values.reshape(-1, n_seed)[index] = np.nan
+
     def _set_attributes(self):
         """ assign metadata attributes to database """
         self.ped_database.attrs['name'] = str(self.ped_database.filename)
@@ -163,37 +512,94 @@ class pedestal(object):
         self.ped_database.attrs['packet_size'] = self.packet_size
         self.ped_database.attrs['waveform_length'] = self.n_samples
         self.ped_database.attrs['num_events'] = self.n_events
-        self.ped_database.attrs['keys'] = "pedestal"
+        self.ped_database.attrs['keys'] = "pedestal, count, rms, cell_mask"
+        self.ped_database.attrs['estimator'] = self.estimator
+        self._set_mask_attributes()
+        if self.n_slices > 1:
+            self.ped_database.attrs['keys'] = "pedestal, count, rms, cell_mask, pedestal_slices"
+            self.ped_database.attrs['time_slices'] = self.n_slices
+            self.ped_database.attrs['slice_by'] = self.slice_by
+            self.ped_database.attrs['slice_edges'] = self.slice_edges
+            self.ped_database.attrs['slice_center_tack'] = (
+                np.bincount(self.event_slice, weights=self.timestamps.astype(float))/
+                np.bincount(self.event_slice, minlength=self.n_slices))
+            self.ped_database.attrs['slice_center_fraction'] = self.slice_center_fraction
         self.ped_database.attrs['structure'] = "Module#/Asic#/Channel#/'keys'"
+        write_branch_index(self.ped_database)
+
+    def _set_mask_attributes(self):
+        """ document mask flags and thresholds in the database metadata """
+        self.ped_database.attrs['cell_flags'] = ", ".join(
+            "{}={}".format(name, flag) for name, flag in sorted(cell_flags.items(), key=lambda f: f[1]))
+        self.ped_database.attrs['channel_flags'] = ", ".join(
+            "{}={}".format(name, flag) for name, flag in sorted(channel_flags.items(), key=lambda f: f[1]))
+        for key, value in dict(mask_defaults, **self.mask_options).items():
+            self.ped_database.attrs['mask_'+key] = value
+
+    def _set_mask_options(self, mask_options):
+        """ check and assign mask thresholds, unspecified ones use mask_defaults """
+        self.mask_options = dict(mask_options or {})
+        unknown = set(self.mask_options)-set(mask_defaults)
+        if unknown:
+            raise KeyError("unknown mask options {}, available: {}".format(
+                           ", ".join(sorted(unknown)), ", ".join(sorted(mask_defaults))))
+
+    def _set_time_slices(self):
+        """ assign each event to a time slice, by event number or TACK time window """
+        events = np.arange(self.n_events)
+        if self.slice_by == 'tack':
+            #TACK windows need the time range of the run before accumulating
+            self.timestamps = self._read_timestamps()
+            coordinate = self.timestamps.astype(float)
+        else:
+            #timestamps are only bookkeeping, they are collected while accumulating
+            self.timestamps = np.zeros(self.n_events, dtype=np.int64)
+            coordinate = events.astype(float)
+        self.slice_edges = np.linspace(coordinate.min(), coordinate.max()+1, self.n_slices+1)
+        self.event_slice = np.clip(np.searchsorted(self.slice_edges, coordinate, 'right')-1,
+                                   0, self.n_slices-1)
+        n_slice_events = np.bincount(self.event_slice, minlength=self.n_slices)
+        if np.any(n_slice_events == 0):
+            raise ValueError("{} of {} time slices contain no events, use fewer "
+                             "slices".format(int(np.sum(n_slice_events == 0)), self.n_slices))
+        self.slice_center_fraction = (np.bincount(self.event_slice, weights=events+0.5)/
+                                      n_slice_events/self.n_events)
 
     def _set_channels_per_packet(self):
         """ assign channels per packet  """
-	self.channels_per_packet = int((0.5*self.packet_size-10.)/(self.n_samples+1.))
+        self.channels_per_packet = int((0.5*self.packet_size-10.)/(self.n_samples+1.))
 
     def _set_data_packet_parameters(self):
         """ assigns data packet characteristics """
-	self.reader = target_io.EventFileReader(self.filename)
-	self.n_events = self.reader.GetNEvents()
-	rawdata = self.reader.GetEventPacket(0,0)
-	self.packet = target_driver.DataPacket()
-	self.packet_size = self.reader.GetPacketSize()
-	self.packet.Assign(rawdata, self.packet_size)
-	wf = self.packet.GetWaveform(0)
-	self.n_samples = wf.GetSamples()
+        self.reader = target_io.EventFileReader(self.filename)
+        self.n_events = self.reader.GetNEvents()
+        rawdata = self.reader.GetEventPacket(0,0)
+        self.packet = target_driver.DataPacket()
+        self.packet_size = self.reader.GetPacketSize()
+        self.packet.Assign(rawdata, self.packet_size)
+        wf = self.packet.GetWaveform(0)
+        self.n_samples = wf.GetSamples()
         self.waveform = np.arange(self.n_samples,dtype=int)
-	self._set_channels_per_packet()
+        self._set_channels_per_packet()
 
     def _set_run_file_path(self):
-        """ assigns file path for run number """
-	self.filename = "{}/target5and7data/run{}.fits".format(os.environ['HOME'],
-			 self.run_number)
-	if not os.path.isfile(self.filename):
-	    new_path = "{0}/target5and7data/runs_{1}0000_"\
-		       "through_{1}9999/".format(os.environ['HOME'],
-			str(self.run_number)[:-4])
-	    self.filename = new_path+"run{}.fits".format(self.run_number)
-	    if not os.path.isfile(self.filename):
-		raise IOError("File run{}.fits cannot be located".format(self.run_number))
+        """ assigns file path for run number, using the local run cache if enabled """
+        if self.cache is not None:
+            cached = self.cache.lookup(self.run_number)
+            if cached:
+                print("Using cached run file {}".format(cached))
+                self.filename = cached
+                return
+        #Check if remote data directory is mounted
+        if os.path.ismount(os.environ['HOME']+'/target5and7data')==True:
+            print("Output-directory is mounted")
+        else:
+            print("Cannot connect to the remote output directory!")
+            print("Make sure '{}/target5and7data' is mounted!".format(os.environ['HOME']))
+            raise SystemExit
+        self.filename = find_run_file(self.run_number)
+        if self.cache is not None:
+            self.filename = self.cache.stage(self.run_number, self.filename)
 
     def _set_run_parameters(self, run_number, modules, asics, channels, filepath, comments):
         """ assign parameters to be used for constructing pedestal database """
@@ -212,10 +618,20 @@ class pedestal(object):
             self._set_run_file_path()
         self.comments = str(comments)
 
+    def _write_masks(self, module, asic, cell_mask, channel_mask):
+        """ store the cell and channel masks of the channels of an asic """
+        for index, channel in enumerate(self.channels):
+            branch = self.ped_database["Module{}/Asic{}/Channel{}".format(module, asic, channel)]
+            if "cell_mask" in branch:
+                del branch["cell_mask"]
+            branch.create_dataset("cell_mask", data=cell_mask[index])
+            branch.attrs['channel_mask'] = int(channel_mask[index])
+
     def close_database(self):
-        """ close currently loaded/created pedestal database """
+        """ close currently loaded/created pedestal database, read-only handles return to the pool """
         if isinstance(self.ped_database, h5py.File):
-            self.ped_database.close()
+            handles.release(self.ped_database)
+            self.ped_database = None
         else:
             warnings.warn("No database currently open!",stacklevel=2)
 
@@ -267,7 +683,8 @@ class pedestal(object):
         else:
             warnings.warn("No database currently open!",stacklevel=2)
 
-    def get_branches(self, verbose=False, filter_by=None):
+    def get_branches(self, verbose=False, filter_by=None, modules=None, asics=None,
+                     channels=None, keys=None):
         """ 
         Get a list of branch names for each group/subgroup in database
 
@@ -278,6 +695,14 @@ class pedestal(object):
         filter_by : list(str), (optional)
             Filter branches matching the specified pattern(s), ex. single ["Module118/Asic10/"] 
             or mutltiple ["Module118","Channel10"] (default: None). Note: case sensitive
+        modules : list of ints (optional)
+            only branches of these modules (default: None)
+        asics : list of ints (optional)
+            only branches of these asics (default: None)
+        channels : list of ints (optional)
+            only branches of these channels (default: None)
+        keys : list of str (optional)
+            only datasets with these names, ex. ['charge', 'amplitude'] (default: None)
 
         Returns
         ----------
@@ -285,13 +710,14 @@ class pedestal(object):
 
         """
         if isinstance(self.ped_database, h5py.File):
-            branches = set()
-            self.ped_database.visit(branches.add)
-            if filter_by:
-                branches = [b for b in branches if all([f in b for f in set(filter_by)])]
+            if self.branch_index is None and 'branch_index' in self.ped_database:
+                self.branch_index = self.ped_database['branch_index'][()]
+            branches = list_branches(self.ped_database, filter_by=filter_by, modules=modules,
+                                     asics=asics, channels=channels, keys=keys,
+                                     index=self.branch_index)
             if verbose:
                 print('\n'.join(b for b in branches))
-            return map(str,branches)
+            return list(map(str,branches))
         else:
             warnings.warn("No database currently open!",stacklevel=2)
 
@@ -306,6 +732,136 @@ class pedestal(object):
         """
         return self.cell_id_map
 
+    def get_cell_counts(self, module, asic, channel):
+        """
+        Get the number of samples accumulated in every storage cell of a channel
+
+        Parameters
+        ----------
+        module : int
+            module number
+        asic : int
+            asic number
+        channel : int
+            channel number
+
+        Returns
+        ----------
+        numpy.ndarray
+
+        """
+        ped_group = self.ped_database['Module{}/Asic{}/Channel{}'.format(module,asic,channel)]
+        if 'count' not in ped_group:
+            raise KeyError("pedestal database has no cell counts, it was created by an older "
+                           "version")
+        return np.array(ped_group['count'])
+
+    def get_cell_mask(self, module, asic, channel):
+        """
+        Get the bad cell mask of a channel, 0 for good cells, else a combination of the
+        bit flags in pedestal.cell_flags ('unsampled': 1, 'noisy': 2, 'outlier': 4)
+
+        Parameters
+        ----------
+        module : int
+            module number
+        asic : int
+            asic number
+        channel : int
+            channel number
+
+        Returns
+        ----------
+        numpy.ndarray of uint8
+
+        """
+        ped_group = self.ped_database['Module{}/Asic{}/Channel{}'.format(module,asic,channel)]
+        if 'cell_mask' not in ped_group:
+            return np.zeros(ped_group['pedestal'].shape, dtype=np.uint8)
+        return np.array(ped_group['cell_mask'])
+
+    def get_channel_mask(self, module, asic, channel):
+        """
+        Get the status of a channel, 0 for good channels, else a combination of the
+        bit flags in pedestal.channel_flags ('dead': 1, 'hot': 2)
+
+        Parameters
+        ----------
+        module : int
+            module number
+        asic : int
+            asic number
+        channel : int
+            channel number
+
+        Returns
+        ----------
+        int
+
+        """
+        ped_group = self.ped_database['Module{}/Asic{}/Channel{}'.format(module,asic,channel)]
+        return int(ped_group.attrs.get('channel_mask', 0))
+
+    def get_coverage(self, min_hits=10, target=0.99, verbose=True):
+        """
+        Storage cell coverage report of every asic
+
+        Parameters
+        ----------
+        min_hits : int (optional)
+            number of samples a cell needs to be considered covered (default: 10)
+        target : float (optional)
+            target fraction of covered cells used to estimate the number of events a
+            calibration run needs (default: 0.99)
+        verbose : bool (optional)
+            if True, prints a one line summary per asic (default: True)
+
+        Returns
+        ----------
+        list of dicts, one per asic, with keys module, asic, n_events, mean_hits,
+        min_hits, cells_below (per channel), coverage (fraction of covered cells of all
+        channels), block_occupancy, phase_occupancy and events_needed
+
+        """
+        n_events = int(self.ped_database.attrs['num_events'])
+        report = []
+        for module in self.modules:
+            for asic in self.asics:
+                counts = np.array([self.get_cell_counts(module, asic, channel)
+                                   for channel in self.channels])
+                asic_group = self.ped_database['Module{}/Asic{}'.format(module, asic)]
+                entry = {'module': int(module), 'asic': int(asic), 'n_events': n_events,
+                         'mean_hits': float(counts.mean()), 'min_hits': int(counts.min()),
+                         'cells_below': np.sum(counts < min_hits, axis=1),
+                         'coverage': float(np.mean(counts >= min_hits)),
+                         'block_occupancy': np.array(asic_group['block_occupancy']),
+                         'phase_occupancy': np.array(asic_group['phase_occupancy']),
+                         'events_needed': self._estimate_events(counts, n_events, min_hits,
+                                                                target)}
+                report.append(entry)
+        if verbose:
+            print("{:>7} {:>4} {:>10} {:>9} {:>9} {:>14} {:>14}".format(
+                  'module', 'asic', 'mean hits', 'min hits', 'coverage',
+                  'cells < {}'.format(min_hits), 'events needed'))
+            for entry in report:
+                print("{:>7} {:>4} {:>10.1f} {:>9} {:>9.4f} {:>14} {:>14}".format(
+                      entry['module'], entry['asic'], entry['mean_hits'], entry['min_hits'],
+                      entry['coverage'], int(entry['cells_below'].sum()), entry['events_needed']))
+        return report
+
+    def get_dead_channels(self):
+        """
+        Get all channels flagged dead
+
+        Returns
+        ----------
+        list of (module, asic, channel) tuples
+
+        """
+        return [(int(module), int(asic), int(channel)) for module in self.modules
+                for asic in self.asics for channel in self.channels
+                if self.get_channel_mask(module, asic, channel) & channel_flags['dead']]
+
     def get_database(self):
         """ 
         Get currently loaded pedestal database 
@@ -357,16 +913,52 @@ class pedestal(object):
         
         """
         pedestal = self._get_pedestal(module, asic, channel)
-        if block and phase:
+        if block is not None and phase is not None:
             cells = self._get_cell_ids(block, phase)
             ped_values = pedestal[cells]
             return np.array(ped_values)
         else:
             return np.array(pedestal)
 
+    def make_masks(self, **mask_options):
+        """
+        Regenerate the cell and channel masks of the loaded pedestal database with new
+        thresholds, see the mask_options of make_pedestal_database
+
+        Parameters
+        ----------
+        mask_options : keyword arguments
+            n_sigma, min_count, dead_rms, hot_factor and/or dead_fraction
+
+        """
+        self._set_mask_options(mask_options)
+        name = self.get_database_name()
+        handles.release(self.ped_database)
+        self._load_database(name, mode="r+")
+        for module in self.modules:
+            for asic in self.asics:
+                arrays = []
+                for key in ('pedestal', 'rms', 'count'):
+                    try:
+                        arrays.append(np.array([np.array(self.ped_database[
+                            'Module{}/Asic{}/Channel{}/{}'.format(module, asic, channel, key)])
+                            for channel in self.channels]))
+                    except KeyError:
+                        raise KeyError("pedestal database has no '{}' datasets, it was "
+                                       "created by an older version".format(key))
+                self._write_masks(module, asic, *self._make_masks(*arrays))
+        self._set_mask_attributes()
+        write_branch_index(self.ped_database)
+        handles.release(self.ped_database)
+        self._load_database(name)
+
     def make_pedestal_database(self, ped_name, run_number, modules, 
                                asics=range(4),channels=range(16), filepath=None, 
-                               check_overwrite=True, comments=None):
+                               check_overwrite=True, comments=None,
+                               pipelined=False, chunk_size=1000, queue_depth=2,
+                               cache=None, prefetch_run=None, estimator='mean', median_bins=32,
+                               time_slices=1, slice_by='event', mask_options=None,
+                               catalog=None):
         """ 
         Create a new pedestal database 
 
@@ -389,22 +981,78 @@ class pedestal(object):
             if True, checks if ped_name exists before overwriting it (default: True)
         comments : str (optional)
             Comments to be added as metadata to database
+        pipelined : bool (optional)
+            if True, packets are read in a separate thread while the previous chunk
+            is accumulated. Per stage statistics are printed at the end (default: False)
+        chunk_size : int (optional)
+            number of events read and accumulated at once (default: 1000)
+        queue_depth : int (optional)
+            maximum number of chunks buffered between pipeline stages (default: 2)
+        cache : run_cache or str (optional)
+            local staging cache, or its directory, for run files located in target5and7data.
+            Cached runs do not require the remote directory to be mounted. If None, the
+            SCT_TOOLKIT_CACHE_DIR environment variable is used when set (default: None)
+        prefetch_run : int (optional)
+            run number to stage into the cache in the background, ex. the next run of a
+            batch (default: None)
+        estimator : str (optional)
+            'mean' of the accepted samples of each cell, or 'median', estimated from a
+            local histogram of median_bins ADC counts around a running center of each cell.
+            Cells whose median falls outside the histogram fall back to the mean
+            (default: 'mean')
+        median_bins : int (optional)
+            width, in ADC counts, of the per cell histograms of the median estimator.
+            Memory use is 4*median_bins bytes per cell and channel (default: 32)
+        time_slices : int (optional)
+            if larger than 1, mean pedestals are also accumulated separately for this
+            many consecutive slices of the run and stored as 'pedestal_slices' of shape
+            (time_slices, n_cells) to follow drifts, see the ped_slices option of
+            waveform.write_events. Cells not sampled within a slice use the run
+            pedestal (default: 1)
+        slice_by : str (optional)
+            'event' for slices with equal numbers of events, read in the single pass over
+            the run, or 'tack' for equal TACK time windows, which needs an extra pass to
+            read the time range of the run first (default: 'event')
+        mask_options : dict (optional)
+            thresholds of the bad cell and channel masks stored with the pedestals. Cells
+            with fewer than 'min_count' samples are unsampled, cells whose RMS or pedestal
+            deviates from the channel median by more than 'n_sigma' robust standard
+            deviations are noisy or outliers. Channels whose median cell RMS is below
+            'dead_rms' ADC counts or with more than a 'dead_fraction' of their sampled
+            cells noisy or outliers are dead,
+            channels with 'hot_factor' times the median RMS of the live channels of their
+            asic are hot (default: None, i.e. {'n_sigma': 5, 'min_count': 1, 'dead_rms': 0.5,
+            'hot_factor': 3, 'dead_fraction': 0.5})
+        catalog : run_catalog, str or False (optional)
+            run catalog updated with the new database, False to disable. If None, the
+            SCT_TOOLKIT_CATALOG environment variable or ~/.sct_toolkit/catalog.db is used
+            (default: None)
 
         """
-	#Check if remote data directory is mounted
-	if os.path.ismount(os.environ['HOME']+'/target5and7data')==True:
-	    print("Output-directory is mounted")
-	else:
-	    print("Cannot connect to the remote output directory!")
-	    print("Make sure '{}/target5and7data' is mounted!".format(os.environ['HOME']))
-	    raise SystemExit
-
+        if estimator not in ('mean', 'median'):
+            raise ValueError("estimator must be 'mean' or 'median', got '{}'".format(estimator))
+        if slice_by not in ('event', 'tack'):
+            raise ValueError("slice_by must be 'event' or 'tack', got '{}'".format(slice_by))
+        self.estimator = estimator
+        self.hist_bins = int(median_bins)
+        self.n_slices = max(int(time_slices), 1)
+        self.slice_by = slice_by
+        self._set_mask_options(mask_options)
+        self.cache = get_cache(cache)
         self._set_run_parameters(run_number, modules, asics=asics, channels=channels, 
                                  filepath=filepath, comments=comments)
+        if self.cache is not None and prefetch_run is not None:
+            self.cache.prefetch(prefetch_run)
+        self.pipelined = bool(pipelined)
+        self.chunk_size = int(chunk_size)
+        self.queue_depth = int(queue_depth)
         self._new_database(ped_name, check_overwrite)
         self._set_data_packet_parameters()
+        if self.n_slices > 1:
+            self._set_time_slices()
         self._calculate_pedestals()
         self._set_attributes()
         self.close_database()
+        update_catalog(ped_name, catalog)
         print("Database successfully created, saving to {}".format(ped_name))
 
@@ -0,0 +1,171 @@
+from __future__ import division, print_function, absolute_import
+import sys
+import time
+import threading
+import queue
+
+class _stage_stats(object):
+    """ Timing and queue depth statistics of a single pipeline stage """
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.busy = 0.
+        self.starved = 0.
+        self.blocked = 0.
+        self.depth_sum = 0
+        self.depth_max = 0
+
+    def record_depth(self, depth):
+        """ record depth of the output queue after a put """
+        self.depth_sum += depth
+        self.depth_max = max(self.depth_max, depth)
+
+    def summary(self):
+        """ return one line summary """
+        mean_depth = self.depth_sum/self.items if self.items else 0.
+        return "{:>8}: {:6d} chunks, busy {:8.2f} s, waiting for input {:8.2f} s, " \
+               "blocked on output {:8.2f} s, output queue depth mean {:.1f} max {}".format(
+               self.name, self.items, self.busy, self.starved, self.blocked,
+               mean_depth, self.depth_max)
+
+class pipeline(object):
+    """ Read/compute/write pipeline connected by bounded queues """
+    _done = object()
+
+    def __init__(self, reader, compute, writer=None, depth=2):
+        """
+        Initialize pipeline
+
+        The reader and writer run in their own threads while compute runs in the
+        calling thread, so disk/network latency is hidden behind computation.
+
+        Parameters
+        ----------
+        reader : callable
+            Called with each task, returns a chunk of data
+        compute : callable
+            Called with each chunk returned by reader, returns a processed chunk
+        writer : callable (optional)
+            Called with each processed chunk (default: None)
+        depth : int
+            Maximum number of chunks waiting between two stages (default: 2)
+
+        """
+        self.reader = reader
+        self.compute = compute
+        self.writer = writer
+        self.depth = int(depth)
+        self.stats = []
+        self._error = None
+
+    def _get(self, input_queue, stats):
+        """ get next item, account time spent waiting for it """
+        wait = time.time()
+        item = input_queue.get()
+        stats.starved += time.time()-wait
+        return item
+
+    def _put(self, output_queue, item, stats):
+        """ put item, account time spent blocked by a full queue """
+        wait = time.time()
+        output_queue.put(item)
+        stats.blocked += time.time()-wait
+        stats.record_depth(output_queue.qsize())
+
+    def _read(self, tasks, output_queue, stats):
+        """ reader thread """
+        try:
+            for task in tasks:
+                if self._error is not None:
+                    break
+                start = time.time()
+                chunk = self.reader(task)
+                stats.busy += time.time()-start
+                stats.items += 1
+                self._put(output_queue, chunk, stats)
+        except BaseException:
+            self._error = sys.exc_info()
+        finally:
+            self._put(output_queue, self._done, _stage_stats('done'))
+
+    def _write(self, input_queue, stats):
+        """ writer thread """
+        try:
+            while True:
+                chunk = self._get(input_queue, stats)
+                if chunk is self._done:
+                    break
+                if self._error is not None:
+                    continue
+                start = time.time()
+                self.writer(chunk)
+                stats.busy += time.time()-start
+                stats.items += 1
+        except BaseException:
+            self._error = sys.exc_info()
+            while input_queue.get() is not self._done:
+                pass
+
+    def get_stats(self):
+        """
+        Get per stage statistics of the last run
+
+        Returns
+        ----------
+        list of str
+
+        """
+        return [stats.summary() for stats in self.stats]
+
+    def run(self, tasks):
+        """
+        Process all tasks through the pipeline
+
+        Parameters
+        ----------
+        tasks : iterable
+            Tasks passed one by one to the reader
+
+        """
+        self._error = None
+        read_stats = _stage_stats('read')
+        compute_stats = _stage_stats('compute')
+        write_stats = _stage_stats('write')
+        self.stats = [read_stats, compute_stats]
+        read_queue = queue.Queue(maxsize=self.depth)
+        read_thread = threading.Thread(target=self._read, args=(tasks, read_queue, read_stats))
+        read_thread.daemon = True
+        read_thread.start()
+        if self.writer is not None:
+            self.stats.append(write_stats)
+            write_queue = queue.Queue(maxsize=self.depth)
+            write_thread = threading.Thread(target=self._write, args=(write_queue, write_stats))
+            write_thread.daemon = True
+            write_thread.start()
+
+        try:
+            while True:
+                chunk = self._get(read_queue, compute_stats)
+                if chunk is self._done:
+                    break
+                if self._error is not None:
+                    continue
+                start = time.time()
+                result = self.compute(chunk)
+                compute_stats.busy += time.time()-start
+                compute_stats.items += 1
+                if self.writer is not None:
+                    self._put(write_queue, result, compute_stats)
+        except BaseException:
+            self._error = sys.exc_info()
+            while read_queue.get() is not self._done:
+                pass
+        finally:
+            read_thread.join()
+            if self.writer is not None:
+                write_queue.put(self._done)
+                write_thread.join()
+
+        if self._error is not None:
+            exc_type, exc_value, exc_traceback = self._error
+            raise exc_value.with_traceback(exc_traceback)
@@ -12,7 +12,7 @@ def plot_charge(filename, module, asic, channel=None, bins=None):
     Parameters
     ----------
     filename : str
-	Name and path of h5py database
+        Name and path of h5py database
     module : int
         Module number
     asic : int
@@ -23,38 +23,44 @@ def plot_charge(filename, module, asic, channel=None, bins=None):
         Bins to use for histogram
 
     """
-    wf = waveform(filename)
-    if channel:
-        charge = np.array(wf.get_branch('Module{}/Asic{}/Channel{}/charge'.format(
-                                        module,asic,channel)))
-        if bins:
-            plt.hist(charge,bins=bins)
+    with waveform(filename) as wf:
+        if channel is not None:
+            charge = np.array(wf.get_branch('Module{}/Asic{}/Channel{}/charge'.format(
+                                            module,asic,channel)))
+            if bins is not None:
+                plt.hist(charge,bins=bins)
+            else:
+                min_bin = int(np.amin(charge))
+                max_bin = int(np.amax(charge))
+                plt.hist(charge,bins=np.arange(min_bin-5,max_bin+5,5))
+            plt.xlabel(r'Charge (ADC$\cdot$ns)')
+            plt.ylabel('Counts')
+            plt.title('Charge: Mod{}, ASIC{}, Ch{}'.format(
+                      module,asic,channel))
+            plt.minorticks_on()
         else:
-            min_bin = int(np.amin(charge))
-            max_bin = int(np.amax(charge))
-            plt.hist(charge,bins=np.arange(min_bin-5,max_bin+5,5))
-        plt.xlabel('Charge (ADC$\cdot$ns)')
-        plt.ylabel('Counts')
-        plt.title('Charge: Mod{}, ASIC{}, Ch{}'.format(
-                  module,asic,channel))
-        plt.minorticks_on()
-    else:
-        branch = wf.get_branch('Module{}/Asic{}'.format(module,asic))
-        f, axarr = plt.subplots(4, 4, figsize=(10,10))
-        for i in xrange(4):
-            for j in xrange(4):
-                index = int(i*4+j)
-                charge = np.array(branch['Channel{}/charge'.format(index)])
-		if bins:
-		    axarr[i, j].hist(charge,bins=bins)
-		else:
-                    min_bin = int(np.amin(charge))
-                    max_bin = int(np.amax(charge))		   
-		    axarr[i, j].hist(charge,bins=np.arange(min_bin-5,max_bin+5,5))
-                axarr[i, j].set_xlabel('Charge (ADC$\cdot$ns)')
-                axarr[i, j].set_ylabel('Counts')
-                axarr[i, j].set_title('Charge: Ch{}'.format(channel),fontsize=12)
-    wf.close_database()
+            branch = wf.get_branch('Module{}/Asic{}'.format(module,asic))
+            dead = set(wf.get_dead_channels())
+            f, axarr = plt.subplots(4, 4, figsize=(10,10))
+            for i in range(4):
+                for j in range(4):
+                    index = int(i*4+j)
+                    if 'Channel{}'.format(index) not in branch:
+                        #dead channels are not stored, leave their panel empty
+                        axarr[i, j].text(0.5, 0.5, 'dead' if (module,asic,index) in dead
+                                         else 'missing', ha='center', va='center',
+                                         transform=axarr[i, j].transAxes)
+                        continue
+                    charge = np.array(branch['Channel{}/charge'.format(index)])
+                    if bins is not None:
+                        axarr[i, j].hist(charge,bins=bins)
+                    else:
+                        min_bin = int(np.amin(charge))
+                        max_bin = int(np.amax(charge))
+                        axarr[i, j].hist(charge,bins=np.arange(min_bin-5,max_bin+5,5))
+                    axarr[i, j].set_xlabel(r'Charge (ADC$\cdot$ns)')
+                    axarr[i, j].set_ylabel('Counts')
+                    axarr[i, j].set_title('Charge: Ch{}'.format(index),fontsize=12)
 
 def plot_amplitude(filename, module, asic, channel=None, bins=None):
     """
@@ -63,7 +69,7 @@ def plot_amplitude(filename, module, asic, channel=None, bins=None):
     Parameters
     ----------
     filename : str
-	Name and path of h5py database
+        Name and path of h5py database
     module : int
         Module number
     asic : int
@@ -74,38 +80,44 @@ def plot_amplitude(filename, module, asic, channel=None, bins=None):
         Bins to use for histogram
 
     """
-    wf = waveform(filename)
-    if channel:
-        amp = np.array(wf.get_branch('Module{}/Asic{}/Channel{}/amplitude'.format(
-                                        module,asic,channel)))
-        if bins:
-            plt.hist(amp,bins=bins)
+    with waveform(filename) as wf:
+        if channel is not None:
+            amp = np.array(wf.get_branch('Module{}/Asic{}/Channel{}/amplitude'.format(
+                                            module,asic,channel)))
+            if bins is not None:
+                plt.hist(amp,bins=bins)
+            else:
+                min_bin = int(np.amin(amp))
+                max_bin = int(np.amax(amp))
+                plt.hist(amp,bins=np.arange(min_bin-5,max_bin+5,5))
+            plt.xlabel('Amplitde (ADC Counts)')
+            plt.ylabel('Counts')
+            plt.title('Amplitude: Mod{}, ASIC{}, Ch{}'.format(
+                      module,asic,channel))
+            plt.minorticks_on()
         else:
-            min_bin = int(np.amin(amp))
-            max_bin = int(np.amax(amp))
-            plt.hist(amp,bins=np.arange(min_bin-5,max_bin+5,5))
-        plt.xlabel('Amplitde (ADC Counts)')
-        plt.ylabel('Counts')
-        plt.title('Amplitude: Mod{}, ASIC{}, Ch{}'.format(
-                  module,asic,channel))
-        plt.minorticks_on()
-    else:
-        branch = wf.get_branch('Module{}/Asic{}'.format(module,asic))
-        f, axarr = plt.subplots(4, 4, figsize=(10,10))
-        for i in xrange(4):
-            for j in xrange(4):
-                index = int(i*4+j)
-                amp = np.array(branch['Channel{}/amplitude'.format(index)])
-		if bins:
-		    axarr[i, j].hist(amp,bins=bins)
-		else:
-                    min_bin = int(np.amin(amp))
-                    max_bin = int(np.amax(amp))		   
-		    axarr[i, j].hist(amp,bins=np.arange(min_bin-5,max_bin+5,5))
-                axarr[i, j].set_xlabel('Amplitude (ADC Counts)')
-                axarr[i, j].set_ylabel('Counts')
-                axarr[i, j].set_title('Amplitude: Ch{}'.format(channel),fontsize=12)
-    wf.close_database()
+            branch = wf.get_branch('Module{}/Asic{}'.format(module,asic))
+            dead = set(wf.get_dead_channels())
+            f, axarr = plt.subplots(4, 4, figsize=(10,10))
+            for i in range(4):
+                for j in range(4):
+                    index = int(i*4+j)
+                    if 'Channel{}'.format(index) not in branch:
+                        #dead channels are not stored, leave their panel empty
+                        axarr[i, j].text(0.5, 0.5, 'dead' if (module,asic,index) in dead
+                                         else 'missing', ha='center', va='center',
+                                         transform=axarr[i, j].transAxes)
+                        continue
+                    amp = np.array(branch['Channel{}/amplitude'.format(index)])
+                    if bins is not None:
+                        axarr[i, j].hist(amp,bins=bins)
+                    else:
+                        min_bin = int(np.amin(amp))
+                        max_bin = int(np.amax(amp))
+                        axarr[i, j].hist(amp,bins=np.arange(min_bin-5,max_bin+5,5))
+                    axarr[i, j].set_xlabel('Amplitude (ADC Counts)')
+                    axarr[i, j].set_ylabel('Counts')
+                    axarr[i, j].set_title('Amplitude: Ch{}'.format(index),fontsize=12)
 
 def plot_position(filename, module, asic, channel=None, bins=None):
     """
@@ -114,7 +126,7 @@ def plot_position(filename, module, asic, channel=None, bins=None):
     Parameters
     ----------
     filename : str
-	Name and path of h5py database
+        Name and path of h5py database
     module : int
         Module number
     asic : int
@@ -125,33 +137,39 @@ def plot_position(filename, module, asic, channel=None, bins=None):
         Bins to use for histogram
 
     """
-    wf = waveform(filename)
-    if channel:
-        pos = np.array(wf.get_branch('Module{}/Asic{}/Channel{}/position'.format(
-                                        module,asic,channel)))
-        if bins:
-            plt.hist(pos,bins=bins)
+    with waveform(filename) as wf:
+        if channel is not None:
+            pos = np.array(wf.get_branch('Module{}/Asic{}/Channel{}/position'.format(
+                                            module,asic,channel)))
+            if bins is not None:
+                plt.hist(pos,bins=bins)
+            else:
+                max_bin = wf.get_n_samples()
+                plt.hist(pos,bins=np.arange(max_bin))
+            plt.xlabel('Position (ns)')
+            plt.ylabel('Counts')
+            plt.title('Position: Mod{}, ASIC{}, Ch{}'.format(
+                      module,asic,channel))
+            plt.minorticks_on()
         else:
-            max_bin = wf.get_n_samples()
-            plt.hist(pos,bins=np.arange(max_bin))
-        plt.xlabel('Position (ns)')
-        plt.ylabel('Counts')
-        plt.title('Position: Mod{}, ASIC{}, Ch{}'.format(
-                  module,asic,channel))
-        plt.minorticks_on()
-    else:
-        branch = wf.get_branch('Module{}/Asic{}'.format(module,asic))
-        f, axarr = plt.subplots(4, 4, figsize=(10,10))
-        for i in xrange(4):
-            for j in xrange(4):
-                index = int(i*4+j)
-                pos = np.array(branch['Channel{}/position'.format(index)])
-		if bins:
-		    axarr[i, j].hist(pos,bins=bins)
-		else:
-                    max_bin = wf.get_n_samples()		   
-		    axarr[i, j].hist(pos,bins=np.arange(max_bin))
-                axarr[i, j].set_xlabel('Position (ns)')
-                axarr[i, j].set_ylabel('Counts')
-                axarr[i, j].set_title('Position: Ch{}'.format(channel),fontsize=12)
-    wf.close_database()
+            branch = wf.get_branch('Module{}/Asic{}'.format(module,asic))
+            dead = set(wf.get_dead_channels())
+            f, axarr = plt.subplots(4, 4, figsize=(10,10))
+            for i in range(4):
+                for j in range(4):
+                    index = int(i*4+j)
+                    if 'Channel{}'.format(index) not in branch:
+                        #dead channels are not stored, leave their panel empty
+                        axarr[i, j].text(0.5, 0.5, 'dead' if (module,asic,index) in dead
+                                         else 'missing', ha='center', va='center',
+                                         transform=axarr[i, j].transAxes)
+                        continue
+                    pos = np.array(branch['Channel{}/position'.format(index)])
+                    if bins is not None:
+                        axarr[i, j].hist(pos,bins=bins)
+                    else:
+                        max_bin = wf.get_n_samples()
+                        axarr[i, j].hist(pos,bins=np.arange(max_bin))
+                    axarr[i, j].set_xlabel('Position (ns)')
+                    axarr[i, j].set_ylabel('Counts')
+                    axarr[i, j].set_title('Position: Ch{}'.format(index),fontsize=12)
@@ -0,0 +1,182 @@
+from __future__ import division, print_function, absolute_import
+import os
+import time
+import warnings
+import multiprocessing
+import numpy as np
+from .waveform import waveform
+
+quantities = ['charge', 'amplitude', 'position']
+formats = ['png', 'pdf']
+
+#x axis labels of the report quantities
+labels = {'charge': r'Charge (ADC$\cdot$ns)', 'amplitude': 'Amplitude (ADC Counts)',
+          'position': 'Position (ns)'}
+
+def _get_bins(values, quantity, n_samples, bins):
+    """ histogram bins of a panel, same defaults as quick_plots """
+    if bins is not None and quantity in bins:
+        return np.asarray(bins[quantity])
+    if quantity == 'position':
+        return np.arange(n_samples)
+    values = values[np.isfinite(values)]
+    if not len(values):
+        return np.arange(2)
+    return np.arange(int(np.amin(values))-5, int(np.amax(values))+5, 5)
+
+def _read_asic(wf, module, asic, names):
+    """ read every requested dataset of the channels of an asic once, keyed by (name, channel) """
+    data = {}
+    for channel in wf._get_asic_channels(module, asic):
+        for name in names:
+            branch = wf.get_branch('Module{}/Asic{}/Channel{}/{}'.format(module, asic,
+                                                                         channel, name))
+            if branch is not None:
+                data[(name, int(channel))] = np.asarray(branch, dtype=np.float64)
+    return data
+
+def _render_asic(task):
+    """ render the report figures of one asic in a worker process, return summary dict """
+    #matplotlib is only loaded where figures are rendered, importing this module stays cheap
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    module, asic = task['module'], task['asic']
+    result = {'module': module, 'asic': asic, 'files': [], 'status': 'done',
+              'message': '', 'elapsed': 0.}
+    start = time.time()
+    try:
+        with waveform(task['filename']) as wf:
+            channels = [int(channel) for channel in wf.get_channel_list()]
+            dead = set(wf.get_dead_channels())
+            n_samples = int(wf.get_n_samples())
+            runs = ", ".join(str(run) for run in np.atleast_1d(wf.run_number))
+            data = _read_asic(wf, module, asic, task['quantities'])
+        n_rows = int(np.ceil(len(channels)/4.))
+        for quantity in task['quantities']:
+            if not any(name == quantity for name, channel in data):
+                continue
+            #figures are drawn on their own Agg canvas, no pyplot state is involved
+            height = 2.5*n_rows+1.
+            figure = Figure(figsize=(10, height))
+            FigureCanvasAgg(figure)
+            axes = figure.subplots(n_rows, 4, squeeze=False)
+            for index, channel in enumerate(channels):
+                ax = axes.flat[index]
+                ax.set_title('Ch{}'.format(channel), fontsize=10)
+                if (quantity, channel) in data:
+                    values = data[(quantity, channel)]
+                    counts, edges = np.histogram(values, bins=_get_bins(
+                                                 values, quantity, n_samples, task['bins']))
+                    ax.stairs(counts, edges, fill=True)
+                else:
+                    ax.text(0.5, 0.5, 'dead' if (module, asic, channel) in dead else 'missing',
+                            ha='center', va='center', transform=ax.transAxes)
+                ax.set_xlabel(labels[quantity], fontsize=8)
+                ax.tick_params(labelsize=7)
+                if index%4 == 0:
+                    ax.set_ylabel('Counts', fontsize=8)
+            for ax in axes.flat[len(channels):]:
+                ax.axis('off')
+            figure.suptitle('{}: run {}, Mod{}, ASIC{}'.format(quantity.capitalize(), runs,
+                                                               module, asic))
+            #fixed margins in inches for the title and the x axis labels of the last row
+            figure.subplots_adjust(left=0.07, right=0.98, bottom=0.6/height,
+                                   top=1.-0.8/height, hspace=0.6, wspace=0.35)
+            name = os.path.join(task['outdir'], 'Module{}_Asic{}_{}.{}'.format(
+                                module, asic, quantity, task['fmt']))
+            figure.savefig(name, dpi=task['dpi'])
+            result['files'].append(name)
+    except Exception as err:
+        result['status'] = 'failed'
+        result['message'] = str(err) or type(err).__name__
+    result['elapsed'] = time.time()-start
+    return result
+
+def make_report(filename, outdir=None, modules=None, asics=None, quantities=quantities,
+                fmt='png', jobs=None, bins=None, dpi=100, verbose=True):
+    """
+    Render the charge, amplitude and position distributions of the channels of every
+    module and asic of a waveform database as grids of histograms, one file per asic
+    and quantity, ex. Module100_Asic0_charge.png
+
+    Asics are rendered in parallel by a pool of worker processes using the
+    non-interactive Agg backend. Each dataset is read once per asic and shared by the
+    figures of all quantities.
+
+    Parameters
+    ----------
+    filename : str
+        name and path of the waveform database
+    outdir : str (optional)
+        directory of the report, created if needed. If None, '<database>_report' next to
+        the database is used (default: None)
+    modules : list of ints (optional)
+        modules to render, all modules of the database if None (default: None)
+    asics : list of ints (optional)
+        asics to render, all asics of the database if None (default: None)
+    quantities : list of str (optional)
+        any of 'charge', 'amplitude' and 'position' (default: all)
+    fmt : str (optional)
+        'png' or 'pdf' (default: 'png')
+    jobs : int (optional)
+        number of worker processes, the number of cpus if None (default: None)
+    bins : dict (optional)
+        histogram bins per quantity, ex. {'charge': np.arange(0, 2000, 10)}. Quantities
+        not given use the quick_plots defaults (default: None)
+    dpi : int (optional)
+        resolution of png files (default: 100)
+    verbose : bool (optional)
+        if True, prints the number of rendered figures and the elapsed time (default: True)
+
+    Returns
+    ----------
+    list of str, names of the written files
+
+    """
+    unknown = [quantity for quantity in quantities if quantity not in labels]
+    if unknown:
+        raise KeyError("unknown report quantities {}, available: {}".format(
+                       ", ".join(unknown), ", ".join(labels)))
+    if fmt not in formats:
+        raise KeyError("unknown report format '{}', available: {}".format(
+                       fmt, ", ".join(formats)))
+    start = time.time()
+    with waveform(filename) as wf:
+        available = (set(int(module) for module in wf.get_module_list()),
+                     set(int(asic) for asic in wf.get_asic_list()))
+    modules = sorted(available[0]) if modules is None else [int(module) for module in modules]
+    asics = sorted(available[1]) if asics is None else [int(asic) for asic in asics]
+    for name, selection, values in (('modules', modules, available[0]),
+                                    ('asics', asics, available[1])):
+        missing = [value for value in selection if value not in values]
+        if missing:
+            raise ValueError("{} {} not in database {}".format(
+                             name, ", ".join(str(value) for value in missing), filename))
+    if outdir is None:
+        outdir = os.path.splitext(filename)[0]+'_report'
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    tasks = [{'filename': os.path.abspath(filename), 'module': module, 'asic': asic,
+              'quantities': list(quantities), 'fmt': fmt, 'outdir': outdir, 'bins': bins,
+              'dpi': int(dpi)} for module in modules for asic in asics]
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+    jobs = max(min(int(jobs), len(tasks)), 1)
+    if jobs > 1:
+        pool = multiprocessing.Pool(processes=jobs)
+        try:
+            results = list(pool.imap_unordered(_render_asic, tasks))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_render_asic(task) for task in tasks]
+    for res in sorted(results, key=lambda r: (r['module'], r['asic'])):
+        if res['status'] == 'failed':
+            warnings.warn("Module{} Asic{} not rendered: {}".format(
+                          res['module'], res['asic'], res['message']), stacklevel=2)
+    files = sorted(name for res in results for name in res['files'])
+    if verbose:
+        print("Rendered {} figures of {} asics in {:.1f} s with {} worker(s), saved to "
+              "{}".format(len(files), len(tasks), time.time()-start, jobs, outdir))
+    return files
@@ -0,0 +1,353 @@
+from __future__ import division, print_function, absolute_import
+import numpy as np
+
+#histogram binning used for percentiles, integer values fall on bin centers
+raw_binning = {'low': -0.5, 'n_bins': 4096, 'bin_width': 1.}
+cal_binning = {'low': -1024.5, 'n_bins': 5120, 'bin_width': 1.}
+
+class waveform_stats(object):
+    """ Streaming per channel, per sample mean, RMS and percentiles of waveforms """
+    def __init__(self, n_channels, n_samples, percentiles=(5, 50, 95), low=-0.5,
+                 n_bins=4096, bin_width=1.):
+        """
+        Initialize accumulator
+
+        Mean and RMS are exact, updated with the pairwise (Chan et al.) combination of
+        chunk moments. Percentiles are the centers of the histogram bins holding them, so
+        they are accurate to half a bin width; values outside the histogram range are
+        clipped to its first or last bin. Bin counts are 32 bit, n_channels*n_samples*n_bins*4
+        bytes, ex. 64 MB for 16 channels of 256 samples with the default binning.
+
+        Parameters
+        ----------
+        n_channels : int
+            number of channels
+        n_samples : int
+            number of samples per waveform
+        percentiles : list of floats (optional)
+            percentiles to estimate, empty to disable the histogram (default: (5, 50, 95))
+        low : float (optional)
+            lower edge of the first histogram bin (default: -0.5)
+        n_bins : int (optional)
+            number of histogram bins (default: 4096)
+        bin_width : float (optional)
+            width of histogram bins (default: 1)
+
+        """
+        self.n_channels = int(n_channels)
+        self.n_samples = int(n_samples)
+        self.percentiles = [float(q) for q in percentiles]
+        self.low = float(low)
+        self.n_bins = int(n_bins)
+        self.bin_width = float(bin_width)
+        self.n = 0
+        self.mean = np.zeros((self.n_channels, self.n_samples))
+        self.m2 = np.zeros((self.n_channels, self.n_samples))
+        self.counts = None
+        if self.percentiles:
+            self.counts = np.zeros((self.n_channels, self.n_samples, self.n_bins), dtype=np.int32)
+
+    def add(self, waveforms):
+        """
+        Add a chunk of waveforms
+
+        Parameters
+        ----------
+        waveforms : numpy.ndarray
+            waveforms of shape (n_events, n_channels, n_samples)
+
+        """
+        waveforms = np.asarray(waveforms, dtype=float)
+        n_chunk = waveforms.shape[0]
+        if n_chunk == 0:
+            return
+        chunk_mean = waveforms.mean(axis=0)
+        chunk_m2 = ((waveforms-chunk_mean)**2).sum(axis=0)
+        n_total = self.n+n_chunk
+        delta = chunk_mean-self.mean
+        self.mean += delta*n_chunk/n_total
+        self.m2 += chunk_m2+delta**2*self.n*n_chunk/n_total
+        self.n = n_total
+        if self.counts is not None:
+            bins = np.clip(np.floor((waveforms-self.low)/self.bin_width).astype(np.int64),
+                           0, self.n_bins-1)
+            #count only the bins occupied by the chunk, waveforms span a narrow range of the
+            #histogram, then add them in place to that window of the counts
+            low, high = int(bins.min()), int(bins.max())+1
+            width = high-low
+            #flat (channel, sample, bin) index of every value within the window
+            offsets = np.arange(self.n_channels*self.n_samples).reshape(
+                      self.n_channels, self.n_samples)*width
+            window = np.bincount((bins-low+offsets).ravel(),
+                                 minlength=self.n_channels*self.n_samples*width)
+            self.counts[:, :, low:high] += window.reshape(self.n_channels, self.n_samples, width)
+
+    def get_mean(self):
+        """
+        Get mean waveform of each channel
+
+        Returns
+        ----------
+        numpy.ndarray of shape (n_channels, n_samples)
+
+        """
+        return self.mean.copy()
+
+    def get_percentiles(self):
+        """
+        Get percentile waveforms of each channel
+
+        Returns
+        ----------
+        numpy.ndarray of shape (n_channels, n_percentiles, n_samples)
+
+        """
+        result = np.full((self.n_channels, len(self.percentiles), self.n_samples), np.nan)
+        if self.counts is None or self.n == 0:
+            return result
+        cumulative = np.cumsum(self.counts, axis=-1)
+        for i, q in enumerate(self.percentiles):
+            #first bin holding the value of rank ceil(q*n/100), at least the first value
+            rank = max(int(np.ceil(q/100.*self.n)), 1)
+            index = np.argmax(cumulative >= rank, axis=-1)
+            result[:, i] = self.low+(index+0.5)*self.bin_width
+        return result
+
+    def get_rms(self):
+        """
+        Get RMS (standard deviation) waveform of each channel
+
+        Returns
+        ----------
+        numpy.ndarray of shape (n_channels, n_samples)
+
+        """
+        if self.n == 0:
+            return np.full(self.m2.shape, np.nan)
+        return np.sqrt(self.m2/self.n)
+
+    def merge(self, other):
+        """
+        Merge the statistics of another accumulator with the same shape and binning
+
+        Parameters
+        ----------
+        other : waveform_stats
+            accumulator to merge
+
+        """
+        if other.n == 0:
+            return
+        n_total = self.n+other.n
+        delta = other.mean-self.mean
+        self.mean += delta*other.n/n_total
+        self.m2 += other.m2+delta**2*self.n*other.n/n_total
+        self.n = n_total
+        if self.counts is not None and other.counts is not None:
+            self.counts += other.counts
+
+class block_envelopes(object):
+    """ Streaming per channel, per sample minimum, maximum and mean waveforms of event blocks """
+    def __init__(self, block_size, n_events):
+        """
+        Initialize accumulator
+
+        Events are grouped into consecutive blocks of block_size events, the last block
+        holds the remaining events. Chunks have to be added in event order, a block
+        spanning several chunks is returned with the chunk completing it.
+
+        Parameters
+        ----------
+        block_size : int
+            number of events per block
+        n_events : int
+            total number of events
+
+        """
+        self.block_size = int(block_size)
+        self.n_events = int(n_events)
+        self.carry = None
+
+    def add(self, waveforms, start):
+        """
+        Add a chunk of consecutive events
+
+        Parameters
+        ----------
+        waveforms : numpy.ndarray
+            waveforms of shape (n_events, n_channels, n_samples)
+        start : int
+            event number of the first waveform
+
+        Returns
+        ----------
+        tuple of the index of the first completed block and the minimum, maximum and mean
+        of the completed blocks, arrays of shape (n_blocks, n_channels, n_samples)
+
+        """
+        waveforms = np.asarray(waveforms, dtype=float)
+        n_chunk = waveforms.shape[0]
+        first = start//self.block_size
+        if n_chunk == 0:
+            return first, waveforms[:0], waveforms[:0], waveforms[:0]
+        #chunk positions where a new block starts
+        edges = np.unique(np.concatenate(([0], np.arange((-start)%self.block_size, n_chunk,
+                                                         self.block_size))))
+        minimum = np.minimum.reduceat(waveforms, edges, axis=0)
+        maximum = np.maximum.reduceat(waveforms, edges, axis=0)
+        total = np.add.reduceat(waveforms, edges, axis=0)
+        count = np.diff(np.append(edges, n_chunk)).astype(float)
+        if self.carry is not None and self.carry[0] == first:
+            minimum[0] = np.minimum(minimum[0], self.carry[1])
+            maximum[0] = np.maximum(maximum[0], self.carry[2])
+            total[0] += self.carry[3]
+            count[0] += self.carry[4]
+        self.carry = None
+        stop = start+n_chunk
+        if stop%self.block_size and stop < self.n_events:
+            #the last block continues in the next chunk
+            self.carry = (first+len(edges)-1, minimum[-1], maximum[-1], total[-1], count[-1])
+            minimum, maximum, total, count = minimum[:-1], maximum[:-1], total[:-1], count[:-1]
+        return first, minimum, maximum, total/count[:,None,None]
+
+class covariance_stats(object):
+    """ Streaming mean and covariance matrix of vector observations """
+    def __init__(self, n_variables):
+        """
+        Initialize accumulator
+
+        The co-moment matrix is updated with the pairwise (Chan et al.) combination of
+        chunk co-moments, which stays accurate for large offsets and many observations.
+        Observations can be masked per variable, the covariance of each pair of variables
+        then uses the observations in which both are valid (pairwise complete).
+
+        Parameters
+        ----------
+        n_variables : int
+            number of variables, ex. pixels
+
+        """
+        self.n_variables = int(n_variables)
+        self.n = 0
+        #per pair (i, j): number of common observations, mean of variable i over them
+        self.counts = np.zeros((self.n_variables, self.n_variables))
+        self.pair_mean = np.zeros((self.n_variables, self.n_variables))
+        self.comoment = np.zeros((self.n_variables, self.n_variables))
+
+    def _combine(self, counts, pair_mean, comoment):
+        """ combine the pair statistics of a chunk or another accumulator """
+        n_total = self.counts+counts
+        with np.errstate(divide='ignore', invalid='ignore'):
+            weight = np.where(n_total > 0, counts/n_total, 0.)
+        delta = pair_mean-self.pair_mean
+        self.comoment += comoment+delta*delta.T*self.counts*weight
+        self.pair_mean += delta*weight
+        self.counts = n_total
+
+    def add(self, observations, valid=None):
+        """
+        Add a chunk of observations
+
+        Parameters
+        ----------
+        observations : numpy.ndarray
+            observations of shape (n_observations, n_variables)
+        valid : numpy.ndarray of bool (optional)
+            usable values, same shape as observations. If None, all values are used
+            (default: None)
+
+        """
+        observations = np.asarray(observations, dtype=float)
+        n_chunk = observations.shape[0]
+        if n_chunk == 0:
+            return
+        shape = (self.n_variables, self.n_variables)
+        if valid is None:
+            chunk_mean = observations.mean(axis=0)
+            centered = observations-chunk_mean
+            counts = np.full(shape, float(n_chunk))
+            pair_mean = np.broadcast_to(chunk_mean[:,None], shape)
+            comoment = np.dot(centered.T, centered)
+        else:
+            weights = np.asarray(valid, dtype=bool).astype(float)
+            #shift by the mean of the valid values so the sums below do not cancel
+            shift = np.where(weights > 0, observations, 0.).sum(axis=0)/np.maximum(
+                    weights.sum(axis=0), 1)
+            values = np.where(weights > 0, observations-shift, 0.)
+            counts = np.dot(weights.T, weights)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                #mean of variable i over the observations where i and j are valid
+                shifted_mean = np.where(counts > 0, np.dot(values.T, weights)/counts, 0.)
+            comoment = np.dot(values.T, values)-counts*shifted_mean*shifted_mean.T
+            pair_mean = shifted_mean+shift[:,None]
+        self._combine(counts, pair_mean, comoment)
+        self.n += n_chunk
+
+    def get_correlation(self):
+        """
+        Get correlation coefficient matrix, nan for constant variables
+
+        Returns
+        ----------
+        numpy.ndarray of shape (n_variables, n_variables)
+
+        """
+        covariance = self.get_covariance()
+        std = np.sqrt(np.diag(covariance))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return covariance/np.outer(std, std)
+
+    def get_counts(self):
+        """
+        Get number of observations used for each pair of variables, the diagonal holds
+        the number of valid observations of each variable
+
+        Returns
+        ----------
+        numpy.ndarray of shape (n_variables, n_variables)
+
+        """
+        return self.counts.astype(np.int64)
+
+    def get_covariance(self, ddof=1):
+        """
+        Get covariance matrix, nan for pairs with no more than ddof common observations
+
+        Parameters
+        ----------
+        ddof : int (optional)
+            delta degrees of freedom, the normalization is n-ddof (default: 1)
+
+        Returns
+        ----------
+        numpy.ndarray of shape (n_variables, n_variables)
+
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(self.counts-ddof > 0, self.comoment/(self.counts-ddof), np.nan)
+
+    def get_mean(self):
+        """
+        Get mean of each variable over its valid observations, nan if there are none
+
+        Returns
+        ----------
+        numpy.ndarray of shape (n_variables,)
+
+        """
+        return np.where(np.diag(self.counts) > 0, np.diag(self.pair_mean), np.nan)
+
+    def merge(self, other):
+        """
+        Merge the statistics of another accumulator with the same number of variables
+
+        Parameters
+        ----------
+        other : covariance_stats
+            accumulator to merge
+
+        """
+        if other.n == 0:
+            return
+        self._combine(other.counts, other.pair_mean, other.comoment)
+        self.n += other.n
@@ -0,0 +1,144 @@
+from __future__ import division, print_function, absolute_import
+import numpy as np
+
+estimators = {}
+
+def register_estimator(name):
+    """
+    Decorator adding a pulse timing estimator to the registry
+
+    Estimators are called as estimator(cal_waveform, **options) with cal_waveform of
+    shape (..., n_samples) and return the pulse time in units of samples as a float
+    array of shape cal_waveform.shape[:-1].
+
+    Parameters
+    ----------
+    name : str
+        name used to select the estimator
+
+    Returns
+    ----------
+    callable
+
+    """
+    def decorator(func):
+        estimators[str(name)] = func
+        return func
+    return decorator
+
+def get_estimator(name):
+    """
+    Get a registered pulse timing estimator
+
+    Parameters
+    ----------
+    name : str or callable
+        name of a registered estimator, or an estimator function
+
+    Returns
+    ----------
+    callable
+
+    """
+    if callable(name):
+        return name
+    if name not in estimators:
+        raise KeyError("unknown timing estimator '{}', available: {}".format(
+                       name, ", ".join(sorted(estimators))))
+    return estimators[name]
+
+def _neighbourhood(cal_waveform, peak, half_width):
+    """ gather samples peak-half_width..peak+half_width, zero outside the readout window """
+    n_samples = cal_waveform.shape[-1]
+    index = peak[...,None]+np.arange(-half_width, half_width+1)
+    inside = (index >= 0) & (index < n_samples)
+    samples = np.take_along_axis(cal_waveform, np.clip(index, 0, n_samples-1), axis=-1)
+    return np.where(inside, samples, 0.)
+
+@register_estimator('parabolic')
+def parabolic(cal_waveform):
+    """
+    Vertex of the parabola through the maximum sample and its two neighbours
+
+    Parameters
+    ----------
+    cal_waveform : numpy.ndarray
+        pedestal subtracted waveforms, shape (..., n_samples)
+
+    Returns
+    ----------
+    numpy.ndarray
+
+    """
+    n_samples = cal_waveform.shape[-1]
+    peak = np.argmax(cal_waveform, axis=-1)
+    centre = np.clip(peak, 1, max(n_samples-2, 1))
+    y = _neighbourhood(cal_waveform, centre, 1)
+    curvature = y[...,0]-2*y[...,1]+y[...,2]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        offset = np.where(curvature < 0, 0.5*(y[...,0]-y[...,2])/curvature, 0.)
+    #peaks on the first or last sample are not bracketed, keep the sample itself
+    offset = np.where(centre == peak, np.clip(offset, -0.5, 0.5), 0.)
+    return peak+offset
+
+@register_estimator('sinc')
+def sinc(cal_waveform, oversample=10, half_width=8):
+    """
+    Maximum of the band-limited (Lanczos windowed sinc) interpolation of the
+    waveform within one sample of the maximum sample
+
+    Parameters
+    ----------
+    cal_waveform : numpy.ndarray
+        pedestal subtracted waveforms, shape (..., n_samples)
+    oversample : int (optional)
+        number of interpolated points per sample (default: 10)
+    half_width : int (optional)
+        number of samples on each side of the peak used for the interpolation (default: 8)
+
+    Returns
+    ----------
+    numpy.ndarray
+
+    """
+    peak = np.argmax(cal_waveform, axis=-1)
+    samples = _neighbourhood(cal_waveform, peak, half_width)
+    #the interpolation kernel only depends on the offsets, build it once per call
+    offsets = np.linspace(-1, 1, 2*int(oversample)+1)
+    distance = offsets[:,None]-np.arange(-half_width, half_width+1)[None,:]
+    kernel = np.sinc(distance)*np.sinc(distance/(half_width+1))
+    interpolated = np.einsum('...j,uj->...u', samples, kernel)
+    return peak+offsets[np.argmax(interpolated, axis=-1)]
+
+@register_estimator('leading_edge')
+def leading_edge(cal_waveform, fraction=0.5):
+    """
+    Linearly interpolated time at which the leading edge crosses a fraction of
+    the peak amplitude
+
+    Parameters
+    ----------
+    cal_waveform : numpy.ndarray
+        pedestal subtracted waveforms, shape (..., n_samples)
+    fraction : float (optional)
+        fraction of the peak amplitude defining the crossing (default: 0.5)
+
+    Returns
+    ----------
+    numpy.ndarray
+
+    """
+    n_samples = cal_waveform.shape[-1]
+    peak = np.argmax(cal_waveform, axis=-1)
+    threshold = fraction*np.take_along_axis(cal_waveform, peak[...,None], axis=-1)[...,0]
+    samples = np.arange(n_samples)
+    below = (cal_waveform < threshold[...,None]) & (samples <= peak[...,None])
+    last_below = np.max(np.where(below, samples, -1), axis=-1)
+    first = np.clip(last_below, 0, n_samples-1)
+    second = np.clip(last_below+1, 0, n_samples-1)
+    y0 = np.take_along_axis(cal_waveform, first[...,None], axis=-1)[...,0]
+    y1 = np.take_along_axis(cal_waveform, second[...,None], axis=-1)[...,0]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        crossing = first+np.where(y1 > y0, (threshold-y0)/(y1-y0), 0.)
+    #no sample below threshold before the peak, the edge is outside the readout window
+    return np.where(last_below < 0, peak, crossing).astype(float)
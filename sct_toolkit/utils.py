@@ -1,6 +1,5 @@
 from __future__ import absolute_import
 import os, sys
-import imp
 
 class docs(object):
     def __init__(self, show=True, update=False):
@@ -15,7 +14,7 @@ class docs(object):
             If True, rebuild documentation to reflect code changes (default:True)
 
         """
-        self.build_path = '/'.join(imp.find_module('sct_toolkit')[1].split('/')[:-1])+'/docs'
+        self.build_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))+'/docs'
         self.source_path = self.build_path+'/_build/html/index.html'
         if update:
             self._update_docs()
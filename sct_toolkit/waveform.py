@@ -2,8 +2,19 @@ from __future__ import division, print_function, absolute_import
 import sys, os, pwd
 import datetime
 import warnings
+from collections import OrderedDict
 import h5py
 import numpy as np
+from .pipeline import pipeline
+from .cache import find_run_file, get_cache
+from .catalog import update_catalog
+from .branch_index import list_branches, write_branch_index
+from .handle_pool import handles
+from .extractors import get_extractor
+from .timing import get_estimator
+from .stats import waveform_stats, block_envelopes, raw_binning, cal_binning
+from .common_mode import estimate_common_mode
+from .pedestal import channel_flags
 
 try:
     import target_io
@@ -11,6 +22,126 @@ try:
 except ImportError:
     pass
 
+try:
+    input = raw_input
+except NameError:
+    pass
+
+#default event block sizes of the min/max/mean preview envelopes
+preview_levels = [100, 1000, 10000]
+
+class calibrated_dataset(object):
+    """ Read-only view of pedestal subtracted waveforms computed when accessed """
+    def __init__(self, wf, module, asic, channel, chunk_size=10000):
+        """
+        Initialize calibrated dataset
+
+        Parameters
+        ----------
+        wf : waveform
+            waveform instance with a database stored in calibrate-on-read mode
+        module : int
+            module number
+        asic : int
+            asic number
+        channel : int
+            channel number
+        chunk_size : int
+            number of events calibrated at once (default: 10000)
+
+        """
+        self.wf = wf
+        self.module = module
+        self.asic = asic
+        self.channel = channel
+        self.chunk_size = int(chunk_size)
+        raw = wf.get_branch('Module{}/Asic{}/Channel{}/waveform'.format(module, asic, channel))
+        self.name = raw.name.replace('/waveform', '/cal_waveform')
+        self.shape = raw.shape
+        self.dtype = np.dtype(float)
+
+    def __array__(self, dtype=None, copy=None):
+        data = self[:]
+        if dtype is not None:
+            data = data.astype(dtype)
+        return data
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        events = np.arange(self.shape[0])[key[0]]
+        scalar = np.ndim(events) == 0
+        events = np.atleast_1d(events)
+        data = np.zeros((len(events), self.shape[1]))
+        if len(events):
+            order = np.argsort(events, kind='mergesort')
+            sorted_events = events[order]
+            for start in range(sorted_events[0], sorted_events[-1]+1, self.chunk_size):
+                stop = min(start+self.chunk_size, sorted_events[-1]+1)
+                lo, hi = np.searchsorted(sorted_events, [start, stop])
+                if lo == hi:
+                    continue
+                cal_waveform = self.wf._calibrate_events(self.module, self.asic, self.channel,
+                                                         start, stop)
+                data[order[lo:hi]] = cal_waveform[sorted_events[lo:hi]-start]
+        if scalar:
+            data = data[0]
+        return data[(Ellipsis,)+key[1:]] if len(key) > 1 else data
+
+    def __len__(self):
+        return self.shape[0]
+
+class sparse_dataset(object):
+    """ Read-only view of zero-suppressed waveforms, suppressed events read as fill_value """
+    def __init__(self, packed, index, n_events, fill_value=0):
+        """
+        Initialize sparse dataset
+
+        Parameters
+        ----------
+        packed : h5py.Dataset
+            stored waveforms, shape (n_stored, n_samples)
+        index : h5py.Dataset
+            increasing event numbers of the stored waveforms, shape (n_stored,)
+        n_events : int
+            total number of events
+        fill_value : float (optional)
+            value of the samples of suppressed events (default: 0)
+
+        """
+        self.packed = packed
+        self.index = np.asarray(index)
+        self.name = packed.name
+        self.shape = (int(n_events),)+packed.shape[1:]
+        self.dtype = packed.dtype
+        self.fill_value = fill_value
+
+    def __array__(self, dtype=None, copy=None):
+        data = self[:]
+        if dtype is not None:
+            data = data.astype(dtype)
+        return data
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        events = np.arange(self.shape[0])[key[0]]
+        scalar = np.ndim(events) == 0
+        events = np.atleast_1d(events)
+        data = np.full((len(events),)+self.shape[1:], self.fill_value, dtype=self.dtype)
+        rows = np.clip(np.searchsorted(self.index, events), 0, max(len(self.index)-1, 0))
+        stored = (self.index[rows] == events) if len(self.index) else np.zeros(len(events), bool)
+        if stored.any():
+            #read the contiguous block of packed rows spanning the request once
+            first, last = rows[stored].min(), rows[stored].max()+1
+            data[stored] = self.packed[first:last][rows[stored]-first]
+        if scalar:
+            data = data[0]
+        return data[(Ellipsis,)+key[1:]] if len(key) > 1 else data
+
+    def __len__(self):
+        return self.shape[0]
+
 class waveform(object):
     """ Class for writing waveform data """
     def __init__(self, database=None):
@@ -24,50 +155,212 @@ class waveform(object):
 
         """
         self.ped_database = None
+        self.ped_cache = OrderedDict()
+        self.store_calibrated = True
+        self.calibrate_on_read = False
+        self.ped_slices = None
+        self.masks = False
+        self.dead_channels = set()
+        self.zero_suppress = None
+        self.previews = []
+        self.branch_index = None
         self.database = database
         if database:
             self._load_database(database)
 
-    def _add_branch(self, event, block , phase, waveform, timestamp,
-                    module, asic, channel):
-        """ create new branch to hold waveform data """
-	branch_name = "Module{}/Asic{}/Channel{}".format(module ,asic, channel)
-	branch = self.database.create_group(branch_name)
-	branch.create_dataset("event", data=event)
-	branch.create_dataset("block", data=block)
-	branch.create_dataset("phase", data=phase)
-        branch.create_dataset("timestamp", data=timestamp)
-	branch.create_dataset("waveform", data=waveform)
-
-    def _add_ped_sub_branch(self, event, block , phase, waveform, cal_waveform, 
-                            timestamp, module, asic, channel,
-                            amplitude, position, charge):
-        """ create new branch to hold waveform data """
-        branch_name = "Module{}/Asic{}/Channel{}".format(module ,asic, channel)
-        branch = self.database.create_group(branch_name) 
-	branch.create_dataset("event", data=event)
-	branch.create_dataset("block", data=block)
-	branch.create_dataset("phase", data=phase)
-        branch.create_dataset("timestamp", data=timestamp)
-	branch.create_dataset("waveform", data=waveform)
-	branch.create_dataset("cal_waveform",data=cal_waveform)
-        branch.create_dataset("amplitude", data=amplitude)
-        branch.create_dataset("position", data=position)
-        branch.create_dataset("charge", data=charge)
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """ close the database when leaving a with block """
+        if isinstance(self.database, h5py.File):
+            self.close_database()
+        return False
+
+    def _calibrate_events(self, module, asic, channel, start, stop):
+        """ pedestal subtract stored raw waveforms of a range of events """
+        name = 'Module{}/Asic{}/Channel{}'.format(module, asic, channel)
+        branch = self.database[name]
+        ped_positions = self._get_cached_pedestal(module, asic, channel)
+        first_position = self.block_position[branch['block'][start:stop]]*32+branch['phase'][start:stop]
+        positions = first_position[:,None]+np.arange(self.n_samples)
+        if self.ped_slices:
+            slice_index = self.database['ped_slice_index'][start:stop][:,None]
+            slice_weight = self.database['ped_slice_weight'][start:stop][:,None]
+            next_index = np.minimum(slice_index+1, len(ped_positions)-1)
+            ped_values = ((1-slice_weight)*ped_positions[slice_index, positions]+
+                          slice_weight*ped_positions[next_index, positions])
+        else:
+            ped_values = ped_positions[positions]
+        cal_waveform = self.get_branch(name+'/waveform')[start:stop]-ped_values
+        if 'common_mode' in branch:
+            common_mode = self.get_branch(name+'/common_mode')[start:stop]
+            cal_waveform -= common_mode if common_mode.ndim == 2 else common_mode[:,None]
+        if 'zs_index' in branch:
+            #suppressed events read as zero, like stored calibrated waveforms
+            stored = np.isin(np.arange(start, stop), branch['zs_index'][()])
+            cal_waveform[~stored] = 0.
+        return np.round(cal_waveform, decimals=2)
+
+    def _accumulate_chunk(self, chunk):
+        """ update the waveform statistics and preview envelopes of a processed chunk """
+        if self.store_stats:
+            chunk = self._accumulate_stats(chunk)
+        if self.previews:
+            chunk = self._accumulate_previews(chunk)
+        return chunk
+
+    def _accumulate_previews(self, chunk):
+        """ attach the preview blocks completed by the chunk, calibrated waveforms if available """
+        if (chunk['module'], chunk['asic']) != self.preview_asic:
+            self.preview_asic = (chunk['module'], chunk['asic'])
+            self.asic_previews = OrderedDict((level, block_envelopes(level, self.n_events))
+                                             for level in self.previews)
+        key = 'cal_waveform' if 'cal_waveform' in chunk else 'waveform'
+        chunk['previews'] = OrderedDict((level, envelopes.add(chunk[key], chunk['start']))
+                                        for level, envelopes in self.asic_previews.items())
+        return chunk
+
+    def _accumulate_stats(self, chunk):
+        """ update the waveform statistics of the chunk's asic, attach them to its last chunk """
+        if (chunk['module'], chunk['asic']) != self.stats_asic:
+            self.stats_asic = (chunk['module'], chunk['asic'])
+            binnings = [('', raw_binning)]
+            if 'cal_waveform' in chunk:
+                binnings.append(('cal_', cal_binning))
+            if self.zero_suppress is None:
+                self.asic_stats = dict((prefix, waveform_stats(len(chunk['channels']),
+                                        self.n_samples, self.percentiles, **binning))
+                                       for prefix, binning in binnings)
+            else:
+                #stored events differ per channel, one accumulator per channel
+                self.asic_stats = dict((prefix, [waveform_stats(1, self.n_samples,
+                                        self.percentiles, **binning)
+                                        for channel in chunk['channels']])
+                                       for prefix, binning in binnings)
+        for prefix, stats in self.asic_stats.items():
+            if self.zero_suppress is None:
+                stats.add(chunk[prefix+'waveform'])
+                continue
+            #statistics of zero-suppressed databases cover the stored events, as make_stats
+            for index, channel in enumerate(chunk['channels']):
+                keep = chunk['amplitude'][:, index] > self._get_zs_threshold(
+                                                      chunk['module'], chunk['asic'], channel)
+                stats[index].add(chunk[prefix+'waveform'][keep, index][:,None])
+        if chunk['stop'] == self.n_events:
+            chunk['stats'] = self.asic_stats
+        return chunk
+
+    def _calibrate_chunk(self, chunk):
+        """ pedestal subtract a chunk of events, calculate amplitude, position and charge """
+        if not self.ped_database:
+            return self._accumulate_chunk(chunk)
+        if (chunk['module'], chunk['asic']) != self.ped_asic:
+            self._load_asic_pedestals(chunk['module'], chunk['asic'], chunk['channels'])
+        first_position = self.block_position[chunk['block']]*32+chunk['phase']
+        positions = first_position[:,:,None]+np.arange(self.n_samples)
+        channel_index = np.arange(len(chunk['channels']))[:,None]
+        if self.ped_slices:
+            #blend the two pedestal slices bracketing each event, weights are precomputed
+            slice_index = self.event_slice[chunk['event']][:,None,None]
+            slice_weight = self.event_weight[chunk['event']][:,None,None]
+            next_index = np.minimum(slice_index+1, len(self.ped_positions)-1)
+            ped_values = ((1-slice_weight)*self.ped_positions[slice_index, channel_index, positions]+
+                          slice_weight*self.ped_positions[next_index, channel_index, positions])
+        else:
+            ped_values = self.ped_positions[channel_index, positions]
+        cal_waveform = chunk['waveform']-ped_values
+        if self.common_mode is not None:
+            #all channels of the asic share the correction of an event
+            common_mode = estimate_common_mode(cal_waveform, method=self.common_mode,
+                                               **self.common_mode_options)
+            cal_waveform -= common_mode[:,None,:] if common_mode.ndim == 2 else \
+                            common_mode[:,None,None]
+            chunk['common_mode'] = np.repeat(common_mode[:,None], len(chunk['channels']), axis=1)
+        if self.masks:
+            #number of samples of each waveform read from cells flagged in the pedestal database
+            chunk['bad_samples'] = self.bad_positions[channel_index, positions].sum(axis=-1)
+
+        peak_pos = np.argmax(cal_waveform, axis=-1)
+        chunk['amplitude'] = np.take_along_axis(cal_waveform, peak_pos[:,:,None], axis=-1)[:,:,0]
+        chunk['position'] = peak_pos
+        chunk['charge'] = self.extractor(cal_waveform, self.lower, self.upper,
+                                         channels=chunk['channels'], **self.extractor_options)[0]
+        if self.timing is not None:
+            chunk['peak_time'] = self.timing(cal_waveform, **self.timing_options)
+        chunk['cal_waveform'] = np.round(cal_waveform, decimals=2)
+        return self._accumulate_chunk(chunk)
+
+    def _check_preview_levels(self, levels):
+        """ return sorted unique preview block sizes, [] for None/False, defaults for True """
+        if levels is None or levels is False:
+            return []
+        if levels is True:
+            return list(preview_levels)
+        levels = sorted(set(int(level) for level in np.atleast_1d(levels)))
+        if levels and levels[0] < 2:
+            raise ValueError("preview block sizes must be at least 2 events, got {}".format(
+                             levels[0]))
+        return levels
 
     def _check_type(self,data):
         """ check input type and map to integer(s) list """
-        if isinstance(data,list):
-            return map(int,data)
+        if isinstance(data,(list,tuple,range,np.ndarray)):
+            return list(map(int,data))
         elif isinstance(data,int):
             return [data]
         else:
             raise TypeError('Input must be integer or list, got {}'.format(type(data)))
 
+    def _cells_to_positions(self, cell_array):
+        """ reorder a cell id indexed array into readout order, padded for wrap around """
+        position_array = cell_array[...,self.cell_id_map]
+        return np.concatenate((position_array, position_array[...,:self.n_samples+32]), axis=-1)
+
+    def _create_branches(self, module, asic, channels):
+        """ create branches of the channels of an asic, sized to hold every event """
+        self.branches = []
+        for channel in channels:
+            branch_name = "Module{}/Asic{}/Channel{}".format(module ,asic, channel)
+            branch = self.database.create_group(branch_name)
+            sparse = self.zero_suppress is not None
+            for key, dtype, is_waveform in self._get_branch_keys():
+                if is_waveform and sparse:
+                    #only waveforms above threshold are appended, with their event numbers.
+                    #small chunks keep channels with few stored events small on disk
+                    dataset = branch.create_dataset(key, (0, self.n_samples), dtype=dtype,
+                                                    maxshape=(None, self.n_samples),
+                                                    chunks=(max(4096//self.n_samples, 1),
+                                                            self.n_samples))
+                    dataset.attrs['sparse'] = True
+                    continue
+                shape = (self.n_events, self.n_samples) if is_waveform else (self.n_events,)
+                branch.create_dataset(key, shape, dtype=dtype)
+            self._create_previews(branch, self.previews,
+                                  'cal_waveform' if self.ped_database else 'waveform')
+            if sparse:
+                branch.create_dataset('zs_index', (0,), dtype=int, maxshape=(None,),
+                                      chunks=(512,))
+                branch.attrs['zs_threshold'] = self._get_zs_threshold(module, asic, channel)
+            self.branches.append(branch)
+        self.branch_asic = (module, asic)
+
+    def _create_previews(self, branch, levels, source, overwrite=False):
+        """ create the min/max/mean preview datasets of a channel, one row per event block """
+        for level in levels:
+            n_blocks = -(-int(self.n_events)//level)
+            for name in ('min', 'max', 'mean'):
+                key = 'preview{}_{}'.format(level, name)
+                if key in branch and overwrite:
+                    del branch[key]
+                dataset = branch.create_dataset(key, (n_blocks, self.n_samples), dtype=np.float32)
+                dataset.attrs['block_size'] = level
+                dataset.attrs['source'] = source
+
     def _generate_maps(self):
         """ generates block and cell id mappings """
         block_id_map = [0]
-        for i in xrange(511):
+        for i in range(511):
             if block_id_map[-1]%2==0:
                 next_block = (block_id_map[-1]+3)%512
                 block_id_map.append(next_block)
@@ -75,81 +368,233 @@ class waveform(object):
                 next_block = (block_id_map[-1]-1)%512
                 block_id_map.append(next_block)
 
-        cell_id_map = np.array([])
-        block_cells = np.arange(32)
-        for i in xrange(512):
-            cell_id_map = np.append(cell_id_map,block_id_map[i]*32+block_cells)
-
         self.block_id_map = block_id_map
-        self.cell_id_map = cell_id_map.astype(int)
+        self.block_position = np.argsort(block_id_map)
+        self.cell_id_map = (np.array(block_id_map)[:,None]*32+np.arange(32)).ravel()
+
+    def _get_branch_keys(self):
+        """ return (key, dtype, is_waveform) of each dataset stored per channel """
+        keys = [('event', int, False), ('block', int, False), ('phase', int, False),
+                ('timestamp', int, False), ('waveform', int, True)]
+        if self.ped_database:
+            if self.store_calibrated:
+                keys += [('cal_waveform', float, True)]
+            if self.common_mode is not None:
+                keys += [('common_mode', float,
+                          bool(self.common_mode_options.get('per_sample', False)))]
+            keys += [('amplitude', float, False), ('position', int, False),
+                     ('charge', float, False)]
+            if self.timing is not None:
+                keys += [('peak_time', float, False)]
+            if self.masks:
+                keys += [('bad_samples', int, False)]
+        return keys
+
+    def _get_asic_channels(self, module, asic):
+        """ return the channels of an asic that are not flagged dead """
+        return [channel for channel in self.channels
+                if (int(module), int(asic), int(channel)) not in self.dead_channels]
+
+    def _get_zs_threshold(self, module, asic, channel):
+        """ return the zero suppression amplitude threshold of a channel, -inf keeps all events """
+        if isinstance(self.zero_suppress, dict):
+            return float(self.zero_suppress.get((int(module), int(asic), int(channel)), -np.inf))
+        return float(self.zero_suppress)
+
+    def _get_cached_pedestal(self, module, asic, channel):
+        """ return pedestal in readout order, keeping recently used channels in memory """
+        key = (module, asic, channel)
+        if key in self.ped_cache:
+            self.ped_cache[key] = self.ped_cache.pop(key)
+            return self.ped_cache[key]
+        if not self.ped_database:
+            self._load_ped_database(self._get_ped_name())
+            self._generate_maps()
+        self.ped_cache[key] = self._cells_to_positions(self._get_pedestal(module, asic, channel))
+        while len(self.ped_cache) > 64:
+            self.ped_cache.popitem(last=False)
+        return self.ped_cache[key]
 
     def _get_cell_ids(self, block, phase):
         """ convert block to cell id, shift for phase, return cell ids """
-        first_cell = self.block_id_map.index(int(block))*32
-        cells = np.arange(first_cell,first_cell+self.n_samples,1)+phase
-        shifted_cells = np.mod(cells,512*32)
-        return self.cell_id_map[shifted_cells]
+        first_position = self._get_first_position(block, phase)
+        positions = np.arange(first_position,first_position+self.n_samples,1)
+        shifted_positions = np.mod(positions,512*32)
+        return self.cell_id_map[shifted_positions]
+
+    def _get_first_position(self, block, phase):
+        """ return readout order position of the first sample """
+        return int(self.block_position[int(block)])*32+int(phase)
+
+    def _get_packet_channels(self, mod_i, asic, channels):
+        """ group channels by data packet, return list of (packet id, [(index, packet channel)]) """
+        packets = {}
+        for index, channel in enumerate(channels):
+            packet_id = (4*mod_i+asic)*16//self.channels_per_packet+channel//self.channels_per_packet
+            packets.setdefault(packet_id, []).append((index, channel%self.channels_per_packet))
+        return sorted(packets.items())
+
+    def _get_ped_name(self):
+        """ locate the pedestal database referenced by a calibrate-on-read database """
+        ped_name = str(self.database.attrs['ped_name'])
+        if not os.path.isfile(ped_name):
+            local_name = os.path.join(os.path.dirname(self.database.filename),
+                                      os.path.basename(ped_name))
+            if not os.path.isfile(local_name):
+                raise IOError("pedestal database '{}' referenced by '{}' not found".format(
+                              ped_name, self.database.filename))
+            ped_name = local_name
+        return ped_name
 
     def _get_pedestal(self, module, asic, channel):
         """ return pedestal array """
         ped_group = self.ped_database['Module{}/Asic{}/Channel{}'.format(module,asic,channel)]
+        if self.ped_slices:
+            return np.array(ped_group['pedestal_slices'])
         return np.array(ped_group['pedestal'])
 
-    def _load_database(self,name):
+    def _load_asic_pedestals(self, module, asic, channels):
+        """ load pedestals of the channels of an asic, reordered into readout order """
+        self.ped_positions = np.array([self._cells_to_positions(
+                                       self._get_pedestal(module, asic, channel))
+                                       for channel in channels])
+        if self.masks:
+            self.bad_positions = np.array([self._cells_to_positions(
+                self.ped_database['Module{}/Asic{}/Channel{}/cell_mask'.format(
+                                  module, asic, channel)][()] != 0) for channel in channels])
+        if self.ped_slices:
+            #(n_slices, n_channels, n_positions)
+            self.ped_positions = self.ped_positions.swapaxes(0, 1).copy()
+        self.ped_asic = (module, asic)
+
+    def _load_database(self, name, mode="r"):
         """ load an existing hdf5 database """
+        if mode != "r":
+            handles.discard(name)
         try:
-            self.database = h5py.File(name,"r",libver='latest')
+            if mode == "r":
+                self.database = handles.acquire(name)
+            else:
+                self.database = h5py.File(name,mode,libver='latest')
+            self.branch_index = None
             self.n_samples = self.database.attrs['waveform_length']
             self.n_events = self.database.attrs['num_events']
             self.modules = self.database.attrs['modules']
             self.asics = self.database.attrs['asics']
             self.channels = self.database.attrs['channels']
             self.run_number = self.database.attrs['run']
+            self.calibrate_on_read = bool(self.database.attrs.get('calibrate_on_read', False))
+            self.ped_slices = self.database.attrs.get('ped_slices', None)
+            self.dead_channels = set(tuple(int(value) for value in row) for row in
+                                     self.database.attrs.get('dead_channels', []))
         except IOError:
             raise IOError("file '{}' not found. Check name and/or path ".format(name))
 
     def _load_ped_database(self,ped_name):
         """ load an existing hdf5 pedestal database """
+        if isinstance(self.ped_database, h5py.File):
+            handles.release(self.ped_database)
         try:
-            self.ped_database = h5py.File(ped_name,"r",libver='latest')
+            self.ped_database = handles.acquire(ped_name)
         except IOError:
-            raise IOError("file '{}' not found. Check name and/or path ".format(name))
+            raise IOError("file '{}' not found. Check name and/or path ".format(ped_name))
 
     def _new_database(self, name, check_overwrite):
         """ generates a new hdf5 database """
         if check_overwrite:
-	    if os.path.isfile(name):
-		print("The file '{}' already exists.".format(name))
-		answers = {"yes","no"}
-		choice = None
-		while True:
-		    choice = raw_input("Would you like to overwrite it? (yes/no) ").lower()
-		    if choice in answers:
-			break
-		    else:
-			print("Not an acceptable input, try again!")
-		if choice == 'no':
-		    raise SystemExit('exiting...')
+            if os.path.isfile(name):
+                print("The file '{}' already exists.".format(name))
+                if not sys.stdin.isatty():
+                    raise IOError("file '{}' exists and overwrite cannot be confirmed "
+                                  "non-interactively, use check_overwrite=False".format(name))
+                answers = {"yes","no"}
+                choice = None
+                while True:
+                    choice = input("Would you like to overwrite it? (yes/no) ").lower()
+                    if choice in answers:
+                        break
+                    else:
+                        print("Not an acceptable input, try again!")
+                if choice == 'no':
+                    raise SystemExit('exiting...')
 
+        if isinstance(self.database, h5py.File):
+            handles.release(self.database)
+        handles.discard(name)
         self.database = h5py.File(name,"w",libver='latest')
 
+    def _print_progress(self, ievt):
+        """ print progress bar """
+        sys.stdout.write('\r')
+        sys.stdout.write("[%-100s] %d%%" % ('='*int((ievt)*100.0/(self.n_events)),
+                        (ievt)*100.0/(self.n_events)))
+        sys.stdout.flush()
+
     def _process_events(self):
-        """ iterate through modules, asics, and channels to process all events """
-	for mod_i, module in enumerate(self.modules):
-	    for asic in self.asics:
-		for channel in self.channels:
-                    print("Processing {} Events from Module {}, Asic {}, Channel {}".format(
-                           self.n_events, module, asic, channel))
-                    self._write_events(mod_i, module, asic, channel)
-
-    def _process_ped_sub_events(self):
-        """ iterate through modules, asics, and channels to process/subtract all events """
-        for mod_i, module in enumerate(self.modules):
-            for asic in self.asics:
-                for channel in self.channels:
-                    print("Processing {} Events from Module {}, Asic {}, Channel {}".format(
-                           self.n_events, module, asic, channel))
-                    self._write_subtracted_events(mod_i, module, asic, channel)
+        """ iterate through modules and asics to process all events in chunks """
+        tasks = [(mod_i, module, asic, start, min(start+self.chunk_size, self.n_events))
+                 for mod_i, module in enumerate(self.modules)
+                 for asic in self.asics if self._get_asic_channels(module, asic)
+                 for start in range(0, self.n_events, self.chunk_size)]
+        self.ped_asic = None
+        self.branch_asic = None
+        self.stats_asic = None
+        self.preview_asic = None
+        if self.pipelined:
+            stages = pipeline(self._read_chunk, self._calibrate_chunk, self._write_chunk,
+                              depth=self.queue_depth)
+            stages.run(tasks)
+            print('\n'.join(stages.get_stats()))
+        else:
+            for task in tasks:
+                self._write_chunk(self._calibrate_chunk(self._read_chunk(task)))
+
+    def _read_preview_source(self, module, asic, channel, source, start, stop):
+        """ read the full resolution waveforms of events [start, stop) previews are made of """
+        if source == 'cal_waveform':
+            return self.get_cal_waveform(module, asic, channel, slice(start, stop))
+        branch = self.get_branch('Module{}/Asic{}/Channel{}/waveform'.format(module, asic, channel))
+        return np.asarray(branch[start:stop])
+
+    def _read_timestamps(self):
+        """ return TACK timestamp of every event, read from the first packet """
+        timestamps = np.zeros(self.n_events, dtype=np.int64)
+        for ievt in range(self.n_events):
+            rawdata = self.reader.GetEventPacket(ievt, 0)
+            self.packet.Assign(rawdata, self.packet_size)
+            timestamps[ievt] = self.packet.GetTACKTime()
+        return timestamps
+
+    def _read_chunk(self, task):
+        """ read and decode packets of all channels in an asic for a range of events """
+        mod_i, module, asic, start, stop = task
+        n_chunk = stop-start
+        channels = self._get_asic_channels(module, asic)
+        n_channels = len(channels)
+        chunk = {'module': module, 'asic': asic, 'start': start, 'stop': stop,
+                 'channels': channels,
+                 'event': np.arange(start, stop, dtype=int),
+                 'block': np.zeros((n_chunk, n_channels), dtype=int),
+                 'phase': np.zeros((n_chunk, n_channels), dtype=int),
+                 'timestamp': np.zeros((n_chunk, n_channels), dtype=int),
+                 'waveform': np.zeros((n_chunk, n_channels, self.n_samples), dtype=int)}
+        packets = self._get_packet_channels(mod_i, asic, channels)
+        for i, ievt in enumerate(range(start, stop)):
+            for packet_id, packet_channels in packets:
+                rawdata = self.reader.GetEventPacket(ievt, packet_id)
+                self.packet.Assign(rawdata, self.packet_size)
+                block = int(self.packet.GetColumn()*8+self.packet.GetRow())
+                phase = int(self.packet.GetBlockPhase())
+                timestamp = self.packet.GetTACKTime()
+                for index, packet_channel in packet_channels:
+                    chunk['block'][i, index] = block
+                    chunk['phase'][i, index] = phase
+                    chunk['timestamp'][i, index] = timestamp
+                    wf = self.packet.GetWaveform(packet_channel)
+                    samples = chunk['waveform'][i, index]
+                    for j in range(self.n_samples):
+                        samples[j] = wf.GetADC(j)
+        return chunk
 
     def _set_attributes(self):
         """ assign metadata attributes to database """
@@ -167,42 +612,102 @@ class waveform(object):
         self.database.attrs['waveform_length'] = self.n_samples
         self.database.attrs['num_events'] = self.n_events
         self.database.attrs['structure'] = "Module#/Asic#/Channel#/'keys'"
+        self.database.attrs['keys'] = ", ".join(key for key, dtype, is_waveform
+                                                in self._get_branch_keys())
         if self.ped_database:
-            self.database.attrs['keys'] = "event, block, phase, timestamp, waveform, cal_waveform," \
-                                           " amplitude, position, charge"
             self.database.attrs['ped_name'] = str(self.ped_database.filename)
             self.database.attrs['charge_interval'] = "-{}, +{}".format(self.lower, self.upper)
+            self.database.attrs['charge_extractor'] = self.extractor_name
+            if self.ped_slices:
+                self.database.attrs['ped_slices'] = self.ped_slices
+                self.database.create_dataset('ped_slice_index', data=self.event_slice)
+                self.database.create_dataset('ped_slice_weight', data=self.event_weight)
+            if self.common_mode is not None:
+                self.database.attrs['common_mode'] = self.common_mode
+            if self.timing is not None:
+                self.database.attrs['timing_estimator'] = self.timing_name
+            self.database.attrs['calibrate_on_read'] = not self.store_calibrated
+            if self.zero_suppress is not None:
+                self.database.attrs['zero_suppressed'] = True
+            if self.masks:
+                self.database.attrs['dead_channels'] = np.array(sorted(self.dead_channels),
+                                                                dtype=int).reshape(-1, 3)
+        if self.store_stats:
+            self.database.attrs['stats_percentiles'] = self.percentiles
+        if self.previews:
+            self.database.attrs['preview_levels'] = self.previews
+            self.database.attrs['preview_source'] = ('cal_waveform' if self.ped_database
+                                                     else 'waveform')
+        write_branch_index(self.database)
+
+    def _set_masks(self, use_masks):
+        """ collect dead channels of pedestal databases with masks """
+        self.masks = bool(use_masks) and 'cell_flags' in self.ped_database.attrs
+        self.dead_channels = set()
+        if self.masks:
+            for module in self.modules:
+                for asic in self.asics:
+                    for channel in self.channels:
+                        group = self.ped_database['Module{}/Asic{}/Channel{}'.format(
+                                                  module, asic, channel)]
+                        if int(group.attrs.get('channel_mask', 0)) & channel_flags['dead']:
+                            self.dead_channels.add((int(module), int(asic), int(channel)))
+            if self.dead_channels:
+                print("Skipping {} dead channel(s): {}".format(len(self.dead_channels),
+                      ", ".join("{}/{}/{}".format(*key) for key in sorted(self.dead_channels))))
+
+    def _set_event_slices(self):
+        """ precompute pedestal time slice and interpolation weight of every event """
+        attrs = self.ped_database.attrs
+        if int(attrs.get('time_slices', 1)) < 2:
+            raise ValueError("pedestal database '{}' has no time slices, create it with "
+                             "time_slices > 1".format(self.ped_database.filename))
+        if attrs['slice_by'] == 'tack':
+            coordinate = self._read_timestamps().astype(float)
+            centers = np.asarray(attrs['slice_center_tack'], dtype=float)
         else:
-            self.database.attrs['keys'] = "event, block, phase, timestamp, waveform"
+            coordinate = (np.arange(self.n_events)+0.5)/self.n_events
+            centers = np.asarray(attrs['slice_center_fraction'], dtype=float)
+        n_slices = len(centers)
+        lower = np.clip(np.searchsorted(centers, coordinate, 'right')-1, 0, n_slices-2)
+        weight = np.clip((coordinate-centers[lower])/(centers[lower+1]-centers[lower]), 0, 1)
+        if self.ped_slices == 'nearest':
+            self.event_slice = lower+(weight > 0.5)
+            self.event_weight = np.zeros(self.n_events)
+        else:
+            self.event_slice = lower
+            self.event_weight = weight
 
     def _set_channels_per_packet(self):
         """ assign channels per packet  """
-	self.channels_per_packet = int((0.5*self.packet_size-10.)/(self.n_samples+1.))
+        self.channels_per_packet = int((0.5*self.packet_size-10.)/(self.n_samples+1.))
 
     def _set_data_packet_parameters(self):
         """ assigns data packet characteristics """
-	self.reader = target_io.EventFileReader(self.filename)
-	self.n_events = self.reader.GetNEvents()
-	rawdata = self.reader.GetEventPacket(0,0)
-	self.packet = target_driver.DataPacket()
-	self.packet_size = self.reader.GetPacketSize()
-	self.packet.Assign(rawdata, self.packet_size)
-	wf = self.packet.GetWaveform(0)
-	self.n_samples = wf.GetSamples()
+        self.reader = target_io.EventFileReader(self.filename)
+        self.n_events = self.reader.GetNEvents()
+        rawdata = self.reader.GetEventPacket(0,0)
+        self.packet = target_driver.DataPacket()
+        self.packet_size = self.reader.GetPacketSize()
+        self.packet.Assign(rawdata, self.packet_size)
+        wf = self.packet.GetWaveform(0)
+        self.n_samples = wf.GetSamples()
         self.waveform = np.arange(self.n_samples, dtype=int)
-	self._set_channels_per_packet()
+        self._set_channels_per_packet()
 
     def _set_run_file_path(self):
-        """ assigns file path for run number """
-	self.filename = "{}/target5and7data/run{}.fits".format(os.environ['HOME'],
-			 self.run_number)
-	if not os.path.isfile(self.filename):
-	    new_path = "{0}/target5and7data/runs_{1}0000_"\
-		       "through_{1}9999/".format(os.environ['HOME'],
-			str(self.run_number)[:-4])
-	    self.filename = new_path+"run{}.fits".format(self.run_number)
-	    if not os.path.isfile(self.filename):
-		raise IOError("File run{}.fits cannot be located".format(self.run_number))
+        """ assigns file path for run number, using the local run cache if enabled """
+        if self.cache is not None:
+            cached = self.cache.lookup(self.run_number)
+            if cached:
+                print("Using cached run file {}".format(cached))
+                self.filename = cached
+                return
+        if not os.path.ismount(os.environ['HOME']+'/target5and7data'):
+            raise IOError('{}/target5and7data must be mounted!'.format(os.environ['HOME']))
+        self.filename = find_run_file(self.run_number)
+        if self.cache is not None:
+            self.filename = self.cache.stage(self.run_number, self.filename)
 
     def _set_run_parameters(self, run_number, modules, asics, channels, 
                             filepath, comments, charge_interval):
@@ -225,90 +730,70 @@ class waveform(object):
         self.lower = int(np.fabs(charge_interval[0]))
         self.upper = int(np.fabs(charge_interval[1]))
 
-    def _write_events(self, mod_i, module, asic, channel):
-        """ write all events in a given module, asic, and channel """
-        event = np.zeros(self.n_events,dtype=int)
-        block = np.zeros(self.n_events,dtype=int)
-        phase = np.zeros(self.n_events,dtype=int)
-        timestamp = np.zeros(self.n_events,dtype=int)
-        waveform = np.zeros((self.n_events,self.n_samples),dtype=int)
-	for ievt in xrange(self.n_events):
-            if(ievt%1000==0):
-		sys.stdout.write('\r')
-		sys.stdout.write("[%-100s] %d%%" % ('='*int((ievt)*100.0/(self.n_events)), 
-                                (ievt)*100.0/(self.n_events)))
-		sys.stdout.flush()
-
-	    rawdata = self.reader.GetEventPacket(ievt,(4*mod_i+asic)\
-                      *16//self.channels_per_packet+channel//self.channels_per_packet)
-	    self.packet.Assign(rawdata, self.reader.GetPacketSize())
-            event[ievt] = int(ievt)
-            block[ievt] = int(self.packet.GetColumn()*8+self.packet.GetRow())
-	    phase[ievt] = int(self.packet.GetBlockPhase())
-            timestamp[ievt] = self.packet.GetTACKTime()
-	    wf = self.packet.GetWaveform(channel%self.channels_per_packet)
-	    waveform[ievt,:] = map(wf.GetADC, self.waveform)
-
-        self._add_branch(event, block, phase, waveform, timestamp, module, asic, channel)
-        sys.stdout.write('\n')
-
-    def _write_subtracted_events(self, mod_i, module, asic, channel):
-        """ write pedestal subtracted events in a given module, asic, and channel """
-        event = np.zeros(self.n_events,dtype=int)
-        block = np.zeros(self.n_events,dtype=int)
-        phase = np.zeros(self.n_events,dtype=int)
-        timestamp = np.zeros(self.n_events,dtype=int)
-        waveform = np.zeros((self.n_events,self.n_samples),dtype=int)
-        cal_waveform = np.zeros((self.n_events,self.n_samples),dtype=float)
-        amplitude = np.zeros(self.n_events,dtype=float)
-        position = np.zeros(self.n_events,dtype=int)
-        charge = np.zeros(self.n_events,dtype=float)
-        pedestal = self._get_pedestal(module, asic, channel)
-        for ievt in xrange(self.n_events):
-            if(ievt%1000==0):
-                sys.stdout.write('\r')
-                sys.stdout.write("[%-100s] %d%%" % ('='*int((ievt)*100.0/(self.n_events)),
-                                (ievt)*100.0/(self.n_events)))
-                sys.stdout.flush()
-
-            rawdata = self.reader.GetEventPacket(ievt,(4*mod_i+asic)\
-                      *16//self.channels_per_packet+channel//self.channels_per_packet)
-            self.packet.Assign(rawdata, self.reader.GetPacketSize())
-            event[ievt] = int(ievt)
-            block[ievt] = b = int(self.packet.GetColumn()*8+self.packet.GetRow())
-            phase[ievt] = p = int(self.packet.GetBlockPhase())
-            timestamp[ievt] = self.packet.GetTACKTime()
-            wf = self.packet.GetWaveform(channel%self.channels_per_packet)
-            samples = map(wf.GetADC, self.waveform)
-            waveform[ievt,:] = samples
-            cells = self._get_cell_ids(b, p)
-            ped_values = pedestal[cells]
-            cal_samples = np.array(samples)-ped_values
-            cal_waveform[ievt,:] = cal_samples
-            amplitude[ievt] = np.amax(cal_samples)
-            peak_pos = np.argmax(cal_samples)
-            position[ievt] = peak_pos
-            if peak_pos < self.lower:
-                charge[ievt] = np.sum(cal_samples[:peak_pos+self.upper])
-            elif peak_pos >=  (self.n_samples-self.upper):
-                charge[ievt] = np.sum(cal_samples[peak_pos-self.lower:])
-            else:
-                charge[ievt] = np.sum(cal_samples[peak_pos-self.lower:peak_pos+self.upper])
-
-        cal_waveform = np.round(cal_waveform,decimals=2)
-        self._add_ped_sub_branch(event, block, phase, waveform, cal_waveform, 
-                                 timestamp, module, asic, channel,
-                                 amplitude, position, charge)
-        sys.stdout.write('\n')
+    def _write_previews(self, branch, level, envelopes, index):
+        """ store the completed preview blocks of one channel of an accumulator """
+        first, minimum, maximum, mean = envelopes
+        if len(minimum):
+            for name, values in (('min', minimum), ('max', maximum), ('mean', mean)):
+                branch['preview{}_{}'.format(level, name)][first:first+len(values)] = \
+                    values[:, index]
+
+    def _write_stats(self, branch, prefix, stats, index, overwrite=False):
+        """ store mean, RMS and percentile waveforms of one channel of an accumulator """
+        values = {'avg_': stats.get_mean()[index], 'rms_': stats.get_rms()[index]}
+        if stats.percentiles:
+            values['percentile_'] = stats.get_percentiles()[index]
+        for name, value in values.items():
+            key = '{}{}waveform'.format(name, prefix)
+            if key in branch and overwrite:
+                del branch[key]
+            dataset = branch.create_dataset(key, data=value)
+            dataset.attrs['n_events'] = stats.n
+            if name == 'percentile_':
+                dataset.attrs['percentiles'] = stats.percentiles
+
+    def _write_chunk(self, chunk):
+        """ write a processed chunk of events into the branches of its asic """
+        if (chunk['module'], chunk['asic']) != self.branch_asic:
+            print("Processing {} Events from Module {}, Asic {}".format(
+                   self.n_events, chunk['module'], chunk['asic']))
+            self._create_branches(chunk['module'], chunk['asic'], chunk['channels'])
+        start, stop = chunk['start'], chunk['stop']
+        for index, branch in enumerate(self.branches):
+            if self.zero_suppress is not None:
+                keep = np.nonzero(chunk['amplitude'][:, index] > branch.attrs['zs_threshold'])[0]
+                n_stored = branch['zs_index'].shape[0]
+                branch['zs_index'].resize((n_stored+len(keep),))
+                branch['zs_index'][n_stored:] = chunk['event'][keep]
+            for key, dtype, is_waveform in self._get_branch_keys():
+                if key == 'event':
+                    branch[key][start:stop] = chunk[key]
+                elif is_waveform and self.zero_suppress is not None:
+                    branch[key].resize((n_stored+len(keep), self.n_samples))
+                    branch[key][n_stored:] = chunk[key][keep, index]
+                else:
+                    branch[key][start:stop] = chunk[key][:, index]
+            for prefix, stats in chunk.get('stats', {}).items():
+                if isinstance(stats, list):
+                    self._write_stats(branch, prefix, stats[index], 0)
+                else:
+                    self._write_stats(branch, prefix, stats, index)
+            for level, envelopes in chunk.get('previews', {}).items():
+                self._write_previews(branch, level, envelopes, index)
+        self._print_progress(stop)
+        if stop == self.n_events:
+            sys.stdout.write('\n')
 
     def close_database(self):
-        """ Close currently loaded/created pedestal database """
+        """ Close currently loaded/created database, read-only handles return to the pool """
         if isinstance(self.database, h5py.File):
-            self.database.close()
+            handles.release(self.database)
+            self.database = None
         else:
             warnings.warn("No database currently open!",stacklevel=2)
         if isinstance(self.ped_database, h5py.File):
-            self.ped_database.close()
+            handles.release(self.ped_database)
+            self.ped_database = None
 
     def get_attributes(self,verbose=True):
         """ 
@@ -329,6 +814,194 @@ class waveform(object):
             print('\n'.join('{}: {}'.format(key, val) for key, val in attributes))
         return attributes
 
+    def extract_charge(self, extractor, charge_interval=None, name=None, chunk_size=10000,
+                       overwrite=False, **options):
+        """
+        Run a charge extractor over the calibrated waveforms of the loaded database
+        and store the result as 'charge_<name>' in every channel. Only the database
+        is read, run files are not needed.
+
+        Parameters
+        ----------
+        extractor : str or callable
+            name of a registered extractor, see sct_toolkit.extractors, or an
+            extractor function
+        charge_interval : list of 2 ints (optional)
+            integration interval [lower, upper]. If None, the charge_interval of the
+            database is used (default: None)
+        name : str (optional)
+            dataset suffix, if None the extractor name is used (default: None)
+        chunk_size : int (optional)
+            number of events processed at once (default: 10000)
+        overwrite : bool (optional)
+            if True, replaces existing datasets of the same name (default: False)
+        **options
+            extra keyword arguments passed to the extractor
+
+        Returns
+        ----------
+        str, name of the new datasets
+
+        """
+        if not isinstance(self.database, h5py.File):
+            raise IOError("no database loaded")
+        func = get_extractor(extractor)
+        if name is None:
+            name = extractor if isinstance(extractor, str) else func.__name__
+        key = 'charge_{}'.format(name)
+        if charge_interval is None:
+            charge_interval = str(self.database.attrs['charge_interval']).split(',')
+        lower, upper = [int(np.fabs(int(value))) for value in charge_interval]
+        #reopen writable for the duration of the pass
+        filename = self.database.filename
+        handles.release(self.database)
+        self._load_database(filename, mode="r+")
+        try:
+            for module in self.modules:
+                for asic in self.asics:
+                    channels = self._get_asic_channels(module, asic)
+                    if not channels:
+                        continue
+                    branches = [self.database['Module{}/Asic{}/Channel{}'.format(
+                                module, asic, channel)] for channel in channels]
+                    for branch in branches:
+                        if key in branch:
+                            if not overwrite:
+                                raise IOError("dataset '{}' already exists in {}, use "
+                                              "overwrite=True".format(key, branch.name))
+                            del branch[key]
+                        dataset = branch.create_dataset(key, (self.n_events,), dtype=float)
+                        dataset.attrs['extractor'] = str(name)
+                        dataset.attrs['charge_interval'] = "-{}, +{}".format(lower, upper)
+                    for start in range(0, self.n_events, int(chunk_size)):
+                        stop = min(start+int(chunk_size), self.n_events)
+                        cal_waveform = np.stack([self.get_cal_waveform(module, asic, channel,
+                                                 slice(start, stop))
+                                                 for channel in channels], axis=1)
+                        charge = func(cal_waveform, lower, upper, channels=channels,
+                                      **options)[0]
+                        for index, branch in enumerate(branches):
+                            branch[key][start:stop] = charge[:, index]
+            keys = [k.strip() for k in str(self.database.attrs['keys']).split(',')]
+            if key not in keys:
+                self.database.attrs['keys'] = ", ".join(keys+[key])
+            write_branch_index(self.database)
+        finally:
+            handles.release(self.database)
+            self._load_database(filename)
+        return key
+
+    def make_stats(self, percentiles=[5, 50, 95], chunk_size=10000, overwrite=False):
+        """
+        Compute mean, RMS and percentile waveforms of the raw and, when available,
+        calibrated waveforms of every channel of the loaded database in a single
+        streaming pass, and store them as avg_waveform, rms_waveform,
+        percentile_waveform, avg_cal_waveform, etc. Zero-suppressed databases only hold
+        the waveforms of stored events, so the statistics cover the stored events of each
+        channel, the same events as the statistics stored by write_events. The number of
+        events is stored as the 'n_events' attribute of each dataset.
+
+        Parameters
+        ----------
+        percentiles : list of floats (optional)
+            percentiles to estimate (default: [5, 50, 95])
+        chunk_size : int (optional)
+            number of events read at once (default: 10000)
+        overwrite : bool (optional)
+            if True, replaces existing statistics (default: False)
+
+        """
+        if not isinstance(self.database, h5py.File):
+            raise IOError("no database loaded")
+        percentiles = [float(q) for q in percentiles]
+        filename = self.database.filename
+        handles.release(self.database)
+        self._load_database(filename, mode="r+")
+        try:
+            for module in self.modules:
+                for asic in self.asics:
+                    for channel in self._get_asic_channels(module, asic):
+                        branch = self.database['Module{}/Asic{}/Channel{}'.format(
+                                               module, asic, channel)]
+                        if 'avg_waveform' in branch and not overwrite:
+                            raise IOError("statistics already exist in {}, use "
+                                          "overwrite=True".format(branch.name))
+                        calibrated = self.get_branch(branch.name+'/cal_waveform') is not None
+                        accumulators = {'': waveform_stats(1, self.n_samples, percentiles,
+                                                           **raw_binning)}
+                        if calibrated:
+                            accumulators['cal_'] = waveform_stats(1, self.n_samples, percentiles,
+                                                                  **cal_binning)
+                        raw = self.get_branch(branch.name+'/waveform')
+                        events = self.get_stored_events(module, asic, channel)
+                        for start in range(0, len(events), int(chunk_size)):
+                            stop = min(start+int(chunk_size), len(events))
+                            if len(events) == self.n_events:
+                                selection = slice(start, stop)
+                            else:
+                                selection = events[start:stop]
+                            accumulators[''].add(raw[selection][:,None])
+                            if calibrated:
+                                accumulators['cal_'].add(self.get_cal_waveform(
+                                    module, asic, channel, selection)[:,None])
+                        for prefix, stats in accumulators.items():
+                            self._write_stats(branch, prefix, stats, 0, overwrite=overwrite)
+            self.database.attrs['stats_percentiles'] = percentiles
+            write_branch_index(self.database)
+        finally:
+            handles.release(self.database)
+            self._load_database(filename)
+
+    def make_previews(self, levels=preview_levels, chunk_size=10000, overwrite=False):
+        """
+        Compute the min/max/mean preview envelopes of every channel of the loaded database
+        in a single streaming pass, ex. for databases written without previews
+
+        Parameters
+        ----------
+        levels : list of ints (optional)
+            event block sizes (default: [100, 1000, 10000])
+        chunk_size : int (optional)
+            number of events read at once (default: 10000)
+        overwrite : bool (optional)
+            if True, replaces existing previews (default: False)
+
+        """
+        if not isinstance(self.database, h5py.File):
+            raise IOError("no database loaded")
+        levels = self._check_preview_levels(levels)
+        keys = [key.strip() for key in str(self.database.attrs['keys']).split(',')]
+        source = 'cal_waveform' if 'cal_waveform' in keys or self.calibrate_on_read \
+                 else 'waveform'
+        filename = self.database.filename
+        handles.release(self.database)
+        self._load_database(filename, mode="r+")
+        try:
+            for module in self.modules:
+                for asic in self.asics:
+                    for channel in self._get_asic_channels(module, asic):
+                        branch = self.database['Module{}/Asic{}/Channel{}'.format(
+                                               module, asic, channel)]
+                        if 'preview{}_min'.format(levels[0]) in branch and not overwrite:
+                            raise IOError("previews already exist in {}, use "
+                                          "overwrite=True".format(branch.name))
+                        self._create_previews(branch, levels, source, overwrite=overwrite)
+                        accumulators = [(level, block_envelopes(level, self.n_events))
+                                        for level in levels]
+                        for start in range(0, self.n_events, int(chunk_size)):
+                            stop = min(start+int(chunk_size), self.n_events)
+                            values = self._read_preview_source(module, asic, channel, source,
+                                                               start, stop)[:,None]
+                            for level, envelopes in accumulators:
+                                self._write_previews(branch, level,
+                                                     envelopes.add(values, start), 0)
+            self.database.attrs['preview_levels'] = levels
+            self.database.attrs['preview_source'] = source
+            write_branch_index(self.database)
+        finally:
+            handles.release(self.database)
+            self._load_database(filename)
+
     def get_asic_list(self):
         """ 
         Get list of asics 
@@ -366,11 +1039,21 @@ class waveform(object):
 
         """ 
         if isinstance(self.database, h5py.File):
-            return self.database.get(str(branch_name))
+            branch_name = str(branch_name)
+            branch = self.database.get(branch_name)
+            if branch is None and self.calibrate_on_read and branch_name.endswith('/cal_waveform'):
+                names = branch_name.strip('/').split('/')
+                module, asic, channel = [int(name[len(prefix):]) for name, prefix in
+                                         zip(names, ['Module', 'Asic', 'Channel'])]
+                return calibrated_dataset(self, module, asic, channel)
+            if isinstance(branch, h5py.Dataset) and branch.attrs.get('sparse', False):
+                return sparse_dataset(branch, branch.parent['zs_index'], self.n_events)
+            return branch
         else:
             warnings.warn("No database currently open!",stacklevel=2)
 
-    def get_branches(self, verbose=False, filter_by=None):
+    def get_branches(self, verbose=False, filter_by=None, modules=None, asics=None,
+                     channels=None, keys=None):
         """
         Get a list of branch names for each group/subgroup in database
 
@@ -381,6 +1064,14 @@ class waveform(object):
         filter_by : list(str), (optional)
             Filter branches matching the specified pattern(s), ex. single ["Module118/Asic10/"]
             or mutltiple ["Module118","Channel10"] (default: None). Note: case sensitive
+        modules : list of ints (optional)
+            only branches of these modules (default: None)
+        asics : list of ints (optional)
+            only branches of these asics (default: None)
+        channels : list of ints (optional)
+            only branches of these channels (default: None)
+        keys : list of str (optional)
+            only datasets with these names, ex. ['charge', 'amplitude'] (default: None)
 
         Returns
         ----------
@@ -388,16 +1079,109 @@ class waveform(object):
 
         """
         if isinstance(self.database, h5py.File):
-            branches = set()
-            self.database.visit(branches.add)
-            if filter_by:
-                branches = [b for b in branches if all([f in b for f in set(filter_by)])]
+            if self.branch_index is None and 'branch_index' in self.database:
+                self.branch_index = self.database['branch_index'][()]
+            branches = list_branches(self.database, filter_by=filter_by, modules=modules,
+                                     asics=asics, channels=channels, keys=keys,
+                                     index=self.branch_index)
             if verbose:
                 print('\n'.join(b for b in branches))
-            return map(str,branches)
+            return list(map(str,branches))
         else:
             warnings.warn("No database currently open!",stacklevel=2)
 
+    def get_cal_waveform(self, module, asic, channel, events=None):
+        """
+        Get pedestal subtracted waveforms for a given module, asic, and channel.
+        Databases written with store_calibrated=False are calibrated on read.
+
+        Parameters
+        ----------
+        module : int
+            module number
+        asic : int
+            asic number
+        channel : int
+            channel number
+        events : slice, int or list of ints (optional)
+            events to read (default: all events)
+
+        Returns
+        ----------
+        numpy.ndarray
+
+        """
+        branch = self.get_branch('Module{}/Asic{}/Channel{}/cal_waveform'.format(
+                                 module, asic, channel))
+        if branch is None:
+            raise KeyError("no calibrated waveforms for Module{}/Asic{}/Channel{}".format(
+                           module, asic, channel))
+        if events is None:
+            events = slice(None)
+        return np.asarray(branch[events])
+
+    def get_stored_events(self, module, asic, channel):
+        """
+        Get the events whose full waveforms are stored. In zero-suppressed databases
+        these are the events above the channel's amplitude threshold, the waveforms of
+        other events read as zeros.
+
+        Parameters
+        ----------
+        module : int
+            module number
+        asic : int
+            asic number
+        channel : int
+            channel number
+
+        Returns
+        ----------
+        numpy.ndarray
+
+        """
+        branch = self.get_branch('Module{}/Asic{}/Channel{}'.format(module, asic, channel))
+        if branch is None:
+            raise KeyError("Module{}/Asic{}/Channel{} not found in database".format(
+                           module, asic, channel))
+        if 'zs_index' in branch:
+            return branch['zs_index'][()]
+        return np.arange(self.n_events)
+
+    def get_waveform_stats(self, module, asic, channel, calibrated=False):
+        """
+        Get stored mean, RMS and percentile waveforms of a given module, asic, and channel
+
+        Parameters
+        ----------
+        module : int
+            module number
+        asic : int
+            asic number
+        channel : int
+            channel number
+        calibrated : bool (optional)
+            if True, statistics of the pedestal subtracted waveforms (default: False)
+
+        Returns
+        ----------
+        dict with keys 'mean', 'rms', 'percentiles' and 'percentile_waveform'
+
+        """
+        prefix = 'cal_' if calibrated else ''
+        branch = self.get_branch('Module{}/Asic{}/Channel{}'.format(module, asic, channel))
+        if branch is None or 'avg_{}waveform'.format(prefix) not in branch:
+            raise KeyError("no waveform statistics for Module{}/Asic{}/Channel{}, see "
+                           "make_stats".format(module, asic, channel))
+        result = {'mean': branch['avg_{}waveform'.format(prefix)][()],
+                  'rms': branch['rms_{}waveform'.format(prefix)][()],
+                  'percentiles': [], 'percentile_waveform': None}
+        key = 'percentile_{}waveform'.format(prefix)
+        if key in branch:
+            result['percentiles'] = list(branch[key].attrs['percentiles'])
+            result['percentile_waveform'] = branch[key][()]
+        return result
+
     def get_cell_id_map(self):
         """
         Get the cell id map
@@ -420,6 +1204,17 @@ class waveform(object):
         """
         return list(self.channels)
 
+    def get_dead_channels(self):
+        """
+        Get channels skipped because their pedestal database flagged them dead
+
+        Returns
+        ----------
+        list of (module, asic, channel) tuples
+
+        """
+        return sorted(self.dead_channels)
+
     def get_database(self):
         """
         Get currently loaded database
@@ -481,9 +1276,105 @@ class waveform(object):
         """
         return self.n_events
 
+    def get_preview(self, module, asic, channel, start=0, stop=None, max_points=1000):
+        """
+        Get per sample minimum, maximum and mean waveforms of event blocks for browsing a
+        range of events of a given module, asic, and channel
+
+        Ranges of at most max_points events are returned at full resolution. Otherwise the
+        finest stored preview level with at most max_points blocks in the range is read,
+        blocks of the coarsest level are merged if none fits, and databases without
+        previews are reduced on the fly. Blocks are aligned to multiples of the block
+        size, so the first and last block may extend beyond the range. Previews are
+        made of the calibrated waveforms when a pedestal database was used, including
+        the events of zero-suppressed channels whose waveforms are not stored.
+
+        Parameters
+        ----------
+        module : int
+            module number
+        asic : int
+            asic number
+        channel : int
+            channel number
+        start : int (optional)
+            first event of the range (default: 0)
+        stop : int (optional)
+            end of the range, all events if None (default: None)
+        max_points : int (optional)
+            maximum number of events or blocks to return (default: 1000)
+
+        Returns
+        ----------
+        dict with keys 'block_size', 'event' first event of each block, and 'min', 'max',
+        'mean' of shape (n_blocks, n_samples)
+
+        """
+        name = 'Module{}/Asic{}/Channel{}'.format(module, asic, channel)
+        branch = self.get_branch(name)
+        if branch is None:
+            raise KeyError("{} not found in database".format(name))
+        stop = self.n_events if stop is None else min(int(stop), self.n_events)
+        start = max(int(start), 0)
+        max_points = max(int(max_points), 1)
+        if 'preview_source' in self.database.attrs:
+            source = str(self.database.attrs['preview_source'])
+        else:
+            source = 'cal_waveform' if self.get_branch(name+'/cal_waveform') is not None \
+                     else 'waveform'
+        if stop-start <= max_points:
+            values = self._read_preview_source(module, asic, channel, source, start, stop)
+            values = np.asarray(values, dtype=float)
+            return {'block_size': 1, 'event': np.arange(start, stop),
+                    'min': values, 'max': values, 'mean': values}
+        levels = [int(level) for level in self.database.attrs.get('preview_levels', [])
+                  if 'preview{}_min'.format(level) in branch]
+        if not levels:
+            #no stored previews, reduce the full resolution waveforms of the range
+            level = -(-(stop-start)//max_points)
+            while -(-stop//level)-start//level > max_points:
+                level += 1
+            envelopes = block_envelopes(level, stop)
+            blocks = []
+            for chunk_start in range(start, stop, 10000):
+                values = self._read_preview_source(module, asic, channel, source, chunk_start,
+                                                   min(chunk_start+10000, stop))
+                blocks.append(envelopes.add(values[:,None], chunk_start))
+            minimum, maximum, mean = [np.concatenate([block[i][:,0] for block in blocks])
+                                      for i in (1, 2, 3)]
+            event = np.concatenate(([start], np.arange(start//level+1, -(-stop//level))*level))
+            return {'block_size': level, 'event': event, 'min': minimum, 'max': maximum,
+                    'mean': mean}
+        fitting = [level for level in levels if -(-stop//level)-start//level <= max_points]
+        level = fitting[0] if fitting else levels[-1]
+        first, last = start//level, -(-stop//level)
+        minimum, maximum, mean = [branch['preview{}_{}'.format(level, key)][first:last]
+                                  .astype(float) for key in ('min', 'max', 'mean')]
+        counts = np.minimum((np.arange(first, last)+1)*level, self.n_events)- \
+                 np.arange(first, last)*level
+        factor = -(-(last-first)//max_points)
+        if factor > 1:
+            #merge consecutive blocks of the coarsest level, means weighted by event count
+            edges = np.arange(0, last-first, factor)
+            minimum = np.minimum.reduceat(minimum, edges, axis=0)
+            maximum = np.maximum.reduceat(maximum, edges, axis=0)
+            mean = np.add.reduceat(mean*counts[:,None], edges, axis=0)/ \
+                   np.add.reduceat(counts, edges)[:,None]
+            return {'block_size': level*factor, 'event': (first+edges)*level,
+                    'min': minimum, 'max': maximum, 'mean': mean}
+        return {'block_size': level, 'event': np.arange(first, last)*level,
+                'min': minimum, 'max': maximum, 'mean': mean}
+
     def write_events(self, run_number, modules, outname=None, outdir='.', 
                      ped_name=None, asics=range(4),channels=range(16), filepath=None, 
-                     check_overwrite=True, comments=None, charge_interval=[8,8]):
+                     check_overwrite=True, comments=None, charge_interval=[8,8],
+                     pipelined=False, chunk_size=1000, queue_depth=2,
+                     cache=None, prefetch_run=None, store_calibrated=True,
+                     extractor='global_peak', extractor_options=None,
+                     timing='parabolic', timing_options=None, store_stats=False,
+                     percentiles=[5, 50, 95], common_mode=None, common_mode_options=None,
+                     ped_slices=None, use_masks=True, zero_suppress=None,
+                     previews=None, catalog=None):
         """ 
         Create a new database from waveform data
 
@@ -514,30 +1405,131 @@ class waveform(object):
             Comments to be added as metadata to database
         charge_interval : list of 2 ints (optional)
             interval to use for charge integration, +- peak amplitide. default: [lower,upper]=[8,8]
+        pipelined : bool (optional)
+            if True, packet reading and HDF5 writing run in their own threads, overlapping
+            with pedestal subtraction. Per stage statistics are printed at the end (default: False)
+        chunk_size : int (optional)
+            number of events read, calibrated and written at once (default: 1000)
+        queue_depth : int (optional)
+            maximum number of chunks buffered between pipeline stages (default: 2)
+        cache : run_cache or str (optional)
+            local staging cache, or its directory, for run files located in target5and7data.
+            Cached runs do not require the remote directory to be mounted. If None, the
+            SCT_TOOLKIT_CACHE_DIR environment variable is used when set (default: None)
+        prefetch_run : int (optional)
+            run number to stage into the cache in the background, ex. the next run of a
+            batch (default: None)
+        store_calibrated : bool (optional)
+            if False, cal_waveform is not stored. Only the raw waveform, block and phase are
+            kept together with the pedestal database name, and get_branch/get_cal_waveform
+            compute calibrated waveforms on read (default: True)
+        extractor : str or callable (optional)
+            charge extractor, see sct_toolkit.extractors for the available algorithms
+            (default: 'global_peak')
+        extractor_options : dict (optional)
+            extra keyword arguments passed to the extractor (default: None)
+        timing : str, callable or None (optional)
+            sub-sample pulse timing estimator stored as 'peak_time' in units of samples,
+            see sct_toolkit.timing for the available algorithms. If None, peak_time is
+            not stored (default: 'parabolic')
+        timing_options : dict (optional)
+            extra keyword arguments passed to the timing estimator (default: None)
+        store_stats : bool (optional)
+            if True, mean, RMS and percentile waveforms of the raw and calibrated waveforms
+            of every channel are accumulated while writing and stored as avg_waveform,
+            rms_waveform, percentile_waveform, avg_cal_waveform, etc. With zero_suppress,
+            they cover the stored events of each channel, like make_stats. The percentile
+            histograms hold 4096 raw and 5120 calibrated 32 bit bins per channel and
+            sample, ~150 MB per asic at 256 samples, and add to the write time. Empty
+            percentiles keep only mean and RMS. The statistics can also be computed later
+            with make_stats (default: False)
+        percentiles : list of floats (optional)
+            percentiles stored with store_stats (default: [5, 50, 95])
+        common_mode : str (optional)
+            if 'median' or 'mean', the baseline shift shared by all channels of an asic is
+            estimated from its quiet channels in every event and subtracted after pedestal
+            subtraction. The correction is stored as 'common_mode', see
+            sct_toolkit.common_mode (default: None)
+        common_mode_options : dict (optional)
+            extra keyword arguments passed to estimate_common_mode, ex. per_sample, threshold
+            or n_sigma (default: None)
+        ped_slices : str (optional)
+            for pedestal databases with time slices, 'nearest' subtracts the slice closest
+            in time to each event and 'interpolate' blends the two bracketing slices. Events
+            are matched by TACK time for pedestals sliced by 'tack', otherwise by their
+            fractional position in the run. If None, the run pedestal is used (default: None)
+        use_masks : bool (optional)
+            if True and the pedestal database has cell and channel masks, channels flagged
+            dead are skipped, i.e. neither decoded nor stored, and the number of samples of
+            each waveform read from flagged cells is stored as 'bad_samples' (default: True)
+        zero_suppress : float or dict (optional)
+            calibrated amplitude threshold, in ADC counts, for storing waveforms. Only the
+            waveforms of events above threshold are stored, packed together with their
+            event numbers ('zs_index'), while per event quantities are kept for all events.
+            A dict maps (module, asic, channel) to per channel thresholds, channels not
+            listed keep all events. get_branch and get_cal_waveform return suppressed
+            waveforms as zeros. Requires ped_name (default: None)
+        previews : bool or list of ints (optional)
+            event block sizes of min/max/mean preview envelopes of the calibrated, or
+            without ped_name raw, waveforms of every channel, stored as preview100_min,
+            preview100_max, etc. True uses [100, 1000, 10000]. See get_preview
+            (default: None)
+        catalog : run_catalog, str or False (optional)
+            run catalog updated with the new database, False to disable. If None, the
+            SCT_TOOLKIT_CATALOG environment variable or ~/.sct_toolkit/catalog.db is used
+            (default: None)
 
         """
-	if not os.path.ismount(os.environ['HOME']+'/target5and7data'):
-	    raise IOError('{}/target5and7data must be mounted!'.format(os.environ['HOME']))
-
         if not outname:
             outname = 'run{}.h5'.format(run_number)
         outfile = outdir+'/'+outname
 
-	if not os.path.isdir(outdir):
+        if not os.path.isdir(outdir):
             os.mkdir(outdir)
 
+        self.cache = get_cache(cache)
         self._set_run_parameters(run_number, modules, asics=asics, channels=channels, 
                                  filepath=filepath, comments=comments, 
                                  charge_interval=charge_interval)
+        if self.cache is not None and prefetch_run is not None:
+            self.cache.prefetch(prefetch_run)
+        self.store_calibrated = bool(store_calibrated)
+        self.extractor = get_extractor(extractor)
+        self.extractor_name = extractor if isinstance(extractor, str) else self.extractor.__name__
+        self.extractor_options = dict(extractor_options or {})
+        if ped_slices not in (None, 'nearest', 'interpolate'):
+            raise ValueError("ped_slices must be None, 'nearest' or 'interpolate', "
+                             "got '{}'".format(ped_slices))
+        self.ped_slices = ped_slices if ped_name else None
+        if zero_suppress is not None and not ped_name:
+            raise ValueError("zero_suppress requires a pedestal database (ped_name)")
+        self.zero_suppress = zero_suppress
+        self.common_mode = common_mode
+        self.common_mode_options = dict(common_mode_options or {})
+        self.store_stats = bool(store_stats)
+        self.previews = self._check_preview_levels(previews)
+        self.percentiles = [float(q) for q in percentiles]
+        self.timing = None
+        if timing is not None:
+            self.timing = get_estimator(timing)
+            self.timing_name = timing if isinstance(timing, str) else self.timing.__name__
+        self.timing_options = dict(timing_options or {})
+        self.pipelined = bool(pipelined)
+        self.chunk_size = int(chunk_size)
+        self.queue_depth = int(queue_depth)
         self._new_database(outfile, check_overwrite)
         self._set_data_packet_parameters()
+        self.masks = False
+        self.dead_channels = set()
         if ped_name:
             self._load_ped_database(ped_name)
             self._generate_maps()
-            self._process_ped_sub_events()
-        else:
-            self._process_events()
+            self._set_masks(use_masks)
+            if self.ped_slices:
+                self._set_event_slices()
+        self._process_events()
         self._set_attributes()
         self.close_database()
+        update_catalog(outfile, catalog)
         print("Database successfully created, saving to {}".format(outfile))
 
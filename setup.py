@@ -17,5 +17,6 @@ setup(name='sct_toolkit',
       author='Miles J. Winter',
       author_email='milesjwinter@gmail.com',
       packages=find_packages(),
+      entry_points={'console_scripts': ['sct-toolkit=sct_toolkit.cli:main']},
       install_requires=['numpy','matplotlib','bokeh','h5py',
                         'sphinx','sphinx_rtd_theme'])
@@ -0,0 +1,38 @@
+from __future__ import division, print_function, absolute_import
+import os
+import sys
+import subprocess
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def _run(code):
+    """ run code in a fresh interpreter, modules loaded by other tests would hide a regression """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([root]+[path for path in
+                                               [env.get('PYTHONPATH')] if path])
+    subprocess.check_call([sys.executable, '-c', code], env=env, cwd=root)
+
+def test_import_package_without_plotting():
+    _run("import sys\n"
+         "import sct_toolkit\n"
+         "assert 'matplotlib' not in sys.modules\n"
+         "assert 'bokeh' not in sys.modules\n")
+
+def test_import_cli_without_plotting():
+    _run("import sys\n"
+         "import sct_toolkit.cli\n"
+         "assert 'matplotlib' not in sys.modules\n"
+         "assert 'bokeh' not in sys.modules\n")
+
+def test_lazy_attributes_resolve():
+    _run("import sct_toolkit\n"
+         "for name, (module, attribute) in sct_toolkit._lazy_attributes.items():\n"
+         "    value = getattr(sct_toolkit, name)\n"
+         "    assert value.__name__ == attribute, name\n"
+         "    assert getattr(sct_toolkit, name) is value, name\n")
+
+def test_lazy_attribute_loads_plotting():
+    _run("import sys\n"
+         "import sct_toolkit\n"
+         "sct_toolkit.plot_charge\n"
+         "assert 'matplotlib' in sys.modules\n")
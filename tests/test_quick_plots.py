@@ -0,0 +1,59 @@
+from __future__ import division, print_function, absolute_import
+import numpy as np
+import h5py
+import pytest
+
+matplotlib = pytest.importorskip('matplotlib')
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+from sct_toolkit import quick_plots
+
+def _make_database(filename, dead_channel):
+    """ waveform database of one asic with a dead channel skipped, as write_events stores it """
+    rng = np.random.RandomState(0)
+    n_events, n_samples = 50, 16
+    with h5py.File(filename, "w") as database:
+        database.attrs['waveform_length'] = n_samples
+        database.attrs['num_events'] = n_events
+        database.attrs['modules'] = np.array([100])
+        database.attrs['asics'] = np.array([0])
+        database.attrs['channels'] = np.arange(16)
+        database.attrs['run'] = 1
+        database.attrs['dead_channels'] = np.array([[100, 0, dead_channel]])
+        for channel in range(16):
+            if channel == dead_channel:
+                continue
+            group = database.create_group('Module100/Asic0/Channel{}'.format(channel))
+            group.create_dataset('charge', data=rng.normal(500, 50, n_events))
+            group.create_dataset('amplitude', data=rng.normal(100, 10, n_events))
+            group.create_dataset('position', data=rng.randint(0, n_samples, n_events))
+
+@pytest.mark.parametrize('plot', ['plot_charge', 'plot_amplitude', 'plot_position'])
+def test_grid_skips_dead_channel(tmp_path, plot):
+    filename = str(tmp_path/'dead.h5')
+    _make_database(filename, dead_channel=3)
+    getattr(quick_plots, plot)(filename, 100, 0)
+    axes = plt.gcf().axes
+    plt.close('all')
+    assert len(axes) == 16
+    assert [text.get_text() for text in axes[3].texts] == ['dead']
+    assert not axes[3].patches
+    assert all(ax.patches for index, ax in enumerate(axes) if index != 3)
+
+@pytest.mark.parametrize('plot', ['plot_charge', 'plot_amplitude', 'plot_position'])
+def test_channel_zero_is_a_single_channel(tmp_path, plot):
+    filename = str(tmp_path/'dead.h5')
+    _make_database(filename, dead_channel=3)
+    getattr(quick_plots, plot)(filename, 100, 0, channel=0, bins=np.arange(0, 1000, 10))
+    axes = plt.gcf().axes
+    plt.close('all')
+    assert len(axes) == 1
+    assert axes[0].get_title().endswith('Mod100, ASIC0, Ch0')
+
+def test_grid_titles_name_channels(tmp_path):
+    filename = str(tmp_path/'dead.h5')
+    _make_database(filename, dead_channel=3)
+    quick_plots.plot_charge(filename, 100, 0)
+    titles = [ax.get_title() for ax in plt.gcf().axes]
+    plt.close('all')
+    assert titles[5] == 'Charge: Ch5'